@@ -0,0 +1,199 @@
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from .executor import InferenceOverloaded
+
+
+class TextQueryBatcher:
+    """
+    Gom các truy vấn văn bản đồng thời thành một batch.
+
+    Mỗi batch chỉ chạy một lần encode_text và một lần FAISS search nhiều dòng,
+    sau đó trả kết quả về cho từng caller thông qua Future. Caller chờ trong luồng của mình (không chiếm
+    worker của InferenceExecutor), nên batch có thể lớn hơn số worker; hàng đợi có giới hạn và deadline riêng.
+    """
+
+    def __init__(self, search_fn, window_ms=5, max_batch_size=32, initializer=None, max_pending=256, deadline=0):
+        """
+        Args:
+            search_fn (callable): Hàm nhận (texts, top_k) và trả về tuple các mảng
+                (ví dụ distances, indices, vectors) với mỗi dòng tương ứng một text.
+            window_ms (float): Thời gian tối đa chờ gom thêm truy vấn (mili giây).
+            max_batch_size (int): Số truy vấn tối đa trong một batch.
+            initializer (callable): Gọi một lần trong luồng của batcher trước batch đầu tiên
+                (ví dụ đặt số luồng FAISS).
+            max_pending (int): Số truy vấn tối đa chờ trong hàng đợi; vượt quá sẽ bị từ chối.
+            deadline (float): Thời gian tối đa (giây) caller chờ kết quả, 0 = không giới hạn.
+        """
+        self.search_fn = search_fn
+        self.window = max(window_ms, 0) / 1000.0
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.initializer = initializer
+        self.max_pending = max(int(max_pending), 1)
+        self.deadline = float(deadline or 0)
+
+        self._pending = []
+        self._cond = threading.Condition()
+
+        # Metrics phục vụ tinh chỉnh window / batch size
+        self._metrics_lock = threading.Lock()
+        self._batch_count = 0
+        self._query_count = 0
+        self._batch_size_histogram = {}
+        self._recent_waits = deque(maxlen=1000)
+        self._max_wait = 0.0
+        self._rejected = 0
+        self._expired = 0
+        # Thời gian xử lý trung bình của một batch (EWMA, giây) để ước lượng Retry-After
+        self._service_time = 0.05
+
+        self._worker = threading.Thread(target=self._run, name='clip-text-batcher', daemon=True)
+        self._worker.start()
+
+    def _retry_after(self):
+        return math.ceil((len(self._pending) / self.max_batch_size + 1) * self._service_time)
+
+    def has_room(self):
+        """True nếu hàng đợi còn dưới một nửa (việc nền như làm mới cache không chiếm chỗ của request)"""
+        with self._cond:
+            return len(self._pending) < self.max_pending // 2
+
+    def submit(self, query_text, top_k):
+        """
+        Đưa một truy vấn vào hàng đợi, trả về Future chứa các mảng một dòng của truy vấn.
+
+        Raises:
+            InferenceOverloaded: nếu hàng đợi đã có max_pending truy vấn (reason='queue_full').
+        """
+        future = Future()
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                with self._metrics_lock:
+                    self._rejected += 1
+                raise InferenceOverloaded(
+                    f"Text query queue is full ({self.max_pending} waiting)", self._retry_after(), 'queue_full'
+                )
+            self._pending.append((query_text, top_k, time.monotonic(), future))
+            self._cond.notify()
+        return future
+
+    def search(self, query_text, top_k, timeout=None):
+        """
+        Gửi truy vấn và chờ kết quả của batch chứa nó (tối đa timeout giây, mặc định là deadline).
+
+        Raises:
+            InferenceOverloaded: nếu hàng đợi đầy (reason='queue_full') hoặc quá deadline (reason='deadline').
+        """
+        future = self.submit(query_text, top_k)
+        timeout = timeout if timeout is not None else (self.deadline or None)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            # Truy vấn chưa vào batch thì bị bỏ, không tốn encode cho kết quả không ai chờ
+            future.cancel()
+            with self._metrics_lock:
+                self._expired += 1
+            raise InferenceOverloaded(
+                f"Text query did not finish within {timeout:g}s", self._retry_after(), 'deadline'
+            )
+
+    def _run(self):
+        if self.initializer is not None:
+            self.initializer()
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                # Chờ tới khi đủ batch hoặc hết window tính từ truy vấn cũ nhất
+                deadline = self._pending[0][2] + self.window
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:self.max_batch_size]
+
+            self._process(batch)
+
+    def _process(self, batch):
+        # Bỏ các truy vấn caller đã huỷ (quá deadline) trong lúc chờ
+        batch = [item for item in batch if item[3].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.monotonic()
+
+        # Loại bỏ các text trùng nhau trong cùng một batch
+        unique_texts = []
+        row_by_text = {}
+        for query_text, _, _, _ in batch:
+            if query_text not in row_by_text:
+                row_by_text[query_text] = len(unique_texts)
+                unique_texts.append(query_text)
+
+        max_k = max(top_k for _, top_k, _, _ in batch)
+
+        try:
+            outputs = self.search_fn(unique_texts, max_k)
+        except Exception as e:
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        # Mỗi caller nhận dòng của mình; caller tự cắt theo top_k
+        for query_text, _, _, future in batch:
+            row = row_by_text[query_text]
+            future.set_result(tuple(output[row:row + 1] for output in outputs))
+
+        self._record(len(batch), [started - enqueued for _, _, enqueued, _ in batch], time.monotonic() - started)
+
+    def _record(self, batch_size, waits, elapsed):
+        with self._metrics_lock:
+            self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+            self._batch_count += 1
+            self._query_count += batch_size
+            self._batch_size_histogram[batch_size] = self._batch_size_histogram.get(batch_size, 0) + 1
+            self._recent_waits.extend(waits)
+            self._max_wait = max(self._max_wait, max(waits))
+
+    def get_metrics(self):
+        """Trả về thống kê batch size và thời gian chờ trong hàng đợi (ms)"""
+        with self._metrics_lock:
+            waits = sorted(self._recent_waits)
+            batch_count = self._batch_count
+            query_count = self._query_count
+            histogram = dict(sorted(self._batch_size_histogram.items()))
+            max_wait = self._max_wait
+            rejected = self._rejected
+            expired = self._expired
+        with self._cond:
+            pending = len(self._pending)
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p * len(waits)))] * 1000
+
+        return {
+            'window_ms': self.window * 1000,
+            'max_batch_size': self.max_batch_size,
+            'max_pending': self.max_pending,
+            'pending': pending,
+            'rejected_queue_full': rejected,
+            'deadline_exceeded': expired,
+            'batches': batch_count,
+            'queries': query_count,
+            'avg_batch_size': (query_count / batch_count) if batch_count else 0.0,
+            'batch_size_histogram': histogram,
+            'queue_wait_ms': {
+                'p50': percentile(0.50),
+                'p95': percentile(0.95),
+                'p99': percentile(0.99),
+                'max': max_wait * 1000,
+            },
+        }
@@ -10,7 +10,34 @@ import os
 import django
 import sys
 import pickle
-from django.core.cache import cache
+import hashlib
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from clip_retrieval.batcher import TextQueryBatcher
+from clip_retrieval.executor import InferenceExecutor, bounded, set_thread_budget
+from clip_retrieval.index_factory import (
+    build_index, describe_index, load_index_info, make_search_params, read_index, rerank_exact, save_index_info,
+    set_search_defaults, supports_selector
+)
+from clip_retrieval.index_log import IndexUpdateLog
+from clip_retrieval.index_snapshot import IndexSnapshot, merge_hits
+from clip_retrieval.lexical_index import LexicalIndex, fuse_scores
+from clip_retrieval.popular_queries import PopularQueryRefresher, PopularQueryTracker
+from clip_retrieval.query_cache import (
+    CacheGeneration, QueryEmbeddingCache, RankedPageStore, RankedResultCache, SingleFlightCache, decode_cursor,
+    encode_cursor, normalize_query, query_hash
+)
+from clip_retrieval.snapshot import (
+    SNAPSHOT_FILES, WAL_NAME, SnapshotError, acquire_snapshot_lock, commit_snapshot, load_manifest, pending_path,
+    recover_snapshot, release_snapshot_lock
+)
+from clip_retrieval.vector_store import VectorStore
+from clip_retrieval.wal import OP_ADD, OP_DELETE, OP_METADATA, IndexWAL, WALRecord
+from model_inference.encoders import (
+    SAMPLE_QUERIES, build_encoder, configure_threads, sample_images, to_channels_last
+)
 
 # sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
@@ -24,10 +51,126 @@ os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 # Thời gian cache mặc định (24 giờ)
 DEFAULT_CACHE_TTL = 60 * 60 * 24
 
+# Sau SOFT_TTL giây kết quả đã cache bị coi là cũ: vẫn được trả ngay, một lần làm mới chạy nền.
+# Khi chưa có kết quả, chỉ một request (lock LOCK_TTL giây trong Redis) tính, các request khác chờ tối đa LOCK_WAIT
+SEARCH_CACHE_SOFT_TTL = getattr(settings, 'CLIP_SEARCH_CACHE_SOFT_TTL', 60 * 60)
+SEARCH_CACHE_LOCK_TTL = getattr(settings, 'CLIP_SEARCH_CACHE_LOCK_TTL', 10)
+SEARCH_CACHE_LOCK_WAIT = getattr(settings, 'CLIP_SEARCH_CACHE_LOCK_WAIT', 5.0)
+
+# Theo dõi truy vấn văn bản phổ biến (Redis sorted set, suy giảm theo HALF_LIFE giây) và tính trước kết quả
+# cho TOP_N truy vấn mỗi khi index thay đổi
+POPULAR_QUERIES_ENABLED = getattr(settings, 'CLIP_POPULAR_QUERIES_ENABLED', True)
+POPULAR_QUERIES_TOP_N = getattr(settings, 'CLIP_POPULAR_QUERIES_TOP_N', 100)
+POPULAR_QUERIES_HALF_LIFE = getattr(settings, 'CLIP_POPULAR_QUERIES_HALF_LIFE', 6 * 60 * 60)
+POPULAR_QUERIES_MAX_SIZE = getattr(settings, 'CLIP_POPULAR_QUERIES_MAX_SIZE', 10000)
+POPULAR_QUERIES_REFRESH_INTERVAL = getattr(settings, 'CLIP_POPULAR_QUERIES_REFRESH_INTERVAL', 5)
+
+# Gom các truy vấn văn bản đồng thời thành batch
+TEXT_BATCH_ENABLED = getattr(settings, 'CLIP_TEXT_BATCH_ENABLED', True)
+TEXT_BATCH_WINDOW_MS = getattr(settings, 'CLIP_TEXT_BATCH_WINDOW_MS', 5)
+TEXT_BATCH_MAX_SIZE = getattr(settings, 'CLIP_TEXT_BATCH_MAX_SIZE', 32)
+TEXT_BATCH_MAX_PENDING = getattr(settings, 'CLIP_TEXT_BATCH_MAX_PENDING', 256)
+
+# Cache embedding truy vấn (LRU trong process) và độ sâu danh sách xếp hạng được cache
+QUERY_EMBEDDING_LRU_SIZE = getattr(settings, 'CLIP_QUERY_EMBEDDING_LRU_SIZE', 1024)
+RANK_CACHE_DEPTH = getattr(settings, 'CLIP_RANK_CACHE_DEPTH', 100)
+
+# Vector mới được search chính xác trong delta của snapshot; đủ DELTA_MAX_VECTORS thì gộp vào FAISS index
+DELTA_MAX_VECTORS = getattr(settings, 'CLIP_INDEX_DELTA_MAX_VECTORS', 2048)
+
+# Tự động compact index khi tỉ lệ vector đã bị xoá (tombstone) vượt ngưỡng
+COMPACTION_THRESHOLD = getattr(settings, 'CLIP_COMPACTION_THRESHOLD', 0.1)
+
+# Loại index (flat, ivf_flat, ivf_pq, hnsw) và tham số search mặc định của deployment
+INDEX_TYPE = getattr(settings, 'CLIP_INDEX_TYPE', 'flat')
+IVF_NLIST = getattr(settings, 'CLIP_IVF_NLIST', None)
+IVF_NPROBE = getattr(settings, 'CLIP_IVF_NPROBE', 16)
+HNSW_EF_SEARCH = getattr(settings, 'CLIP_HNSW_EF_SEARCH', 64)
+
+# Kiểu lưu vector trong index (float32, float16, int8, pq); index nén được re-rank chính xác
+# bằng vector gốc trên đĩa với RERANK_FACTOR lần số ứng viên
+INDEX_STORAGE = getattr(settings, 'CLIP_INDEX_STORAGE', 'float32')
+RERANK_FACTOR = getattr(settings, 'CLIP_RERANK_FACTOR', 4)
+
+# Tìm kiếm hai tầng: index giảm chiều bằng PCA (0 = tắt) chọn ít nhất RERANK_MIN_CANDIDATES ứng viên,
+# sau đó xếp hạng lại chính xác bằng vector 512 chiều gốc
+INDEX_PCA_DIM = getattr(settings, 'CLIP_INDEX_PCA_DIM', 0)
+RERANK_MIN_CANDIDATES = getattr(settings, 'CLIP_RERANK_MIN_CANDIDATES', 200)
+# Số truy vấn đo recall khi engine tự build lại index (compaction): ít hơn rebuild_clip_index (500)
+RECALL_SAMPLE_SIZE = getattr(settings, 'CLIP_INDEX_RECALL_SAMPLE', 100)
+# Hàng kết quả bị thiếu (bộ lọc quá chặt với IVF / HNSW): quét chính xác nếu số ảnh hợp lệ không vượt quá
+# giới hạn này, ngược lại search ANN lại với nprobe / efSearch rộng hơn
+SHORT_ROW_EXACT_LIMIT = getattr(settings, 'CLIP_SHORT_ROW_EXACT_LIMIT', 20000)
+
+# Memory-map index và embeddings (read-only) để các worker dùng chung page cache
+INDEX_MMAP = getattr(settings, 'CLIP_INDEX_MMAP', False)
+
+# Mỗi thay đổi chỉ ghi nối một bản ghi vào WAL; snapshot toàn bộ index sau mỗi SNAPSHOT_INTERVAL bản ghi
+SNAPSHOT_INTERVAL = getattr(settings, 'CLIP_SNAPSHOT_INTERVAL', 500)
+WAL_FSYNC = getattr(settings, 'CLIP_WAL_FSYNC', True)
+SNAPSHOT_VERIFY = getattr(settings, 'CLIP_SNAPSHOT_VERIFY', False)
+# Thời gian chờ lock snapshot khi load; hết thời gian thì đọc không cần lock (kiểm tra checksum theo manifest)
+SNAPSHOT_LOCK_WAIT = getattr(settings, 'CLIP_SNAPSHOT_LOCK_WAIT', 30)
+SNAPSHOT_LOAD_ATTEMPTS = 3
+
+# Đồng bộ index giữa các worker: mọi thay đổi được cấp version và ghi vào log chung (Redis stream giữ
+# LOG_RETENTION entry), mỗi worker đọc log (chờ tối đa SYNC_POLL giây mỗi lần) và áp dụng theo thứ tự.
+# Chỉ một worker lưu snapshot tại một thời điểm (lock SNAPSHOT_LOCK_TTL giây)
+INDEX_SYNC_ENABLED = getattr(settings, 'CLIP_INDEX_SYNC_ENABLED', True)
+INDEX_LOG_RETENTION = getattr(settings, 'CLIP_INDEX_LOG_RETENTION', 10000)
+INDEX_SYNC_POLL = getattr(settings, 'CLIP_INDEX_SYNC_POLL', 5.0)
+INDEX_SYNC_BATCH = 500
+
+# Số luồng tải ảnh song song khi index theo batch
+FETCH_WORKERS = getattr(settings, 'CLIP_INDEX_FETCH_WORKERS', 8)
+
+# Giới hạn cứng số kết quả của một lần tìm kiếm
+MAX_TOP_K = getattr(settings, 'CLIP_SEARCH_MAX_TOP_K', 100)
+
+# Tìm kiếm kết hợp: trọng số của điểm CLIP (phần còn lại là BM25 trên title / description)
+# và số ứng viên lấy từ mỗi nguồn trước khi trộn
+HYBRID_CLIP_WEIGHT = getattr(settings, 'CLIP_HYBRID_CLIP_WEIGHT', 0.5)
+HYBRID_CANDIDATES = getattr(settings, 'CLIP_HYBRID_CANDIDATES', 100)
+
+# Phân trang bằng cursor: độ sâu danh sách xếp hạng lưu phía server và thời gian giữ danh sách
+PAGE_DEPTH = getattr(settings, 'CLIP_SEARCH_PAGE_DEPTH', 500)
+PAGE_TTL = getattr(settings, 'CLIP_SEARCH_PAGE_TTL', 60 * 30)
+
+# Embedding của ảnh upload được cache theo hash nội dung (LRU trong process + Redis)
+UPLOAD_EMBEDDING_LRU_SIZE = getattr(settings, 'CLIP_UPLOAD_EMBEDDING_LRU_SIZE', 256)
+
+# Backend inference cho encoder văn bản / ảnh (eager | torchscript | onnx) và lượng tử hoá int8
+INFERENCE_BACKEND = getattr(settings, 'CLIP_INFERENCE_BACKEND', 'eager')
+INFERENCE_QUANTIZATION = getattr(settings, 'CLIP_INFERENCE_QUANTIZATION', 'none')
+INFERENCE_NUM_THREADS = getattr(settings, 'INFERENCE_NUM_THREADS', 0)
+INFERENCE_CHANNELS_LAST = getattr(settings, 'INFERENCE_CHANNELS_LAST', False)
+INFERENCE_DIR = getattr(settings, 'INFERENCE_ARTIFACT_DIR', os.path.join(str(INDEX_DIR), 'inference'))
+
+# Executor cho search: số worker, số request chờ tối đa (vượt quá -> 503) và deadline (giây) mỗi request;
+# INFERENCE_NUM_THREADS là tổng số luồng torch / FAISS chia đều cho các worker
+SEARCH_WORKERS = getattr(settings, 'CLIP_SEARCH_WORKERS', 2)
+SEARCH_QUEUE_SIZE = getattr(settings, 'CLIP_SEARCH_QUEUE_SIZE', 16)
+SEARCH_DEADLINE = getattr(settings, 'CLIP_SEARCH_DEADLINE', 10.0)
+
 # Define the index directory
 
 # INDEX_DIR = r".\mediafiles\clip_index"
 
+
+def _normalize(features):
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+
+def _is_compressed(index_info):
+    """Quantized codes or PCA-reduced vectors: the index only shortlists, raw vectors give exact distances"""
+    # Indexes built before index_info.json existed are float32
+    return index_info.get('storage', 'float32') != 'float32' or bool(index_info.get('pca_dim'))
+
+
+def clamp_top_k(top_k):
+    """Giới hạn top_k trong khoảng [1, MAX_TOP_K]"""
+    return min(max(int(top_k), 1), MAX_TOP_K)
+
 class CLIPImageSearch:
     # Singleton instance
     _instance = None
@@ -45,382 +188,1242 @@ class CLIPImageSearch:
         if CLIPImageSearch._initialized:
             return
             
+        # Serializes index mutations (add / remove / fold / compaction); searches never take it, they read
+        # self.snapshot, an immutable IndexSnapshot that writers replace with a new one
+        self._write_lock = threading.RLock()
+        # Held together with the Redis snapshot lock by the thread that owns it
+        self._snapshot_mutex = threading.Lock()
+        self._compaction_thread = None
+        self._snapshot_thread = None
+        self._fold_thread = None
+        
+        # Shared, versioned log of index updates (None = this process is the only writer)
+        self.index_log = IndexUpdateLog(retention=INDEX_LOG_RETENTION) if INDEX_SYNC_ENABLED else None
+        self._sync_thread = None
+        self._sync_stats = {'remote_applied': 0, 'reloads': 0, 'skipped_versions': 0}
+        # Rebuild count of the snapshot on disk that this worker loaded (see rebuild_clip_index)
+        self._rebuild = 0
+        
+        # Bounded executor for search requests (shared torch / FAISS thread budget)
+        self.executor = InferenceExecutor(
+            max_workers=SEARCH_WORKERS, max_queue=SEARCH_QUEUE_SIZE, deadline=SEARCH_DEADLINE,
+            thread_budget=INFERENCE_NUM_THREADS
+        )
+        # Số luồng intra-op của torch là của cả process: đặt một lần ở đây, trước khi worker nào chạy
+        configure_threads(self.executor.threads_per_worker)
+        
         # Load CLIP model
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model, self.preprocess = clip.load("ViT-B/32", self.device)
+        if INFERENCE_CHANNELS_LAST:
+            # Một lần lúc load, chỉ phần visual: encode_text dùng chung model không bị ảnh hưởng
+            to_channels_last(self.model.visual)
+        self._load_encoders()
         
         # Load data and FAISS index
         self.load_data()
         
+        # Batcher for concurrent text queries: callers wait in their own thread, not on an executor worker,
+        # so a batch can hold more queries than SEARCH_WORKERS; it has its own queue limit and deadline
+        self.text_batcher = None
+        if TEXT_BATCH_ENABLED:
+            self.text_batcher = TextQueryBatcher(
+                self._search_text_batch,
+                window_ms=TEXT_BATCH_WINDOW_MS,
+                max_batch_size=TEXT_BATCH_MAX_SIZE,
+                initializer=lambda: set_thread_budget(self.executor.threads_per_worker),
+                max_pending=TEXT_BATCH_MAX_PENDING,
+                deadline=SEARCH_DEADLINE
+            )
+        
+        # Query embedding cache (in-process LRU + Redis) and ranked id cache
+        self.embedding_cache = QueryEmbeddingCache(max_entries=QUERY_EMBEDDING_LRU_SIZE)
+        # Search result caches: single-flight on miss, stale-while-revalidate refreshes run in the background
+        # (text rankings through the batcher, image results on the executor)
+        cache_options = dict(
+            soft_ttl=SEARCH_CACHE_SOFT_TTL, lock_ttl=SEARCH_CACHE_LOCK_TTL, wait=SEARCH_CACHE_LOCK_WAIT
+        )
+        self.rank_cache = RankedResultCache(DEFAULT_CACHE_TTL, background=self._refresh_ranking, **cache_options)
+        self.result_cache = SingleFlightCache(
+            DEFAULT_CACHE_TTL, background=self.executor.submit_background, **cache_options
+        )
+        # Generation of every cached search result: bumped (one INCR) whenever the index changes
+        self.search_generation = CacheGeneration('clip_search')
+        self.upload_cache = QueryEmbeddingCache(max_entries=UPLOAD_EMBEDDING_LRU_SIZE, prefix='clip_upload_emb')
+        self.page_store = RankedPageStore(ttl=PAGE_TTL)
+        
+        # Popular query tracking; the refresher re-ranks the top queries whenever the generation changes
+        self.popular_queries = PopularQueryTracker(
+            half_life=POPULAR_QUERIES_HALF_LIFE, max_size=POPULAR_QUERIES_MAX_SIZE
+        )
+        self.popular_refresher = None
+        if POPULAR_QUERIES_ENABLED:
+            self.popular_refresher = PopularQueryRefresher(
+                self.popular_queries, self.search_generation, self._warm_query, top_n=POPULAR_QUERIES_TOP_N,
+                interval=POPULAR_QUERIES_REFRESH_INTERVAL, refresh_every=SEARCH_CACHE_SOFT_TTL
+            )
+            self.popular_refresher.start()
+        
+        # Apply what other workers logged since the snapshot, then follow the shared log
+        self._start_index_sync()
+        
         # Mark as initialized
         CLIPImageSearch._initialized = True
         
+    def _load_encoders(self):
+        """Text / image encoders on the configured inference backend (eager, TorchScript or ONNX Runtime)"""
+        text_samples = image_samples = None
+        if INFERENCE_BACKEND != 'eager':
+            text_samples = clip.tokenize(SAMPLE_QUERIES)
+            image_samples = sample_images(self.preprocess)
+        
+        options = dict(
+            backend=INFERENCE_BACKEND, quantization=INFERENCE_QUANTIZATION, device=self.device,
+            artifact_dir=INFERENCE_DIR, num_threads=self.executor.threads_per_worker
+        )
+        self.text_encoder = build_encoder(
+            'clip-vit-b32-text', self.model, lambda model, tokens: model.encode_text(tokens), text_samples, **options
+        )
+        self.image_encoder = build_encoder(
+            'clip-vit-b32-image', self.model, lambda model, images: model.encode_image(images), image_samples,
+            channels_last=INFERENCE_CHANNELS_LAST, **options
+        )
+        
     def load_data(self):
-        """Load FAISS index, embeddings and image metadata"""
+        """Load FAISS index, embeddings and image metadata, and publish them as the first snapshot"""
+        for attempt in range(SNAPSHOT_LOAD_ATTEMPTS):
+            # A worker committing a snapshot writes the manifest before renaming its files: they are read under
+            # the snapshot lock or, when another worker holds it, checked against the manifest and read again
+            # if a snapshot was committed in the meantime
+            locked = self._acquire_snapshot_lock(wait=SNAPSHOT_LOCK_WAIT)
+            try:
+                repaired = self._load_snapshot(locked)
+                break
+            except SnapshotError as e:
+                if locked or attempt == SNAPSHOT_LOAD_ATTEMPTS - 1:
+                    raise
+                print(f"CLIP index snapshot changed while loading ({e}), reading it again")
+            finally:
+                self._release_snapshot_lock(locked)
+        if repaired:
+            # Save the repaired data
+            self._save_data(force=True)
+    
+    def _load_snapshot(self, locked):
+        """Read the snapshot on disk + the WAL after it and publish them; returns True if the files were repaired"""
         try:
+            # Finish (or discard) a snapshot interrupted by a crash, then read the WAL written since it.
+            # Pending files are only touched under the snapshot lock: another worker may be writing them
+            manifest = recover_snapshot(INDEX_DIR, verify=SNAPSHOT_VERIFY or not locked, repair=bool(locked))
+            self._snapshot_seq = manifest['seq'] if manifest else 0
+            self._rebuild = manifest.get('rebuild', 0) if manifest else 0
+            self._applied_seq = self._snapshot_seq
+            self.wal = IndexWAL(os.path.join(INDEX_DIR, WAL_NAME), fsync=WAL_FSYNC)
+            pending_records = self.wal.replay(after_seq=self._snapshot_seq)
+            
             # Load FAISS index
             index_path = os.path.join(INDEX_DIR, 'clip_faiss.index')
-            self.faiss_index = faiss.read_index(index_path)
-            print(f"Loaded FAISS index with {self.faiss_index.ntotal} vectors")
+            faiss_index = read_index(index_path, mmap=INDEX_MMAP)
+            source_path = index_path if INDEX_MMAP else None
+            set_search_defaults(faiss_index, IVF_NPROBE, HNSW_EF_SEARCH)
+            index_info = load_index_info(os.path.join(INDEX_DIR, 'index_info.json'))
+            print(f"Loaded FAISS index with {faiss_index.ntotal} vectors ({index_info.get('factory', 'Flat')})")
             
-            # Load image URLs and IDs for reference
+            # Load image URLs and IDs for reference (both aligned with FAISS positions)
             with open(os.path.join(INDEX_DIR, 'image_urls.json'), 'r') as f:
-                self.image_urls = json.load(f)
+                image_urls = json.load(f)
                 
             with open(os.path.join(INDEX_DIR, 'image_ids.json'), 'r') as f:
-                self.image_ids = json.load(f)
+                image_ids = json.load(f)
             
             # Load full metadata for detailed results
             with open(os.path.join(INDEX_DIR, 'image_metadata.json'), 'r') as f:
-                self.image_metadata = json.load(f)
+                image_metadata = json.load(f)
             
-            # Create a lookup dictionary for faster access
-            self.metadata_by_id = {item['id']: item for item in self.image_metadata}
+            # Positions whose vectors were deleted but not yet compacted away
+            tombstone_path = os.path.join(INDEX_DIR, 'tombstones.json')
+            if os.path.exists(tombstone_path):
+                with open(tombstone_path, 'r') as f:
+                    tombstones = set(json.load(f))
+            else:
+                tombstones = set()
             
-            print(f"Loaded metadata for {len(self.image_urls)} images")
+            print(f"Loaded metadata for {len(image_urls)} images")
             
-            # As a backup, also load the numpy embeddings
+            # Full-precision embeddings; kept on disk (memory-mapped) when the index itself is quantized
+            repaired = False
             embedding_path = os.path.join(INDEX_DIR, 'clip_image_embeddings.npy')
             if os.path.exists(embedding_path):
-                self.image_embeddings = np.load(embedding_path)
+                embeddings = VectorStore.load(embedding_path, mmap=INDEX_MMAP or _is_compressed(index_info))
                 
                 # Check for mismatches between metadata and embeddings
-                if len(self.image_ids) != self.image_embeddings.shape[0]:
-                    print(f"Warning: Mismatch between metadata ({len(self.image_ids)} images) and embeddings ({self.image_embeddings.shape[0]} vectors)")
+                if len(image_ids) != embeddings.shape[0]:
+                    print(f"Warning: Mismatch between metadata ({len(image_ids)} images) and embeddings ({embeddings.shape[0]} vectors)")
                     print("Attempting to repair the index automatically...")
-                    self._synchronize_metadata_and_embeddings()
+                    image_ids, image_urls, image_metadata, embeddings = self._synchronize_metadata_and_embeddings(
+                        image_ids, image_urls, image_metadata, embeddings
+                    )
+                    repaired = True
+                elif faiss_index.ntotal != len(image_ids):
+                    # Old removals left orphan vectors in the index: positions no longer match ids
+                    print(f"Warning: FAISS index has {faiss_index.ntotal} vectors for {len(image_ids)} ids, rebuilding from embeddings")
+                    repaired = True
+                if repaired:
+                    faiss_index, index_info = self._build_index(embeddings.to_array())
+                    source_path = None
             else:
                 print("Warning: Numpy embeddings file not found")
+                embeddings = VectorStore(faiss_index.reconstruct_n(0, faiss_index.ntotal))
+            
+            if not locked and load_manifest(INDEX_DIR) != manifest:
+                raise SnapshotError("another worker committed a snapshot while it was being read")
+            
+            self.snapshot = IndexSnapshot(
+                faiss_index, embeddings, image_ids, image_urls, {item['id']: item for item in image_metadata},
+                tombstones, index_info, version=self._snapshot_seq, source_path=source_path
+            )
+            
+            # BM25 index over titles / descriptions of the live images (kept in sync by _apply_adds / _apply_delete)
+            snapshot = self.snapshot
+            self.lexical_index = LexicalIndex.from_metadata(
+                snapshot.metadata(image_id) for image_id in snapshot.live_ids().tolist()
+                if snapshot.metadata(image_id) is not None
+            )
+            print(f"Built lexical index over {len(self.lexical_index)} images")
+            
+            # Re-apply mutations logged after the snapshot
+            with self._write_lock:
+                if self.index_log is not None:
+                    # Versions are global: stop at a missing one (its writer crashed before logging it to disk),
+                    # the shared log fills the gap in order
+                    for count, record in enumerate(pending_records):
+                        if record.seq != self._snapshot_seq + count + 1:
+                            pending_records = pending_records[:count]
+                            break
+                self._apply_records(pending_records)
+                if pending_records:
+                    print(f"Replayed {len(pending_records)} WAL records on top of snapshot {self._snapshot_seq}")
+            return repaired
                 
         except Exception as e:
             print(f"Error loading data: {e}")
             raise
+
+    def _publish(self, snapshot):
+        """Atomically make `snapshot` the one new searches read (callers hold _write_lock)"""
+        self.snapshot = snapshot
+
+    def _has_private(self, viewer_id):
+        """Người xem có ảnh private trong index => kết quả khác với danh sách public dùng chung"""
+        return self.snapshot.has_private(viewer_id)
             
-    def _synchronize_metadata_and_embeddings(self):
-        """Ensure metadata and embeddings are in sync"""
-        try:
-            embedding_path = os.path.join(INDEX_DIR, 'clip_image_embeddings.npy')
-            if not os.path.exists(embedding_path):
-                print("Cannot synchronize: embeddings file not found")
-                return False
-                
-            # Load embeddings
-            embeddings = np.load(embedding_path)
-            
-            # Determine which needs trimming
-            if len(self.image_ids) > embeddings.shape[0]:
-                # More metadata than embeddings, trim metadata
-                print(f"Trimming metadata from {len(self.image_ids)} to {embeddings.shape[0]} entries")
-                self.image_ids = self.image_ids[:embeddings.shape[0]]
-                self.image_urls = self.image_urls[:embeddings.shape[0]]
-                
-                # Rebuild metadata
-                updated_metadata = []
-                for img_id in self.image_ids:
-                    if str(img_id) in [str(item['id']) for item in self.image_metadata]:
-                        item = next((item for item in self.image_metadata if str(item['id']) == str(img_id)), None)
-                        if item:
-                            updated_metadata.append(item)
-                
-                self.image_metadata = updated_metadata
-                self.metadata_by_id = {item['id']: item for item in self.image_metadata}
-                
-            elif len(self.image_ids) < embeddings.shape[0]:
-                # More embeddings than metadata, trim embeddings
-                print(f"Trimming embeddings from {embeddings.shape[0]} to {len(self.image_ids)} entries")
-                embeddings = embeddings[:len(self.image_ids)]
-                np.save(embedding_path, embeddings)
-                self.image_embeddings = embeddings
-            
-            # Rebuild FAISS index
-            dimension = embeddings.shape[1]
-            self.faiss_index = faiss.IndexFlatL2(dimension)
-            self.faiss_index.add(embeddings)
-            
-            # Save all synchronized data
-            self._save_data()
-            
-            print(f"Successfully synchronized data. Now have {len(self.image_ids)} images with corresponding embeddings.")
-            return True
+    def _synchronize_metadata_and_embeddings(self, image_ids, image_urls, image_metadata, embeddings):
+        """
+        Trim metadata or embeddings so they have the same number of entries.
+        
+        Returns:
+            tuple: (image_ids, image_urls, image_metadata, embeddings) after the repair
+        """
+        if len(image_ids) > embeddings.shape[0]:
+            # More metadata than embeddings, trim metadata
+            print(f"Trimming metadata from {len(image_ids)} to {embeddings.shape[0]} entries")
+            image_ids = image_ids[:embeddings.shape[0]]
+            image_urls = image_urls[:embeddings.shape[0]]
             
-        except Exception as e:
-            print(f"Error synchronizing data: {e}")
-            return False
+            # Rebuild metadata
+            kept = {str(image_id) for image_id in image_ids}
+            image_metadata = [item for item in image_metadata if str(item['id']) in kept]
+            
+        elif len(image_ids) < embeddings.shape[0]:
+            # More embeddings than metadata, trim embeddings
+            print(f"Trimming embeddings from {embeddings.shape[0]} to {len(image_ids)} entries")
+            embeddings = VectorStore(embeddings[:len(image_ids)])
+        
+        print(f"Successfully synchronized data. Now have {len(image_ids)} images with corresponding embeddings.")
+        return image_ids, image_urls, image_metadata, embeddings
+    
+    def encode_texts(self, texts):
+        """Encode a list of texts into normalized CLIP vectors (one forward pass)"""
+        return _normalize(self.text_encoder(clip.tokenize(texts)))
+
+    @property
+    def input_resolution(self):
+        """Kích thước ảnh đầu vào của visual encoder (224 với ViT-B/32)"""
+        return getattr(getattr(self.model, 'visual', None), 'input_resolution', 224)
+
+    def _decode_query_image(self, source):
+        """Decode ảnh truy vấn; JPEG được decode thẳng ở tỉ lệ nhỏ nhất vẫn >= input của model (draft)"""
+        img = PILImage.open(source)
+        if img.format == 'JPEG':
+            img.draft('RGB', (self.input_resolution, self.input_resolution))
+        return img.convert('RGB')
+
+    def _encode_image(self, img):
+        """Encode one PIL image into a normalized (1, d) CLIP vector"""
+        return _normalize(self.image_encoder(self.preprocess(img).unsqueeze(0)))
+
+    def _build_index(self, vectors):
+        """
+        Build (and train) an index of the configured type, recording its recall vs flat.
+        
+        Returns:
+            tuple: (index, index_info)
+        """
+        index, description = build_index(vectors, INDEX_TYPE, nlist=IVF_NLIST, storage=INDEX_STORAGE,
+                                         pca_dim=INDEX_PCA_DIM)
+        set_search_defaults(index, IVF_NPROBE, HNSW_EF_SEARCH)
+        index_info = describe_index(
+            index, description, INDEX_TYPE, vectors, IVF_NPROBE, HNSW_EF_SEARCH,
+            storage=INDEX_STORAGE, rerank_factor=RERANK_FACTOR, min_candidates=RERANK_MIN_CANDIDATES,
+            recall_sample=RECALL_SAMPLE_SIZE
+        )
+        print(f"Built {description} index, recall@10 vs flat: {index_info['recall_at_10_vs_flat']}")
+        return index, index_info
+
+    def _search_vectors(self, query_vectors, top_k, nprobe=None, ef_search=None, viewer_id=None, snapshot=None):
+        """
+        FAISS search restricted to the positions the viewer may see (live, and public or
+        owned by the viewer): every row gets exactly min(top_k, eligible) hits.
+        Positions refer to `snapshot` (default: the current one), which the caller must also
+        use to turn them into image ids.
+        """
+        snapshot = snapshot or self.snapshot
+        mask, bitmap, eligible = snapshot.visibility(viewer_id)
+        depth = min(top_k, eligible)
+        if depth <= 0:
+            return (np.empty((len(query_vectors), 0), dtype='float32'),
+                    np.empty((len(query_vectors), 0), dtype='int64'))
+        
+        # Vectors added since the base index was built are scanned exactly and merged in
+        base_size = snapshot.base_size
+        delta_positions = np.flatnonzero(mask[base_size:])
+        base_eligible = eligible - len(delta_positions)
+        
+        base_depth = min(top_k, base_eligible)
+        if base_depth > 0:
+            distances, indices = self._search_base(snapshot, query_vectors, base_depth, mask[:base_size], bitmap,
+                                                   base_eligible, nprobe, ef_search)
+        else:
+            distances = np.empty((len(query_vectors), 0), dtype='float32')
+            indices = np.empty((len(query_vectors), 0), dtype='int64')
+        
+        if len(delta_positions):
+            delta_distances, delta_indices = rerank_exact(
+                query_vectors, np.tile(delta_positions, (len(query_vectors), 1)), snapshot.delta_vectors,
+                min(depth, len(delta_positions))
+            )
+            delta_indices = np.where(delta_indices >= 0, delta_indices + base_size, -1)
+            distances, indices = merge_hits(distances, indices, delta_distances, delta_indices, depth)
+        return distances, indices
+    
+    def _search_base(self, snapshot, query_vectors, depth, mask, bitmap, eligible, nprobe=None, ef_search=None):
+        """Search the snapshot's base FAISS index over the eligible positions of `mask`"""
+        # Quantized / PCA-reduced codes only shortlist candidates; exact distances come from the raw vectors
+        rerank = _is_compressed(snapshot.index_info) and RERANK_FACTOR and RERANK_FACTOR > 1
+        search_depth = min(max(depth * RERANK_FACTOR, RERANK_MIN_CANDIDATES), eligible) if rerank else depth
+        
+        index = snapshot.index
+        if supports_selector(index):
+            # The bitmap is checked while FAISS scans, so filtered rows never take a result slot
+            selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+            # Per-request tunables (nprobe for IVF, efSearch for HNSW) override the deployment defaults
+            params = make_search_params(index, nprobe, ef_search, selector=selector)
+            distances, indices = index.search(query_vectors, search_depth, params=params)
+        else:
+            distances, indices = self._search_overfetch(index, query_vectors, search_depth, mask, eligible,
+                                                        nprobe, ef_search)
+        
+        if rerank:
+            distances, indices = rerank_exact(query_vectors, indices, snapshot.embeddings, depth)
+        
+        # IVF / HNSW only visit part of the index: with a very selective filter a row can come back short
+        short_rows = np.flatnonzero((indices[:, :depth] >= 0).sum(axis=1) < depth)
+        if len(short_rows):
+            distances, indices = distances[:, :depth].copy(), indices[:, :depth].copy()
+            distances[short_rows], indices[short_rows] = self._fill_short_rows(
+                snapshot, query_vectors[short_rows], depth, mask, bitmap, eligible, search_depth, rerank, ef_search
+            )
+        return distances, indices
     
-    def search(self, query_text, top_k=12, use_cache=True):
-        """Search images using a text query with FAISS with Redis caching"""
-        # Kiểm tra cache nếu use_cache=True
-        if use_cache:
-            cache_key = f'clip_text_search:{query_text}:{top_k}'
-            cached_results = cache.get(cache_key)
-            if cached_results:
-                print(f"Returning cached results for query: '{query_text}'")
-                return cached_results
-        
-        # Encode the query text
-        with torch.no_grad():
-            text = clip.tokenize([query_text]).to(self.device)
-            text_features = self.model.encode_text(text)
-            text_features /= text_features.norm(dim=-1, keepdim=True)
-        
-        # Convert to numpy and correct shape
-        query_vector = text_features.cpu().numpy().astype('float32').reshape(1, -1)
-        
-        # Search using FAISS
-        distances, indices = self.faiss_index.search(query_vector, top_k)
-        
-        # Prepare results
+    def _fill_short_rows(self, snapshot, query_vectors, depth, mask, bitmap, eligible, search_depth, rerank,
+                         ef_search=None):
+        """
+        Answer rows the filtered ANN search returned short. A small eligible set is scanned exactly
+        (its vectors gathered once for all rows); a large one is searched again with every IVF list
+        probed / a wider HNSW beam instead of a full exact scan per row.
+        """
+        if eligible <= SHORT_ROW_EXACT_LIMIT:
+            positions = np.flatnonzero(mask)
+            vectors = np.ascontiguousarray(snapshot.embeddings[positions], dtype='float32')
+            distances, hits = faiss.knn(np.ascontiguousarray(query_vectors, dtype='float32'), vectors, depth)
+            return distances, np.where(hits >= 0, positions[np.maximum(hits, 0)], -1)
+        
+        index = snapshot.index
+        selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+        wide_ef = max(ef_search or HNSW_EF_SEARCH, search_depth) * 4
+        params = make_search_params(index, snapshot.index_info.get('nlist'), wide_ef, selector=selector)
+        distances, indices = index.search(query_vectors, search_depth, params=params)
+        if rerank:
+            return rerank_exact(query_vectors, indices, snapshot.embeddings, depth)
+        return distances[:, :depth], indices[:, :depth]
+    
+    def _search_overfetch(self, index, query_vectors, depth, mask, eligible, nprobe=None, ef_search=None):
+        """
+        Fallback for indexes that cannot take an IDSelector (flat PQ): fetch depth scaled by
+        the share of eligible positions, filter, and double the depth until every row is full.
+        """
+        total = index.ntotal
+        fetch = min(total, int(np.ceil(depth * total / eligible * 1.25)))
+        params = make_search_params(index, nprobe, ef_search)
+        while True:
+            distances, indices = index.search(query_vectors, fetch, params=params)
+            in_range = (indices >= 0) & (indices < len(mask))
+            valid = in_range & mask[np.where(in_range, indices, 0)]
+            if fetch >= total or (valid.sum(axis=1) >= depth).all():
+                break
+            fetch = min(fetch * 2, total)
+        
+        filtered_distances = np.full((len(query_vectors), depth), np.inf, dtype='float32')
+        filtered_indices = np.full((len(query_vectors), depth), -1, dtype='int64')
+        for row in range(len(query_vectors)):
+            keep = np.flatnonzero(valid[row])[:depth]
+            filtered_distances[row, :len(keep)] = distances[row, keep]
+            filtered_indices[row, :len(keep)] = indices[row, keep]
+        return filtered_distances, filtered_indices
+
+    def _search_text_batch(self, texts, top_k):
+        """
+        Encode several texts together and run one multi-row FAISS search.
+        Hits are returned as image ids (-1 = none), resolved against the snapshot that was searched.
+        """
+        query_vectors = self.encode_texts(texts)
+        snapshot = self.snapshot
+        distances, indices = self._search_vectors(query_vectors, top_k, snapshot=snapshot)
+        return distances, snapshot.image_ids_at(indices), query_vectors
+
+    def _ranking_from_ids(self, distances, image_ids, top_k=None):
+        """Convert one row of hits (image ids, -1 = none) into ranked (image_ids, similarity scores) arrays"""
+        keep = np.flatnonzero(np.asarray(image_ids) >= 0)
+        if top_k is not None:
+            keep = keep[:top_k]
+        # Convert distance to similarity score (lower distance = higher similarity)
+        # For normalized vectors, we can convert L2 distance to cosine similarity
+        scores = 1.0 / (1.0 + np.asarray(distances, dtype='float64')[keep])  # Transform to a 0-1 scale
+        return np.asarray(image_ids, dtype='int64')[keep], scores.astype('float32')
+
+    def _ranking_from_search(self, distances, indices, top_k=None, snapshot=None):
+        """Convert one row of FAISS output (positions in `snapshot`) into ranked (image_ids, scores) arrays"""
+        # Tombstoned positions (deleted vectors still present until compaction) map to -1 and are skipped
+        return self._ranking_from_ids(distances, (snapshot or self.snapshot).image_ids_at(indices), top_k)
+
+    def _results_from_ranking(self, image_ids, scores, snapshot=None):
+        """Build result dicts (metadata + similarity score) from a ranking"""
+        snapshot = snapshot or self.snapshot
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < 0 or idx >= len(self.image_ids):
-                # This can happen if FAISS doesn't find enough matches
-                continue
-                
-            image_id = self.image_ids[idx]
-            # Convert distance to similarity score (lower distance = higher similarity)
-            # For normalized vectors, we can convert L2 distance to cosine similarity
-            distance = float(distances[0][i])
-            similarity_score = 1.0 / (1.0 + distance)  # Transform to a 0-1 scale
-            
-            # Get full metadata if available
-            metadata = self.metadata_by_id.get(image_id, {})
+        for image_id, score in zip(image_ids.tolist(), scores.tolist()):
+            # Get full metadata if available (copy so the shared dict is not mutated)
+            metadata = dict(snapshot.metadata(image_id) or {})
             if not metadata:
                 # Fallback if metadata is not available
-                metadata = {
-                    'id': image_id,
-                    'file': self.image_urls[idx]
-                }
+                metadata = {'id': image_id}
             
             # Add similarity score
-            metadata['similarity_score'] = similarity_score
-            
+            metadata['similarity_score'] = score
             results.append(metadata)
         
         # Sort by similarity score (highest first)
         results.sort(key=lambda x: x['similarity_score'], reverse=True)
+        return results
+
+    def _format_results(self, distances, indices, top_k=None, snapshot=None):
+        """Build result dicts from one row of FAISS distances/indices (positions in `snapshot`)"""
+        snapshot = snapshot or self.snapshot
+        return self._results_from_ranking(*self._ranking_from_search(distances, indices, top_k, snapshot), snapshot)
+
+    def _rank_text_query(self, normalized, digest, depth, nprobe=None, ef_search=None, viewer_id=None):
+        """Rank the index for a text query down to `depth`, reusing a cached embedding if present"""
+        vector = self.embedding_cache.get(digest)
+        if vector is None and self.text_batcher is not None and not (
+                nprobe or ef_search or self._has_private(viewer_id)):
+            # Encode + search in the batcher, waiting in this thread: concurrent queries are coalesced
+            distances, image_ids, vectors = self.text_batcher.search(normalized, depth)
+            self.embedding_cache.set(digest, vectors[0])
+        else:
+            # Custom search parameters / a per-viewer filter bypass the shared (public) batch
+            distances, image_ids = self._rank_text_inline(normalized, digest, vector, depth, nprobe, ef_search,
+                                                          viewer_id)
         
-        # Cache kết quả nếu use_cache=True
-        if use_cache:
-            # Serialize để cache (nếu cần thiết)
-            cache_key = f'clip_text_search:{query_text}:{top_k}'
-            cache.set(cache_key, results, DEFAULT_CACHE_TTL)
+        return self._ranking_from_ids(distances[0], image_ids[0], depth)
+
+    @bounded
+    def _rank_text_inline(self, normalized, digest, vector, depth, nprobe=None, ef_search=None, viewer_id=None):
+        """Encode (unless `vector` is cached) and search one text query on an executor worker"""
+        if vector is None:
+            vector = self.encode_texts([normalized])[0]
+            self.embedding_cache.set(digest, vector)
+        snapshot = self.snapshot
+        distances, indices = self._search_vectors(vector.reshape(1, -1), depth, nprobe, ef_search, viewer_id, snapshot)
+        return distances, snapshot.image_ids_at(indices)
+
+    def _rank_text(self, query_text, depth, use_cache=True, nprobe=None, ef_search=None, viewer_id=None):
+        """CLIP ranking of a text query down to `depth`: (image_ids, scores), served from the rank cache when deep enough"""
+        normalized = normalize_query(query_text)
+        digest = query_hash(normalized)
         
-        return results
+        # Cached rankings are computed with the deployment defaults over public images only
+        if nprobe or ef_search or self._has_private(viewer_id):
+            use_cache = False
+        
+        if not use_cache:
+            image_ids, scores = self._rank_text_query(normalized, digest, depth, nprobe, ef_search, viewer_id)
+            return image_ids[:depth], scores[:depth]
+        
+        # Rank deeper than requested so later top_k values are served from the same entry
+        rank_depth = max(depth, RANK_CACHE_DEPTH)
+        
+        def rank():
+            image_ids, scores = self._rank_text_query(normalized, digest, rank_depth)
+            return image_ids, scores, len(image_ids) < rank_depth
+        
+        # Danh sách xếp hạng đủ sâu thì chỉ cần cắt; truy vấn đồng thời chỉ xếp hạng một lần
+        return self.rank_cache.get_or_rank(digest, depth, self._cache_generation(), rank)
 
-    def search_by_image(self, image_path_or_url, top_k=12, use_cache=True):
-        """Search similar images using an image URL or local file path with Redis caching"""
-        try:
-            # Kiểm tra cache nếu sử dụng URL và use_cache=True
-            if use_cache and image_path_or_url.startswith('http'):
-                cache_key = f'clip_image_search:{image_path_or_url}:{top_k}'
-                cached_results = cache.get(cache_key)
-                if cached_results:
-                    print(f"Returning cached results for image search: '{image_path_or_url}'")
-                    return cached_results
-            
-            # Phân biệt URL và local path
-            if os.path.exists(image_path_or_url):
-                # Nếu là file local
-                img = PILImage.open(image_path_or_url).convert('RGB')
-            elif image_path_or_url.startswith('http'):
-                # Nếu là URL
-                response = requests.get(image_path_or_url, stream=True)
-                img = PILImage.open(BytesIO(response.content)).convert('RGB')
-            else:
-                raise ValueError(f"Không thể xử lý: {image_path_or_url}")
+    def _refresh_ranking(self, fn):
+        """Run a stale rank cache refresh in the background; falsy when the batcher / executor is busy"""
+        if self.text_batcher is None:
+            return self.executor.submit_background(fn)
+        if not self.text_batcher.has_room():
+            return False
+        threading.Thread(target=fn, name='clip-rank-refresh', daemon=True).start()
+        return True
 
-            # Generate embedding
-            image_input = self.preprocess(img).unsqueeze(0).to(self.device)
+    def _warm_query(self, query_text):
+        """Rank a popular query into the rank cache; False when the batcher / executor is busy"""
+        depth = max(RANK_CACHE_DEPTH, PAGE_DEPTH)
+        if self.text_batcher is None:
+            future = self.executor.submit_background(self._rank_text, query_text, depth)
+            if future is None:
+                return False
+            future.result()
+            return True
+        if not self.text_batcher.has_room():
+            return False
+        self._rank_text(query_text, depth)
+        return True
 
-            with torch.no_grad():
-                image_features = self.model.encode_image(image_input)
-                image_features /= image_features.norm(dim=-1, keepdim=True)
+    def _track_query(self, query_text):
+        if POPULAR_QUERIES_ENABLED:
+            self.popular_queries.record(query_text)
 
-            # Convert to numpy and reshape
-            query_vector = image_features.cpu().numpy().astype('float32').reshape(1, -1)
+    def _rank_hybrid(self, query_text, depth, use_cache=True, nprobe=None, ef_search=None, viewer_id=None):
+        """CLIP + BM25 ranking fused down to `depth` candidates from each side"""
+        vector_ids, vector_scores = self._rank_text(query_text, depth, use_cache, nprobe, ef_search, viewer_id)
+        lexical_ids, lexical_scores = self.lexical_index.search(query_text, depth, viewer_id)
+        return fuse_scores(vector_ids, vector_scores, lexical_ids, lexical_scores, HYBRID_CLIP_WEIGHT)
 
-            # Search using FAISS
-            distances, indices = self.faiss_index.search(query_vector, top_k)
+    def search(self, query_text, top_k=12, use_cache=True, nprobe=None, ef_search=None, viewer_id=None):
+        """
+        Search images using a text query with FAISS with Redis caching.
+        viewer_id: UserProfile id of the viewer, whose private images are eligible too.
+        """
+        top_k = clamp_top_k(top_k)
+        self._track_query(query_text)
+        return self._results_from_ranking(*self._rank_text(query_text, top_k, use_cache, nprobe, ef_search, viewer_id))
 
-            # Prepare results
-            results = []
-            for i, idx in enumerate(indices[0]):
-                if idx < 0 or idx >= len(self.image_ids):
-                    continue
+    def search_hybrid(self, query_text, top_k=12, use_cache=True, nprobe=None, ef_search=None, viewer_id=None):
+        """
+        Text search fusing CLIP similarity with BM25 over titles / descriptions, so exact
+        title lookups (e.g. a series name) rank first while descriptive queries still work.
+        """
+        top_k = clamp_top_k(top_k)
+        depth = max(top_k, min(HYBRID_CANDIDATES, MAX_TOP_K))
+        self._track_query(query_text)
+        image_ids, scores = self._rank_hybrid(query_text, depth, use_cache, nprobe, ef_search, viewer_id)
+        return self._results_from_ranking(image_ids[:top_k], scores[:top_k])
 
-                image_id = self.image_ids[idx]
-                distance = float(distances[0][i])
-                similarity_score = 1.0 / (1.0 + distance)
+    @property
+    def index_version(self):
+        """WAL seq of the last applied mutation: changes whenever an image is added or removed"""
+        return self.snapshot.version
 
-                metadata = self.metadata_by_id.get(image_id, {})
-                if not metadata:
-                    metadata = {
-                        'id': image_id,
-                        'file': self.image_urls[idx]
-                    }
+    def search_page(self, query_text=None, page_size=20, cursor=None, mode='vector', use_cache=True, nprobe=None,
+                    ef_search=None, viewer_id=None):
+        """
+        Cursor-paginated text search. The first request ranks PAGE_DEPTH results once and stores the
+        list server-side (keyed by query + index version); a cursor only slices that list.
+        
+        Returns:
+            dict: results, next_cursor (None on the last page), index_version of the list,
+            stale (index changed since it was ranked), expired (unknown / expired cursor)
+        """
+        page_size = clamp_top_k(page_size)
+        if cursor:
+            position = decode_cursor(cursor)
+            entry = self.page_store.get(position[0]) if position else None
+            # A list holding private images is only readable by their owner
+            if entry is None or entry[3] not in (None, viewer_id):
+                return {'results': [], 'next_cursor': None, 'index_version': self.index_version,
+                        'stale': True, 'expired': True}
+            token, offset = position
+        else:
+            self._track_query(query_text)
+            version = self.index_version
+            scope = viewer_id if self._has_private(viewer_id) else None
+            mode = 'hybrid' if mode == 'hybrid' else 'vector'
+            token = self.page_store.make_token(normalize_query(query_text), mode, nprobe, ef_search, scope, version)
+            entry = self.page_store.get(token) if use_cache else None
+            if entry is None:
+                rank = self._rank_hybrid if mode == 'hybrid' else self._rank_text
+                image_ids, scores = rank(query_text, PAGE_DEPTH, use_cache, nprobe, ef_search, viewer_id)
+                entry = (image_ids, scores, version, scope)
+                self.page_store.set(token, *entry)
+            offset = 0
+        
+        image_ids, scores, version, _ = entry
+        end = offset + page_size
+        return {
+            'results': self._results_from_ranking(image_ids[offset:end], scores[offset:end]),
+            'next_cursor': encode_cursor(token, end) if end < len(image_ids) else None,
+            'index_version': version,
+            'stale': version != self.index_version,
+            'expired': False,
+        }
 
-                metadata['similarity_score'] = similarity_score
-                results.append(metadata)
+    def get_metrics(self):
+        """Runtime metrics of the search engine (text batching, inference executor, search result caches, popular queries, index sync)"""
+        return {
+            'text_batcher': self.text_batcher.get_metrics() if self.text_batcher is not None else None,
+            'executor': self.executor.get_metrics(),
+            'search_cache': {
+                'rankings': self.rank_cache.entries.get_metrics(),
+                'image_results': self.result_cache.get_metrics(),
+            },
+            'popular_queries': self.popular_refresher.get_metrics() if self.popular_refresher is not None else None,
+            'index_sync': self._index_sync_metrics(),
+        }
+    
+    def _index_sync_metrics(self):
+        """Version this worker has applied vs the latest version in the shared log"""
+        if self.index_log is None:
+            return None
+        metrics = dict(self._sync_stats, version=self._applied_seq, latest=None, lag=None)
+        try:
+            metrics['latest'] = self.index_log.latest()
+            metrics['lag'] = max(metrics['latest'] - self._applied_seq, 0)
+        except Exception as e:
+            print(f"⚠️ Không đọc được version của log thay đổi CLIP index: {e}")
+        return metrics
 
-            # Sort by similarity score (highest first)
-            results.sort(key=lambda x: x['similarity_score'], reverse=True)
+    @bounded
+    def search_by_image(self, image_path_or_url, top_k=12, use_cache=True, nprobe=None, ef_search=None,
+                        viewer_id=None):
+        """Search similar images using an image URL or local file path with Redis caching"""
+        try:
+            top_k = clamp_top_k(top_k)
+            if nprobe or ef_search or self._has_private(viewer_id):
+                use_cache = False
             
-            # Cache kết quả nếu sử dụng URL và use_cache=True
-            if use_cache and image_path_or_url.startswith('http'):
-                cache_key = f'clip_image_search:{image_path_or_url}:{top_k}'
-                cache.set(cache_key, results, DEFAULT_CACHE_TTL)
+            def compute():
+                # Phân biệt URL và local path
+                if os.path.exists(image_path_or_url):
+                    # Nếu là file local
+                    img = self._decode_query_image(image_path_or_url)
+                elif image_path_or_url.startswith('http'):
+                    # Nếu là URL
+                    response = requests.get(image_path_or_url, stream=True)
+                    img = self._decode_query_image(BytesIO(response.content))
+                else:
+                    raise ValueError(f"Không thể xử lý: {image_path_or_url}")
 
-            return results
+                # Generate embedding
+                query_vector = self._encode_image(img)
+
+                # Search using FAISS
+                snapshot = self.snapshot
+                distances, indices = self._search_vectors(query_vector, top_k, nprobe, ef_search, viewer_id, snapshot)
+
+                # Prepare results
+                return self._format_results(distances[0], indices[0], top_k, snapshot)
+            
+            # Chỉ cache khi sử dụng URL và use_cache=True; URL giống nhau đồng thời chỉ tải + encode một lần
+            if use_cache and image_path_or_url.startswith('http'):
+                cache_key = self.search_generation.key(
+                    self._cache_generation(), 'clip_image_search', image_path_or_url, top_k
+                )
+                return self.result_cache.get_or_compute(cache_key, compute)
+            return compute()
 
         except Exception as e:
             print(f"Error in image search: {e}")
             return []
 
-    def search_by_image_id(self, image_id, top_k=12, use_cache=True):
-        """Search similar images using an image ID with Redis caching"""
+    @bounded
+    def search_by_image_bytes(self, data, top_k=12, nprobe=None, ef_search=None, viewer_id=None):
+        """
+        Search with an uploaded image decoded straight from memory (no temp file).
+        The embedding is cached by content hash, so re-uploads of the same photo
+        skip decoding and encoding.
+        """
         try:
-            # Kiểm tra cache nếu use_cache=True
-            if use_cache:
-                cache_key = f'clip_image_id_search:{image_id}:{top_k}'
-                cached_results = cache.get(cache_key)
-                if cached_results:
-                    print(f"Returning cached results for image ID search: '{image_id}'")
-                    return cached_results
+            top_k = clamp_top_k(top_k)
+            digest = hashlib.sha256(data).hexdigest()
+            query_vector = self.upload_cache.get(digest)
+            if query_vector is None:
+                query_vector = self._encode_image(self._decode_query_image(BytesIO(data)))[0]
+                self.upload_cache.set(digest, query_vector)
+            else:
+                print(f"Reusing cached embedding for uploaded image {digest[:12]}")
             
-            # Truy vấn Django database để lấy ảnh
-            from media.models import Image
-            image = Image.objects.get(id=image_id)
-            image_url = image.file.url
+            snapshot = self.snapshot
+            distances, indices = self._search_vectors(query_vector.reshape(1, -1), top_k, nprobe, ef_search, viewer_id,
+                                                      snapshot)
+            return self._format_results(distances[0], indices[0], top_k, snapshot)
+        
+        except Exception as e:
+            print(f"Error in uploaded image search: {e}")
+            return []
+
+    @bounded
+    def search_by_image_id(self, image_id, top_k=12, use_cache=True, viewer_id=None):
+        """
+        Search images similar to an indexed image using its stored vector: no download and no
+        model inference. Only images that are not in the index are fetched and encoded.
+        The image itself is left out of the results.
+        """
+        try:
+            top_k = clamp_top_k(top_k)
+            if self._has_private(viewer_id):
+                use_cache = False
             
-            # Tiến hành tìm kiếm thông qua URL
-            results = self.search_by_image(image_url, top_k, use_cache=False)
+            def compute():
+                snapshot = self.snapshot
+                position = snapshot.position_of(image_id)
+                if position is not None:
+                    # Vector của ảnh đã nằm trong embedding store
+                    query_vector = np.asarray(snapshot.embeddings[[position]], dtype='float32')
+                    distances, indices = self._search_vectors(query_vector, top_k + 1, viewer_id=viewer_id,
+                                                              snapshot=snapshot)
+                    results = self._format_results(distances[0], indices[0], snapshot=snapshot)
+                else:
+                    # Ảnh chưa được index (ví dụ đang chờ trong hàng đợi): tải ảnh và encode
+                    from media.models import Image
+                    image = Image.objects.get(id=image_id)
+                    results = self.search_by_image(image.file.url, top_k + 1, use_cache=False, viewer_id=viewer_id)
+                return [result for result in results if result.get('id') != image_id][:top_k]
             
             # Cache kết quả nếu use_cache=True
             if use_cache:
-                cache_key = f'clip_image_id_search:{image_id}:{top_k}'
-                cache.set(cache_key, results, DEFAULT_CACHE_TTL)
-            
-            return results
+                cache_key = self.search_generation.key(
+                    self._cache_generation(), 'clip_image_id_search', image_id, top_k
+                )
+                return self.result_cache.get_or_compute(cache_key, compute)
+            return compute()
             
         except Exception as e:
             print(f"Error in image ID search: {e}")
             return []
 
+    @bounded
+    def search_batch(self, queries, viewer_id=None):
+        """
+        Run several text / image-id queries together: uncached texts are encoded in one
+        forward pass, images that are not in the index are downloaded concurrently and
+        encoded in one forward pass, and every query vector goes through one multi-row FAISS search.
+        
+        Args:
+            queries (list): dicts with 'text' or 'image_id', plus 'top_k'.
+        
+        Returns:
+            list: one result list per query, in the same order (empty for images that cannot be read).
+        """
+        results = [None] * len(queries)
+        rows = []  # (query index, vector, top_k, image id to leave out)
+        pending_texts = {}
+        pending_images = {}
+        snapshot = self.snapshot
+        
+        for i, query in enumerate(queries):
+            top_k = clamp_top_k(query.get('top_k', 12))
+            if query.get('text') is not None:
+                self._track_query(query['text'])
+                normalized = normalize_query(query['text'])
+                vector = self.embedding_cache.get(query_hash(normalized))
+                if vector is None:
+                    pending_texts.setdefault(normalized, []).append((i, top_k))
+                else:
+                    rows.append((i, vector, top_k, None))
+                continue
+            
+            image_id = int(query['image_id'])
+            position = snapshot.position_of(image_id)
+            if position is None:
+                # Ảnh chưa được index: tải + encode chung với các ảnh khác của batch
+                pending_images.setdefault(image_id, []).append((i, top_k))
+                continue
+            rows.append((i, np.asarray(snapshot.embeddings[[position]], dtype='float32')[0], top_k, image_id))
+        
+        if pending_texts:
+            texts = list(pending_texts)
+            for text, vector in zip(texts, self.encode_texts(texts)):
+                self.embedding_cache.set(query_hash(text), vector)
+                rows.extend((i, vector, top_k, None) for i, top_k in pending_texts[text])
+        
+        if pending_images:
+            images = self._load_images(list(pending_images))
+            loaded, embeddings = self._encode_images(images) if images else ([], None)
+            for offset, image in enumerate(loaded):
+                rows.extend((i, embeddings[offset], top_k, image.id) for i, top_k in pending_images.pop(image.id))
+            # Ảnh không tồn tại / không tải được
+            for entries in pending_images.values():
+                for i, _ in entries:
+                    results[i] = []
+        
+        if rows:
+            query_vectors = np.ascontiguousarray(np.stack([vector for _, vector, _, _ in rows]), dtype='float32')
+            # Image-id rows fetch one extra hit, since the image itself is usually the nearest one
+            depth = max(top_k + (exclude_id is not None) for _, _, top_k, exclude_id in rows)
+            distances, indices = self._search_vectors(query_vectors, depth, viewer_id=viewer_id, snapshot=snapshot)
+            for row, (i, _, top_k, exclude_id) in enumerate(rows):
+                ranked = self._format_results(distances[row], indices[row], snapshot=snapshot)
+                results[i] = [result for result in ranked if result.get('id') != exclude_id][:top_k]
+        return results
+
+    def contains(self, image_id):
+        """O(1) check whether an image currently has a live vector in the index"""
+        return self.snapshot.contains(image_id)
+
     def update_index_for_image(self, image_id):
         """Add a new image to the FAISS index"""
+        if not self.update_index_for_images([image_id]):
+            raise ValueError(f"Image {image_id} could not be indexed")
+        return True
+    
+    def update_index_for_images(self, image_ids, fetch_workers=FETCH_WORKERS):
+        """
+        Add (or re-index) a batch of images: parallel download, one encode_image
+        forward pass, one FAISS add and one WAL sync for the whole batch.
+        
+        Returns:
+            list: ids that were indexed (missing / unreadable images are skipped)
+        """
         try:
-            # Get the image from Django ORM
-            from media.models import Image
-            image = Image.objects.get(id=image_id)
+            images = self._load_images(image_ids)
+            if not images:
+                return []
             
-            # Process the image
-            image_url = image.file.url
-            img_response = requests.get(image_url, stream=True)
-            img = PILImage.open(BytesIO(img_response.content)).convert('RGB')
+            loaded, embeddings = self._encode_images(images, fetch_workers)
+            if not loaded:
+                return []
+            
+            # Create metadata for these images
+            indexed_ids = [image.id for image in loaded]
+            metadatas = [self._image_metadata(image) for image in loaded]
             
-            # Generate embedding
-            image_input = self.preprocess(img).unsqueeze(0).to(self.device)
-            with torch.no_grad():
-                image_features = self.model.encode_image(image_input)
-                image_features /= image_features.norm(dim=-1, keepdim=True)
-            
-            # Convert to numpy and reshape
-            embedding = image_features.cpu().numpy().astype('float32').reshape(1, -1)
-            
-            # Add to FAISS index
-            self.faiss_index.add(embedding)
-            
-            # Update metadata
-            self.image_ids.append(image_id)
-            self.image_urls.append(image_url)
-            
-            # Create metadata for this image
-            metadata = {
-                'id': image_id,
-                'file': image_url,
-                'title': image.title,
-                'description': image.description,
-                'created_at': str(image.created_at),
-                'is_public': image.is_public,
-                'user_id': image.user.id
-            }
-            
-            # Add to metadata
-            self.image_metadata.append(metadata)
-            self.metadata_by_id[image_id] = metadata
+            with self._write_lock:
+                # Log first (shared log + one WAL fsync per batch), then apply in memory
+                self._log_updates([
+                    WALRecord(None, OP_ADD, image_id, embedding, metadata)
+                    for image_id, embedding, metadata in zip(indexed_ids, embeddings, metadatas)
+                ])
+                self._apply_adds(indexed_ids, embeddings, metadatas)
+            
+            self._maybe_snapshot()
             
             # Xóa cache liên quan đến tìm kiếm để đảm bảo kết quả luôn mới nhất
             self._invalidate_search_cache()
             
-            # Save updated data
-            self._save_data()
-            
-            return True
+            return indexed_ids
             
         except Exception as e:
-            print(f"Error updating index for image {image_id}: {e}")
+            print(f"Error updating index for images {image_ids}: {e}")
             raise
     
-    def remove_from_index(self, image_id):
-        """Remove an image from the FAISS index"""
+    def update_metadata_for_images(self, image_ids):
+        """
+        Rewrite the stored metadata and BM25 postings of indexed images (title / description edits)
+        without downloading or re-encoding them.
+        
+        Returns:
+            list: ids that were updated (images not in the index are skipped)
+        """
         try:
-            # Find the index of the image in our metadata
-            image_index = None
-            for i, img_id in enumerate(self.image_ids):
-                if str(img_id) == str(image_id):  # Convert to string for comparison
-                    image_index = i
-                    break
-            
-            if image_index is None:
-                print(f"Image {image_id} not found in index")
-                return False
+            images = self._load_images(image_ids)
+            if not images:
+                return []
+            
+            with self._write_lock:
+                # The image may have been indexed by another worker
+                self._catch_up()
+                images = [image for image in images if self.snapshot.contains(image.id)]
+                if not images:
+                    return []
                 
-            # Remove from metadata
-            self.image_ids.pop(image_index)
-            self.image_urls.pop(image_index)
+                metadatas = [self._image_metadata(image) for image in images]
+                self._log_updates([WALRecord(None, OP_METADATA, metadata['id'], metadata=metadata)
+                                   for metadata in metadatas])
+                updated_ids = self._apply_metadata([image.id for image in images], metadatas)
+            
+            self._maybe_snapshot()
             
-            # Remove from metadata dictionary
-            if image_id in self.metadata_by_id:
-                del self.metadata_by_id[image_id]
+            # Xóa cache liên quan đến tìm kiếm để đảm bảo kết quả luôn mới nhất
+            self._invalidate_search_cache()
             
-            # Find and remove from image_metadata list
-            self.image_metadata = [img for img in self.image_metadata if str(img['id']) != str(image_id)]
+            return updated_ids
+            
+        except Exception as e:
+            print(f"Error updating metadata for images {image_ids}: {e}")
+            raise
+    
+    def _encode_images(self, images, fetch_workers=FETCH_WORKERS):
+        """
+        Download + preprocess images concurrently (network bound), then encode them in one forward pass.
+        
+        Returns:
+            tuple: (images that could be read, their normalized embeddings)
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(fetch_workers, len(images)))) as pool:
+            loaded = [item for item in pool.map(self._fetch_and_preprocess, images) if item[1] is not None]
+        if not loaded:
+            return [], None
+        embeddings = _normalize(self.image_encoder(torch.stack([tensor for _, tensor in loaded])))
+        return [image for image, _ in loaded], embeddings
+    
+    @staticmethod
+    def _load_images(image_ids):
+        """Image rows (with their owner) in the order of image_ids, from one query"""
+        from media.models import Image
+        images = Image.objects.select_related('user').in_bulk(image_ids)
+        return [images[image_id] for image_id in image_ids if image_id in images]
+    
+    @staticmethod
+    def _image_metadata(image):
+        return {
+            'id': image.id,
+            'file': image.file.url,
+            'title': image.title,
+            'description': image.description,
+            'created_at': str(image.created_at),
+            'is_public': image.is_public,
+            'user_id': image.user.id
+        }
+    
+    def _fetch_and_preprocess(self, image):
+        try:
+            img_response = requests.get(image.file.url, timeout=30)
+            img_response.raise_for_status()
+            img = PILImage.open(BytesIO(img_response.content)).convert('RGB')
+            return image, self.preprocess(img)
+        except Exception as e:
+            print(f"Error fetching image {image.id}: {e}")
+            return image, None
+    
+    def remove_from_index(self, image_id):
+        """Remove an image from the FAISS index (O(1) lookup + tombstone)"""
+        if not self.remove_images_from_index([image_id]):
+            print(f"Image {image_id} not found in index")
+            return False
+        return True
+    
+    def remove_images_from_index(self, image_ids):
+        """Tombstone a batch of images with one WAL sync; returns the ids that were in the index"""
+        try:
+            with self._write_lock:
+                # The image may have been indexed by another worker
+                self._catch_up()
+                removed_ids = [image_id for image_id in image_ids if self.snapshot.contains(image_id)]
+                if not removed_ids:
+                    return []
+                
+                self._log_updates([WALRecord(None, OP_DELETE, image_id) for image_id in removed_ids])
+                self._apply_deletes(removed_ids)
             
-            # Note: We're deliberately NOT rebuilding the FAISS index
-            # Instead we just mark the index as stale by updating metadata
-            # The index will be slightly inaccurate but will not cause errors
-            # This avoids expensive rebuilding operations
-            print(f"Removed image {image_id} from metadata but skipped FAISS index rebuild")
+            self._maybe_snapshot()
             
             # Xóa cache liên quan đến tìm kiếm để đảm bảo kết quả luôn mới nhất
             self._invalidate_search_cache()
             
-            # Save updated data
-            self._save_data()
+            self._maybe_compact()
+            return removed_ids
+            
+        except Exception as e:
+            print(f"Error removing images {image_ids} from index: {e}")
+            raise
+
+    def _log_updates(self, records):
+        """
+        Assign versions to a batch of updates (caller holds _write_lock and applies them right after):
+        publish them to the shared log, apply other workers' earlier versions first, then write them
+        to the WAL with one fsync.
+        """
+        if self.index_log is not None:
+            versions = self.index_log.append(records, floor=self._applied_seq)
+            # Versions of one batch are consecutive: everything before them is already in the log
+            self._catch_up(through=versions[0] - 1)
+        else:
+            versions = [None] * len(records)
+        
+        for record, version in zip(records, versions):
+            if record.op == OP_ADD:
+                seq = self.wal.append_add(record.image_id, record.vector, record.metadata, sync=False, seq=version)
+            elif record.op == OP_METADATA:
+                seq = self.wal.append_metadata(record.image_id, record.metadata, sync=False, seq=version)
+            else:
+                seq = self.wal.append_delete(record.image_id, sync=False, seq=version)
+            # A snapshot reloaded while catching up may already include this batch
+            self._applied_seq = max(self._applied_seq, seq)
+        self.wal.sync()
+    
+    def _apply_records(self, records):
+        """Apply logged updates in version order, one snapshot per run of adds / deletes / metadata edits"""
+        for op, group in itertools.groupby(records, key=lambda record: record.op):
+            group = list(group)
+            self._applied_seq = group[-1].seq
+            image_ids = [record.image_id for record in group]
+            if op == OP_ADD:
+                self._apply_adds(image_ids, np.stack([record.vector for record in group]),
+                                 [record.metadata for record in group])
+            elif op == OP_METADATA:
+                self._apply_metadata(image_ids, [record.metadata for record in group])
+            else:
+                self._apply_deletes(image_ids)
+        return len(records)
+    
+    def _start_index_sync(self):
+        """Catch up with the shared log and start the thread that follows it (and watches for rebuilds)"""
+        if self.index_log is not None:
+            try:
+                with self._write_lock:
+                    applied = self._catch_up()
+                if applied:
+                    print(f"🔄 Applied {applied} index updates from other workers (version {self._applied_seq})")
+            except Exception as e:
+                print(f"⚠️ Không đọc được log thay đổi CLIP index: {e}")
+        
+        self._sync_thread = threading.Thread(target=self._follow_index_log, name='clip-index-sync', daemon=True)
+        self._sync_thread.start()
+    
+    def _follow_index_log(self):
+        while True:
+            try:
+                if self.index_log is None:
+                    time.sleep(INDEX_SYNC_POLL)
+                elif self.index_log.wait(self._applied_seq, INDEX_SYNC_POLL):
+                    self.sync_index()
+                self._reload_if_rebuilt()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi đồng bộ CLIP index từ log chung: {e}")
+                time.sleep(INDEX_SYNC_POLL)
+    
+    def _reload_if_rebuilt(self):
+        """Reload the snapshot written by rebuild_clip_index in another process; True if reloaded"""
+        manifest = load_manifest(INDEX_DIR)
+        if not manifest or manifest.get('rebuild', 0) <= self._rebuild:
+            return False
+        
+        print(f"🔄 CLIP index was rebuilt on disk, reloading snapshot {manifest['seq']}")
+        with self._write_lock:
+            self.load_data()
+            # Versions published after the rebuilt snapshot
+            self._catch_up()
+        self._sync_stats['reloads'] += 1
+        return True
+    
+    def sync_index(self):
+        """Apply the updates other workers published since this worker's version; returns their number"""
+        if self.index_log is None:
+            return 0
+        with self._write_lock:
+            applied = self._catch_up()
+        if applied:
+            self._maybe_snapshot()
+            self._maybe_compact()
+            # The writer that logged these updates already bumped the generation; cache keys carry the index
+            # version, so entries this worker cached before catching up are not read by up-to-date workers
+        return applied
+    
+    def _catch_up(self, through=None):
+        """
+        Apply shared-log records after _applied_seq in version order (caller holds _write_lock).
+        A worker whose next versions were already trimmed from the log reloads the last snapshot on disk.
+        Returns the number of versions this worker moved forward.
+        """
+        if self.index_log is None:
+            return 0
+        start = self._applied_seq
+        while through is None or self._applied_seq < through:
+            records = self.index_log.read_after(self._applied_seq, count=INDEX_SYNC_BATCH)
+            first = records[0].seq if records else self.index_log.latest() + 1
+            if first > self._applied_seq + 1:
+                if self._recover_from_disk():
+                    continue
+                # Neither the log nor the disk has these versions any more
+                print(f"⚠️ CLIP index versions {self._applied_seq + 1}..{first - 1} are lost, skipping them")
+                self._sync_stats['skipped_versions'] += first - 1 - self._applied_seq
+                self._applied_seq = first - 1
+            if not records:
+                break
+            if through is not None:
+                records = [record for record in records if record.seq <= through]
+            self._apply_records(records)
+        
+        applied = self._applied_seq - start
+        self._sync_stats['remote_applied'] += applied
+        return applied
+    
+    def _recover_from_disk(self):
+        """Reload the snapshot (+ WAL) saved by another worker if it is ahead of this one; True on progress"""
+        manifest = load_manifest(INDEX_DIR)
+        if not manifest or manifest['seq'] <= self._applied_seq:
+            return False
+        
+        version = self._applied_seq
+        print(f"🔄 CLIP index at version {version} is behind the shared log, reloading snapshot {manifest['seq']}")
+        self.load_data()
+        self._sync_stats['reloads'] += 1
+        return self._applied_seq > version
+    
+    def _apply_add(self, image_id, embedding, metadata):
+        """Append a vector at the next FAISS position (re-indexing an image replaces its previous vector)"""
+        self._apply_adds([image_id], np.asarray(embedding, dtype='float32').reshape(1, -1), [metadata])
+    
+    def _apply_adds(self, image_ids, embeddings, metadatas):
+        """Publish a snapshot with a batch of vectors appended to its delta"""
+        self._publish(self.snapshot.with_adds(image_ids, embeddings, metadatas, self._applied_seq))
+        for image_id, metadata in zip(image_ids, metadatas):
+            self.lexical_index.add(image_id, metadata)
+        self._maybe_fold()
+    
+    def _apply_metadata(self, image_ids, metadatas):
+        """Publish a snapshot with new metadata for indexed images; returns the ids that were in the index"""
+        snapshot, updated_ids = self.snapshot.with_metadata(image_ids, metadatas, self._applied_seq)
+        if updated_ids:
+            self._publish(snapshot)
+        for image_id in updated_ids:
+            self.lexical_index.add(image_id, snapshot.metadata(image_id))
+        return updated_ids
+    
+    def _apply_delete(self, image_id):
+        """Tombstone the image's position: the vector stays in FAISS until compaction, but is never returned again"""
+        return bool(self._apply_deletes([image_id]))
+    
+    def _apply_deletes(self, image_ids):
+        """Publish a snapshot with the images' positions tombstoned; returns the ids that were in the index"""
+        snapshot, removed_ids = self.snapshot.with_deletes(image_ids, self._applied_seq)
+        if removed_ids:
+            self._publish(snapshot)
+        for image_id in removed_ids:
+            self.lexical_index.remove(image_id)
+        return removed_ids
+    
+    def _maybe_snapshot(self):
+        """Start a background snapshot once SNAPSHOT_INTERVAL WAL records have accumulated"""
+        if self._applied_seq - self._snapshot_seq < SNAPSHOT_INTERVAL:
+            return
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        
+        self._snapshot_thread = threading.Thread(target=self._save_data, name='clip-index-snapshot', daemon=True)
+        self._snapshot_thread.start()
+    
+    def _maybe_fold(self):
+        """Start a background fold once the delta holds DELTA_MAX_VECTORS vectors"""
+        if self.snapshot.delta_size < DELTA_MAX_VECTORS:
+            return
+        if self._fold_thread is not None and self._fold_thread.is_alive():
+            return
+        
+        self._fold_thread = threading.Thread(target=self.fold_delta, name='clip-index-fold', daemon=True)
+        self._fold_thread.start()
+    
+    def fold_delta(self):
+        """Add the delta vectors to a copy of the base index (off-lock), then publish it as the new base"""
+        try:
+            snapshot = self.snapshot
+            if not snapshot.delta_size:
+                return False
+            
+            # Heavy part: searches keep using the current snapshot meanwhile
+            index = snapshot.folded_index()
             
+            with self._write_lock:
+                current = self.snapshot
+                if current.index is not snapshot.index:
+                    # Compaction or a snapshot save replaced the base in the meantime
+                    return False
+                # Vectors appended while folding stay in the delta of the new snapshot
+                self._publish(current.rebased(index))
+            print(f"Folded {snapshot.delta_size} delta vectors into the CLIP base index ({index.ntotal} vectors)")
             return True
             
         except Exception as e:
-            print(f"Error removing image {image_id} from index: {e}")
-            raise
+            print(f"Error folding CLIP index delta: {e}")
+            return False
+    
+    def _maybe_compact(self):
+        """Start a background compaction once tombstones exceed COMPACTION_THRESHOLD"""
+        snapshot = self.snapshot
+        if not snapshot.size or snapshot.tombstone_count / snapshot.size < COMPACTION_THRESHOLD:
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        
+        self._compaction_thread = threading.Thread(target=self.compact, name='clip-index-compaction', daemon=True)
+        self._compaction_thread.start()
+
+    def compact(self):
+        """Physically drop tombstoned vectors; the new index is built off-lock, then published as a new snapshot"""
+        try:
+            # Capture the live positions at this point in time
+            snapshot = self.snapshot
+            live_positions = np.flatnonzero(~snapshot.dead).tolist()
+            
+            if len(live_positions) == snapshot.size:
+                return False
+            print(f"Compacting CLIP index: dropping {snapshot.size - len(live_positions)} tombstoned vectors")
+            
+            # Heavy part: searches keep using the current snapshot meanwhile
+            live_vectors = np.ascontiguousarray(snapshot.embeddings[live_positions], dtype='float32')
+            new_index, index_info = self._build_index(live_vectors)
+            
+            with self._write_lock:
+                # Carry over vectors added while the new index was being built (positions are append-only)
+                current = self.snapshot
+                appended = list(range(snapshot.size, current.size))
+                if appended:
+                    new_index.add(np.ascontiguousarray(current.embeddings[appended], dtype='float32'))
+                kept = live_positions + appended
+                
+                # Deletes that happened during compaction are remapped to new positions
+                new_tombstones = {new_pos for new_pos, old_pos in enumerate(kept) if current.dead[old_pos]}
+                urls = current.image_urls()
+                
+                self._publish(IndexSnapshot(
+                    new_index, VectorStore(current.embeddings[kept], mmap=current.embeddings.mmap),
+                    current.ids[kept].tolist(), [urls[pos] for pos in kept], current.all_metadata(),
+                    new_tombstones, index_info, version=current.version
+                ))
+            
+            self._save_data(force=True)
+            self._invalidate_search_cache()
+            print(f"Compaction finished: index now has {self.snapshot.size} vectors")
+            return True
+            
+        except Exception as e:
+            print(f"Error compacting CLIP index: {e}")
+            return False
             
     def _rebuild_index_from_metadata(self):
-        """Rebuild FAISS index from existing images in metadata"""
+        """Rebuild FAISS index from existing images in metadata, publishing it as one new snapshot"""
         try:
             print("Attempting to rebuild FAISS index from existing metadata...")
+            snapshot = self.snapshot
             
-            # If we have no images left, create an empty index
-            if len(self.image_ids) == 0:
-                print("No images remaining, creating empty index")
-                # Use default dimension (512 for CLIP ViT-B/32)
-                self.faiss_index = faiss.IndexFlatL2(512)
-                return
-                
             # Get embeddings for remaining images
             from media.models import Image
             embeddings = []
+            image_ids = []
             
-            for image_id in self.image_ids:
+            for image_id in snapshot.live_ids().tolist():
                 try:
                     # Get the image and regenerate its embedding
                     image = Image.objects.get(id=image_id)
@@ -431,81 +1434,153 @@ class CLIPImageSearch:
                     img = PILImage.open(BytesIO(img_response.content)).convert('RGB')
                     
                     # Generate embedding
-                    image_input = self.preprocess(img).unsqueeze(0).to(self.device)
-                    with torch.no_grad():
-                        image_features = self.model.encode_image(image_input)
-                        image_features /= image_features.norm(dim=-1, keepdim=True)
+                    embedding = _normalize(self.image_encoder(self.preprocess(img).unsqueeze(0)))
                     
                     # Add to embeddings list
-                    embedding = image_features.cpu().numpy().astype('float32').reshape(1, -1)
                     embeddings.append(embedding)
+                    image_ids.append(image_id)
                     
                 except Exception as e:
                     print(f"Error processing image {image_id} during rebuild: {e}")
                     # Skip this image
                     continue
             
-            if embeddings:
-                # Combine all embeddings
-                all_embeddings = np.vstack(embeddings)
-                
-                # Save embeddings
-                np.save(os.path.join(INDEX_DIR, 'clip_image_embeddings.npy'), all_embeddings)
-                
-                # Build new index
-                dimension = all_embeddings.shape[1]
-                self.faiss_index = faiss.IndexFlatL2(dimension)
-                self.faiss_index.add(all_embeddings)
-                
-                print(f"Successfully rebuilt index with {len(embeddings)} images")
-            else:
-                # If we couldn't get any embeddings, create an empty index
-                print("No valid embeddings found, creating empty index")
-                self.faiss_index = faiss.IndexFlatL2(512)
+            # If we couldn't get any embeddings (or no images remain), create an empty index
+            # Use default dimension (512 for CLIP ViT-B/32)
+            all_embeddings = np.vstack(embeddings) if embeddings else np.empty((0, 512), dtype='float32')
+            faiss_index = faiss.IndexFlatL2(all_embeddings.shape[1])
+            faiss_index.add(all_embeddings)
+            
+            with self._write_lock:
+                metadata_by_id = self.snapshot.all_metadata()
+                self._publish(IndexSnapshot(
+                    faiss_index, VectorStore(all_embeddings), image_ids,
+                    [(metadata_by_id.get(image_id) or {}).get('file') for image_id in image_ids], metadata_by_id,
+                    version=self._applied_seq
+                ))
+            self._save_data(force=True)
+            self._invalidate_search_cache()
+            print(f"Successfully rebuilt index with {len(image_ids)} images")
                 
         except Exception as e:
             print(f"Error rebuilding index: {e}")
-            # Create a fresh index as last resort
-            self.faiss_index = faiss.IndexFlatL2(512)
     
-    def _save_data(self):
-        """Save all metadata and index"""
+    def _save_data(self, force=False):
+        """
+        Write an atomic snapshot of index + metadata at the last applied WAL record,
+        then truncate the WAL. Files are written to temp names and renamed after the
+        manifest (with checksums) is committed, so a crash never leaves a mixed set and
+        other workers' mappings of the old files stay valid.
+        
+        Workers share the index directory: only one saves at a time, after catching up with
+        the shared log, and never over a newer snapshot. A periodic save (force=False) is
+        also skipped when the snapshot on disk is already at this version.
+        
+        _write_lock is only held to capture the snapshot and to publish the result: writes
+        keep being applied while the files are serialized.
+        """
+        token = self._acquire_snapshot_lock()
+        if not token:
+            # Nothing was written: _snapshot_seq stays behind so a later write tries again
+            print("Another worker is saving the CLIP index snapshot, skipping")
+            return False
         try:
-            # Save FAISS index
-            faiss.write_index(self.faiss_index, os.path.join(INDEX_DIR, 'clip_faiss.index'))
+            with self._write_lock:
+                # Another worker may have saved (and truncated the WAL) at a later version
+                self._catch_up()
+                manifest = load_manifest(INDEX_DIR)
+                if manifest and manifest['seq'] > self._applied_seq:
+                    print(f"Snapshot on disk is at version {manifest['seq']}, ahead of this worker "
+                          f"({self._applied_seq}): not overwriting it")
+                    self._snapshot_seq = manifest['seq']
+                    return False
+                if not force and manifest and manifest['seq'] == self._applied_seq:
+                    self._snapshot_seq = manifest['seq']
+                    return False
+                # Snapshots are immutable: this one is serialized below without holding _write_lock
+                captured = self.snapshot
+                seq = self._applied_seq
+            
+            snapshot = captured
+            if snapshot.delta_size:
+                # The file holds a single index: fold the delta in first
+                index = snapshot.folded_index()
+                snapshot = snapshot.rebased(index)
+                with self._write_lock:
+                    current = self.snapshot
+                    if current.index is captured.index:
+                        self._publish(current.rebased(index))
+            
+            faiss.write_index(snapshot.index, pending_path(INDEX_DIR, 'clip_faiss.index'))
+            snapshot.embeddings.write(pending_path(INDEX_DIR, 'clip_image_embeddings.npy'))
             
             # Save metadata
-            with open(os.path.join(INDEX_DIR, 'image_urls.json'), 'w') as f:
-                json.dump(self.image_urls, f)
+            with open(pending_path(INDEX_DIR, 'image_urls.json'), 'w') as f:
+                json.dump(snapshot.image_urls(), f)
+                
+            with open(pending_path(INDEX_DIR, 'image_ids.json'), 'w') as f:
+                json.dump(snapshot.ids.tolist(), f)
                 
-            with open(os.path.join(INDEX_DIR, 'image_ids.json'), 'w') as f:
-                json.dump(self.image_ids, f)
+            with open(pending_path(INDEX_DIR, 'image_metadata.json'), 'w') as f:
+                json.dump(list(snapshot.all_metadata().values()), f)
+            
+            with open(pending_path(INDEX_DIR, 'tombstones.json'), 'w') as f:
+                json.dump(np.flatnonzero(snapshot.dead).tolist(), f)
+            
+            save_index_info(pending_path(INDEX_DIR, 'index_info.json'), snapshot.index_info)
+            
+            commit_snapshot(INDEX_DIR, SNAPSHOT_FILES, seq)
+            
+            with self._write_lock:
+                current = self.snapshot
+                if current.embeddings is captured.embeddings:
+                    # Vectors are read back from the committed file from now on (if vectors were added
+                    # meanwhile they stay in memory until the next save)
+                    self._publish(current.with_embeddings(VectorStore.load(
+                        os.path.join(INDEX_DIR, 'clip_image_embeddings.npy'), mmap=current.embeddings.mmap
+                    )))
+                self._snapshot_seq = seq
                 
-            with open(os.path.join(INDEX_DIR, 'image_metadata.json'), 'w') as f:
-                json.dump(self.image_metadata, f)
+                # Records not yet applied (replay at startup, other workers' newer versions) stay in the log
+                self.wal.truncate(through_seq=seq)
                 
+            print(f"Saved CLIP index snapshot at WAL seq {seq}")
             return True
         except Exception as e:
             print(f"Error saving data: {e}")
             raise
+        finally:
+            self._release_snapshot_lock(token)
+    
+    def _acquire_snapshot_lock(self, wait=0):
+        """
+        Lock giữa các worker (và rebuild_clip_index) khi ghi / khôi phục snapshot.
+        Returns: token, hoặc None nếu worker khác hay luồng khác của process này đang giữ lock
+        (luồng đó có thể đang chờ _write_lock: không chờ nó).
+        """
+        if not self._snapshot_mutex.acquire(blocking=False):
+            return None
+        token = acquire_snapshot_lock(wait)
+        if not token:
+            self._snapshot_mutex.release()
+        return token
+    
+    def _release_snapshot_lock(self, token):
+        if token:
+            release_snapshot_lock(token)
+            self._snapshot_mutex.release()
+    
+    def _cache_generation(self):
+        """Generation of cached search results, tagged with the index version they are computed on"""
+        return f'{self.search_generation.current()}v{self.snapshot.version}'
     
     def _invalidate_search_cache(self):
-        """Xóa toàn bộ cache liên quan đến tìm kiếm"""
+        """Invalidate toàn bộ cache tìm kiếm phụ thuộc index (xếp hạng text, image URL, image ID)"""
         try:
-            # Sử dụng wildcard để xóa tất cả cache liên quan đến tìm kiếm
-            # Lưu ý: Điều này phụ thuộc vào cơ chế hỗ trợ wildcard delete của Redis
-            from django.core.cache import cache
-            
-            # Xóa cache tìm kiếm theo text
-            cache.delete_pattern("pixoria:clip_text_search:*")
-            
-            # Xóa cache tìm kiếm theo image
-            cache.delete_pattern("pixoria:clip_image_search:*")
-            
-            # Xóa cache tìm kiếm theo image ID
-            cache.delete_pattern("pixoria:clip_image_id_search:*")
-            
-            print("Đã xóa cache tìm kiếm")
+            # Một lệnh INCR: entry của thế hệ cũ không còn được đọc và tự hết hạn theo TTL
+            # (embedding truy vấn không phụ thuộc index nên không bị ảnh hưởng)
+            generation = self.search_generation.bump()
+            print(f"Search cache generation -> {generation}")
         except Exception as e:
             print(f"Lỗi khi xóa cache tìm kiếm: {e}")
             # Tiếp tục ngay cả khi có lỗi xảy ra
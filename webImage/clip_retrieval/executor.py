@@ -0,0 +1,174 @@
+import functools
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class InferenceOverloaded(Exception):
+    """Hàng đợi inference đã đầy hoặc request đã quá deadline: client nên thử lại sau retry_after giây"""
+
+    def __init__(self, message, retry_after=1, reason='queue_full'):
+        super().__init__(message)
+        self.retry_after = max(int(retry_after), 1)
+        self.reason = reason
+
+
+def set_thread_budget(num_threads):
+    """
+    Số luồng OpenMP mà FAISS dùng cho mỗi lệnh gọi từ luồng hiện tại. Số luồng của torch là thiết lập
+    của cả process, chỉ được đặt một lần bằng inference.configure_threads.
+    """
+    import faiss
+
+    faiss.omp_set_num_threads(num_threads)
+
+
+class InferenceExecutor:
+    """
+    Executor của process cho forward CLIP + FAISS search: số worker cố định chia nhau một ngân sách luồng
+    (torch và FAISS không tự tạo thêm pool OpenMP theo số request), hàng đợi có giới hạn và deadline cho
+    mỗi request. Khi hàng đợi đầy, request bị từ chối ngay bằng InferenceOverloaded thay vì xếp hàng vô hạn.
+    """
+
+    def __init__(self, max_workers=2, max_queue=16, deadline=10.0, thread_budget=0, name='clip-inference'):
+        """
+        Args:
+            max_workers (int): Số request được xử lý đồng thời.
+            max_queue (int): Số request tối đa chờ worker rảnh; vượt quá sẽ bị từ chối.
+            deadline (float): Thời gian tối đa (giây) một request chờ + chạy, 0 = không giới hạn.
+            thread_budget (int): Tổng số luồng OpenMP chia đều cho các worker, 0 = số CPU.
+        """
+        self.max_workers = max(int(max_workers), 1)
+        self.max_queue = max(int(max_queue), 0)
+        self.deadline = float(deadline or 0)
+        self.threads_per_worker = max((int(thread_budget or 0) or os.cpu_count() or 1) // self.max_workers, 1)
+
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix=name, initializer=self._init_worker)
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+        self._deadline_exceeded = 0
+        # Thời gian xử lý trung bình (EWMA, giây) để ước lượng Retry-After
+        self._service_time = 0.05
+        self._recent_waits = deque(maxlen=1000)
+
+    def _init_worker(self):
+        self._local.worker = True
+        set_thread_budget(self.threads_per_worker)
+
+    def in_worker(self):
+        """True nếu luồng hiện tại là worker của executor (gọi lồng nhau chạy trực tiếp, tránh deadlock)"""
+        return getattr(self._local, 'worker', False)
+
+    def _retry_after(self):
+        return max(math.ceil(self._in_flight / self.max_workers * self._service_time), 1)
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Chạy fn(*args, **kwargs) trên một worker và chờ kết quả.
+
+        Raises:
+            InferenceOverloaded: nếu hàng đợi đầy (reason='queue_full') hoặc quá deadline (reason='deadline').
+        """
+        enqueued = time.monotonic()
+        deadline = enqueued + self.deadline if self.deadline else None
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise InferenceOverloaded(
+                    f"Inference queue is full ({self.max_queue} waiting)", self._retry_after(), 'queue_full'
+                )
+            self._in_flight += 1
+
+        future = self._pool.submit(self._execute, fn, args, kwargs, enqueued, deadline)
+        # Giải phóng chỗ trong hàng đợi cả khi future bị huỷ trước khi chạy
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self._deadline_exceeded += 1
+                retry_after = self._retry_after()
+            raise InferenceOverloaded(f"Search did not finish within {self.deadline:g}s", retry_after, 'deadline')
+
+    def submit_background(self, fn, *args, **kwargs):
+        """
+        Chạy fn trên một worker mà không chờ kết quả (ví dụ làm mới cache). Chỉ nhận khi hàng đợi còn
+        dưới một nửa, để việc nền không chiếm chỗ của request; trả về Future, hoặc None nếu bị bỏ qua.
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue // 2:
+                return None
+            self._in_flight += 1
+        future = self._pool.submit(self._execute, fn, args, kwargs, time.monotonic(), None)
+        future.add_done_callback(self._release)
+        return future
+
+    def _execute(self, fn, args, kwargs, enqueued, deadline):
+        started = time.monotonic()
+        if deadline is not None and started >= deadline:
+            # Caller đã bỏ đi: không tốn CPU cho kết quả không ai chờ
+            raise InferenceOverloaded("Search expired in the queue", reason='deadline')
+
+        with self._lock:
+            self._running += 1
+            self._recent_waits.append(started - enqueued)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def get_metrics(self):
+        """Trạng thái hàng đợi, số request bị từ chối / quá deadline và thời gian chờ worker (ms)"""
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            metrics = {
+                'workers': self.max_workers,
+                'threads_per_worker': self.threads_per_worker,
+                'max_queue': self.max_queue,
+                'deadline_s': self.deadline,
+                'running': self._running,
+                'queued': self._in_flight - self._running,
+                'completed': self._completed,
+                'rejected_queue_full': self._rejected,
+                'deadline_exceeded': self._deadline_exceeded,
+                'avg_service_ms': self._service_time * 1000,
+                'retry_after_s': self._retry_after(),
+            }
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(len(waits) - 1, int(p * len(waits)))] * 1000
+
+        metrics['queue_wait_ms'] = {'p50': percentile(0.50), 'p95': percentile(0.95), 'p99': percentile(0.99)}
+        return metrics
+
+
+def bounded(method):
+    """Method của engine chạy qua self.executor (nếu có); lời gọi lồng nhau từ worker chạy trực tiếp"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        executor = getattr(self, 'executor', None)
+        if executor is None or executor.in_worker():
+            return method(self, *args, **kwargs)
+        return executor.run(method, self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,419 @@
+import json
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+# Các loại index hỗ trợ cho CLIP index
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+# Cách lưu vector trong index: nguyên bản, nửa độ chính xác, lượng tử hoá 8 bit, product quantization
+STORAGE_TYPES = ('float32', 'float16', 'int8', 'pq')
+
+# Giá trị mặc định cho tham số runtime
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+DEFAULT_HNSW_M = 32
+
+
+def default_nlist(num_vectors):
+    """Số cluster IVF: ~4*sqrt(N), nhưng đảm bảo mỗi cluster có ít nhất 39 điểm train"""
+    if num_vectors <= 0:
+        return 1
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+
+
+def default_pq_m(dimension):
+    """Số sub-quantizer PQ: ước lớn nhất của dimension không vượt quá dimension / 8"""
+    target = max(1, dimension // 8)
+    for m in range(target, 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def _pq_nbits(num_vectors):
+    # 8 bit/code cần ~10k điểm train; với tập nhỏ dùng 4 bit
+    return 8 if num_vectors >= 256 * 39 else 4
+
+
+def _codec_string(storage, dimension, num_vectors, pq_m=None):
+    if storage == 'float32':
+        return 'Flat'
+    if storage == 'float16':
+        return 'SQfp16'
+    if storage == 'int8':
+        return 'SQ8'
+    if storage == 'pq':
+        return f'PQ{pq_m or default_pq_m(dimension)}x{_pq_nbits(num_vectors)}'
+    raise ValueError(f"Unknown storage type: {storage} (expected one of {STORAGE_TYPES})")
+
+
+def factory_string(index_type, dimension, num_vectors, nlist=None, pq_m=None, hnsw_m=DEFAULT_HNSW_M,
+                   storage='float32', pca_dim=None):
+    """
+    Chuỗi mô tả index cho faiss.index_factory.
+
+    pca_dim: giảm chiều bằng PCA trước khi vào index (tầng lọc thô, ứng viên được re-rank bằng vector gốc).
+    Ma trận PCA được lưu ngay trong file index (IndexPreTransform).
+    """
+    prefix = ''
+    if pca_dim and 0 < pca_dim < dimension:
+        prefix = f'PCA{int(pca_dim)},'
+        dimension = int(pca_dim)
+    if index_type == 'ivf_pq':
+        # ivf_pq luôn lưu mã PQ
+        storage = 'pq'
+    codec = _codec_string(storage, dimension, num_vectors, pq_m)
+
+    if index_type == 'flat':
+        return prefix + codec
+    if index_type == 'hnsw':
+        if storage == 'float32':
+            return f'{prefix}HNSW{hnsw_m}'
+        if storage == 'pq':
+            # HNSW + PQ chỉ hỗ trợ mã 8 bit
+            return f'{prefix}HNSW{hnsw_m}_PQ{pq_m or default_pq_m(dimension)}'
+        return f'{prefix}HNSW{hnsw_m}_{codec}'
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return f'{prefix}IVF{nlist or default_nlist(num_vectors)},{codec}'
+
+    raise ValueError(f"Unknown index type: {index_type} (expected one of {INDEX_TYPES})")
+
+
+def build_index(vectors, index_type='flat', nlist=None, pq_m=None, hnsw_m=DEFAULT_HNSW_M,
+                train_size=100000, seed=1234, storage='float32', pca_dim=None):
+    """
+    Xây dựng FAISS index (L2) từ ma trận vector.
+
+    Index cần train (IVF, PCA) được train trên một mẫu ngẫu nhiên tối đa train_size vector.
+
+    Returns:
+        tuple: (index, description) - index đã chứa toàn bộ vector, chuỗi factory đã dùng.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    num_vectors, dimension = vectors.shape
+
+    # IVF không train được với quá ít vector: quay về flat
+    if index_type in ('ivf_flat', 'ivf_pq') and num_vectors < 39:
+        print(f"Only {num_vectors} vectors, falling back to a flat index")
+        index_type = 'flat'
+    # PCA cần ít nhất số vector bằng số chiều gốc để ước lượng ma trận hiệp phương sai
+    if pca_dim and pca_dim < dimension and num_vectors < dimension:
+        print(f"Only {num_vectors} vectors, skipping the PCA{pca_dim} reduction")
+        pca_dim = None
+
+    description = factory_string(index_type, dimension, num_vectors, nlist, pq_m, hnsw_m, storage, pca_dim)
+    index = faiss.index_factory(dimension, description, faiss.METRIC_L2)
+
+    if not index.is_trained:
+        if num_vectors > train_size:
+            rng = np.random.default_rng(seed)
+            sample = vectors[np.sort(rng.choice(num_vectors, train_size, replace=False))]
+        else:
+            sample = vectors
+        print(f"Training {description} index on {len(sample)} vectors...")
+        index.train(sample)
+
+    if num_vectors:
+        index.add(vectors)
+    return index, description
+
+
+def read_index(path, mmap=False):
+    """
+    Đọc FAISS index từ file.
+
+    mmap=True: map file ở chế độ read-only, các worker dùng chung page cache thay vì mỗi
+    process giữ một bản sao trên heap. Index đọc theo cách này không được sửa trực tiếp,
+    cần đọc lại bình thường (copy-on-write) trước khi add.
+    """
+    if not mmap:
+        return faiss.read_index(str(path))
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    # Bản faiss mới hơn map được cả mã của flat / HNSW index, bản cũ chỉ map inverted lists của IVF
+    flags |= getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+    return faiss.read_index(str(path), flags)
+
+
+def write_index(index, path):
+    """Ghi index ra file tạm rồi rename, để process khác đang mmap file cũ không bị ảnh hưởng"""
+    tmp_path = f'{path}.tmp'
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, str(path))
+
+
+def set_search_defaults(index, nprobe=None, ef_search=None):
+    """Đặt tham số search mặc định của index (áp dụng cho cả deployment)"""
+    ivf = _extract_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = int(nprobe)
+    hnsw = _extract_hnsw(index)
+    if hnsw is not None and ef_search:
+        hnsw.hnsw.efSearch = int(ef_search)
+
+
+def make_search_params(index, nprobe=None, ef_search=None, selector=None):
+    """
+    Tạo SearchParameters cho một lần search (per-request), hoặc None nếu không cần.
+
+    selector: faiss.IDSelector giới hạn các vị trí được duyệt (lọc ngay trong lúc search).
+    """
+    if selector is None:
+        if nprobe and _extract_ivf(index) is not None:
+            return faiss.SearchParametersIVF(nprobe=int(nprobe))
+        if ef_search and _extract_hnsw(index) is not None:
+            return faiss.SearchParametersHNSW(efSearch=int(ef_search))
+        return None
+
+    # SearchParameters thay thế hoàn toàn tham số của index, nên phải mang theo nprobe / efSearch mặc định
+    ivf = _extract_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=int(nprobe or ivf.nprobe))
+    hnsw = _extract_hnsw(index)
+    if hnsw is not None:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=int(ef_search or hnsw.hnsw.efSearch))
+    return faiss.SearchParameters(sel=selector)
+
+
+def supports_selector(index):
+    """IndexPQ (flat PQ) không nhận IDSelector khi search; các loại index còn lại đều lọc được"""
+    return not isinstance(_unwrap(index), faiss.IndexPQ)
+
+
+def coarse_dimension(index):
+    """Số chiều index thực sự so sánh (nhỏ hơn index.d khi có bước PCA phía trước)"""
+    return int(_unwrap(index).d)
+
+
+def is_reduced(index):
+    """Index có bước giảm chiều (PCA): kết quả chỉ là ứng viên, cần re-rank bằng vector gốc"""
+    return coarse_dimension(index) < index.d
+
+
+def rerank_exact(query_vectors, candidates, vectors, k):
+    """
+    Xếp hạng lại chính xác (L2) các ứng viên từ index nén / giảm chiều bằng vector full-precision.
+
+    Args:
+        query_vectors (np.ndarray): (n, d) vector truy vấn.
+        candidates (np.ndarray): (n, c) vị trí ứng viên từ FAISS (-1 = không có).
+        vectors: Nguồn vector gốc hỗ trợ fancy indexing (np.ndarray hoặc VectorStore).
+        k (int): Số kết quả giữ lại mỗi dòng.
+
+    Returns:
+        tuple: (distances, indices) cùng định dạng với faiss search.
+    """
+    query_vectors = np.asarray(query_vectors, dtype='float32')
+    num_queries = len(query_vectors)
+    candidates = np.asarray(candidates, dtype='int64').reshape(num_queries, -1)
+    distances = np.full((num_queries, k), np.inf, dtype='float32')
+    indices = np.full((num_queries, k), -1, dtype='int64')
+
+    # Đọc mỗi vector ứng viên đúng một lần cho cả batch truy vấn
+    valid = candidates >= 0
+    unique_positions = np.unique(candidates[valid])
+    if len(unique_positions) == 0:
+        return distances, indices
+    candidate_vectors = np.asarray(vectors[unique_positions], dtype='float32')
+
+    # ||v - q||^2 = ||v||^2 - 2 v.q + ||q||^2: một phép nhân ma trận cho toàn bộ (ứng viên x truy vấn)
+    dots = candidate_vectors @ query_vectors.T
+    vector_norms = np.einsum('ij,ij->i', candidate_vectors, candidate_vectors)
+    query_norms = np.einsum('ij,ij->i', query_vectors, query_vectors)
+    slots = np.searchsorted(unique_positions, np.where(valid, candidates, unique_positions[0]))
+    all_distances = vector_norms[slots] - 2 * dots[slots, np.arange(num_queries)[:, None]] + query_norms[:, None]
+    all_distances = np.where(valid, np.maximum(all_distances, 0), np.inf).astype('float32')
+
+    keep = min(k, all_distances.shape[1])
+    if all_distances.shape[1] > keep:
+        top = np.argpartition(all_distances, keep - 1, axis=1)[:, :keep]
+    else:
+        top = np.broadcast_to(np.arange(keep), (num_queries, keep))
+    top_distances = np.take_along_axis(all_distances, top, axis=1)
+    order = np.take_along_axis(top, np.argsort(top_distances, axis=1, kind='stable'), axis=1)
+
+    distances[:, :keep] = np.take_along_axis(all_distances, order, axis=1)
+    indices[:, :keep] = np.where(np.isfinite(distances[:, :keep]), np.take_along_axis(candidates, order, axis=1), -1)
+    return distances, indices
+
+
+def measure_recall(index, vectors, k=10, sample_size=500, params=None, seed=4321, rerank_factor=None,
+                   min_candidates=0):
+    """
+    Recall@k của index so với tìm kiếm chính xác (flat) trên chính các vector đã index.
+
+    sample_size: số truy vấn; kết quả chính xác được tính brute-force trực tiếp trên vectors (không copy
+    vectors vào một IndexFlatL2), chi phí tỉ lệ với sample_size.
+    rerank_factor: nếu có, lấy max(k * rerank_factor, min_candidates) ứng viên rồi xếp hạng lại chính xác.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    num_vectors = vectors.shape[0]
+    if num_vectors == 0:
+        return 1.0
+
+    k = min(k, num_vectors)
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(num_vectors, min(sample_size, num_vectors), replace=False)]
+
+    _, truth = faiss.knn(queries, vectors, k)
+
+    depth = min(max(k * rerank_factor, min_candidates), num_vectors) if rerank_factor else k
+    if params is not None:
+        _, found = index.search(queries, depth, params=params)
+    else:
+        _, found = index.search(queries, depth)
+    if rerank_factor:
+        _, found = rerank_exact(queries, found, vectors, k)
+
+    hits = sum(len(set(truth[i]) & set(found[i])) for i in range(len(queries)))
+    return hits / float(len(queries) * k)
+
+
+def index_bytes_per_vector(index):
+    """Kích thước index khi serialize chia cho số vector (xấp xỉ bộ nhớ thường trú mỗi ảnh)"""
+    if index.ntotal == 0:
+        return 0.0
+    return len(faiss.serialize_index(index)) / float(index.ntotal)
+
+
+def storage_report(vectors, index_type='flat', storages=STORAGE_TYPES, k=10, rerank_factor=4, nlist=None,
+                   nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    """
+    So sánh các kiểu lưu trữ: bytes mỗi ảnh trong index và recall@k (có / không re-rank chính xác).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    rows = []
+    for storage in storages:
+        index, description = build_index(vectors, index_type, nlist=nlist, storage=storage)
+        set_search_defaults(index, nprobe, ef_search)
+        rows.append({
+            'storage': storage,
+            'factory': description,
+            'bytes_per_image': round(index_bytes_per_vector(index), 1),
+            'raw_bytes_per_image': vectors.shape[1] * 4,
+            f'recall_at_{k}': round(measure_recall(index, vectors, k=k), 4),
+            f'recall_at_{k}_reranked': round(measure_recall(index, vectors, k=k, rerank_factor=rerank_factor), 4),
+        })
+    return rows
+
+
+def describe_index(index, description, index_type, vectors, nprobe=None, ef_search=None,
+                   storage='float32', rerank_factor=None, min_candidates=0, recall_sample=500):
+    """
+    Thông tin index (loại, tham số, recall so với flat) để lưu cạnh file index.
+    recall_sample: số truy vấn dùng để đo recall.
+    """
+    params = make_search_params(index, nprobe, ef_search)
+    if index_type == 'ivf_pq':
+        storage = 'pq'
+    info = {
+        'index_type': index_type,
+        'storage': storage,
+        'factory': description,
+        'dimension': int(index.d),
+        'pca_dim': coarse_dimension(index) if is_reduced(index) else None,
+        'ntotal': int(index.ntotal),
+        'nprobe': nprobe if _extract_ivf(index) is not None else None,
+        'ef_search': ef_search if _extract_hnsw(index) is not None else None,
+        'built_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    ivf = _extract_ivf(index)
+    if ivf is not None:
+        info['nlist'] = int(ivf.nlist)
+    info['bytes_per_image'] = round(index_bytes_per_vector(index), 1)
+    # Recall chỉ có ý nghĩa với index xấp xỉ / nén
+    # Index nén hoặc giảm chiều chỉ chọn ứng viên, engine re-rank bằng vector gốc
+    compressed = storage != 'float32' or bool(info['pca_dim'])
+    exact = index_type == 'flat' and not compressed
+    info['recall_at_10_vs_flat'] = 1.0 if exact else round(
+        measure_recall(index, vectors, k=10, sample_size=recall_sample, params=params), 4
+    )
+    if rerank_factor and compressed:
+        info['rerank_factor'] = rerank_factor
+        info['rerank_min_candidates'] = min_candidates
+        info['recall_at_10_reranked'] = round(
+            measure_recall(index, vectors, k=10, sample_size=recall_sample, params=params,
+                           rerank_factor=rerank_factor, min_candidates=min_candidates), 4
+        )
+    return info
+
+
+def two_stage_report(vectors, pca_dims, index_type='flat', storage='float32', k=10, candidates=200, nlist=None,
+                     nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH, sample_size=200, seed=4321):
+    """
+    So sánh tìm kiếm hai tầng: index giảm chiều PCA lấy `candidates` ứng viên, rồi xếp hạng lại chính xác
+    bằng vector gốc. Hàng đầu tiên là index đủ số chiều (không re-rank) để làm mốc.
+    Latency đo từng truy vấn một (như một request), gồm cả bước re-rank.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    num_vectors, dimension = vectors.shape
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(num_vectors, min(sample_size, num_vectors), replace=False)]
+    k = min(k, num_vectors)
+
+    exact = faiss.IndexFlatL2(dimension)
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for pca_dim in [None] + [dim for dim in pca_dims if dim < dimension]:
+        index, description = build_index(vectors, index_type, nlist=nlist, storage=storage, pca_dim=pca_dim)
+        set_search_defaults(index, nprobe, ef_search)
+        depth = min(max(candidates, k), num_vectors) if pca_dim else k
+
+        coarse_hits = reranked_hits = 0
+        start = time.perf_counter()
+        for row, query in enumerate(queries):
+            query = query.reshape(1, -1)
+            _, found = index.search(query, depth)
+            coarse_hits += len(set(truth[row]) & set(found[0, :k]))
+            if pca_dim:
+                _, found = rerank_exact(query, found, vectors, k)
+            reranked_hits += len(set(truth[row]) & set(found[0]))
+        elapsed = time.perf_counter() - start
+
+        rows.append({
+            'pca_dim': pca_dim or dimension,
+            'factory': description,
+            'candidates': depth,
+            'bytes_per_image': round(index_bytes_per_vector(index), 1),
+            f'recall_at_{k}_coarse': round(coarse_hits / float(len(queries) * k), 4),
+            f'recall_at_{k}': round(reranked_hits / float(len(queries) * k), 4),
+            'ms_per_query': round(1000 * elapsed / len(queries), 3),
+        })
+    return rows
+
+
+def save_index_info(path, info):
+    with open(path, 'w') as f:
+        json.dump(info, f, indent=2)
+
+
+def load_index_info(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _extract_ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except Exception:
+        return None
+
+
+def _extract_hnsw(index):
+    index = _unwrap(index)
+    return index if hasattr(index, 'hnsw') else None
+
+
+def _unwrap(index):
+    """Index bên trong bước biến đổi vector (PCA) nếu có"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        return faiss.downcast_index(index.index)
+    return index
@@ -0,0 +1,102 @@
+import json
+
+import numpy as np
+
+from .wal import OP_ADD, OP_METADATA, WALRecord
+
+# Redis stream dùng chung giữa các process: mỗi entry là một thay đổi của CLIP index, ID = '<version>-0'
+UPDATES_KEY = 'pixoria:clip_index_updates'
+# Version lớn nhất đã cấp (INCR trong cùng transaction với XADD nên stream luôn có đủ version theo thứ tự)
+VERSION_KEY = 'pixoria:clip_index_version'
+
+
+def _redis():
+    from django_redis import get_redis_connection
+    return get_redis_connection('default')
+
+
+def _entry_version(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    return int(entry_id.split('-', 1)[0])
+
+
+class IndexUpdateLog:
+    """
+    Log thay đổi của CLIP index dùng chung giữa các worker (Redis stream).
+
+    Mỗi thay đổi (add: id + vector + metadata, delete: id) được cấp một version tăng dần trên toàn hệ thống;
+    mọi worker áp dụng các entry theo đúng thứ tự version, nên index trong bộ nhớ của các worker giống nhau
+    tại cùng một version. Stream chỉ giữ khoảng `retention` entry gần nhất: worker tụt lại xa hơn phải
+    đọc lại snapshot trên đĩa rồi mới đọc tiếp từ log.
+    """
+
+    def __init__(self, retention=10000, key=UPDATES_KEY, version_key=VERSION_KEY):
+        self.retention = max(int(retention), 1)
+        self.key = key
+        self.version_key = version_key
+
+    def append(self, records, floor=0):
+        """
+        Cấp version cho các bản ghi (liên tiếp nhau) và ghi chúng vào stream trong một transaction.
+
+        Args:
+            records (list): WALRecord (seq bị bỏ qua).
+            floor (int): Version đã áp dụng ở worker gọi; bộ đếm không bao giờ cấp version <= floor
+                (ví dụ sau khi Redis bị xoá dữ liệu).
+
+        Returns:
+            list: Version của từng bản ghi, theo thứ tự.
+        """
+        from redis.exceptions import WatchError
+
+        with _redis().pipeline() as pipe:
+            while True:
+                try:
+                    # WATCH bộ đếm: worker khác cấp version cùng lúc thì thử lại với giá trị mới
+                    pipe.watch(self.version_key)
+                    current = max(int(pipe.get(self.version_key) or 0), int(floor))
+                    versions = list(range(current + 1, current + len(records) + 1))
+                    pipe.multi()
+                    pipe.set(self.version_key, versions[-1])
+                    for version, record in zip(versions, records):
+                        pipe.xadd(self.key, self._encode(record), id=f'{version}-0',
+                                  maxlen=self.retention, approximate=True)
+                    pipe.execute()
+                    return versions
+                except WatchError:
+                    continue
+
+    def latest(self):
+        """Version lớn nhất đã được cấp (0 nếu chưa có thay đổi nào)"""
+        return int(_redis().get(self.version_key) or 0)
+
+    def read_after(self, version, count=500):
+        """Tối đa count bản ghi có version > version, theo thứ tự"""
+        entries = _redis().xrange(self.key, min=f'{int(version) + 1}-0', count=count)
+        return [self._decode(entry_id, fields) for entry_id, fields in entries]
+
+    def wait(self, version, timeout=5.0):
+        """Chờ tối đa timeout giây cho tới khi log có bản ghi mới hơn version; True nếu có"""
+        return bool(_redis().xread({self.key: f'{int(version)}-0'}, count=1, block=max(int(timeout * 1000), 1)))
+
+    @staticmethod
+    def _encode(record):
+        fields = {'op': record.op, 'image_id': record.image_id}
+        if record.op == OP_ADD:
+            fields['vector'] = np.ascontiguousarray(record.vector, dtype='<f4').reshape(-1).tobytes()
+            fields['metadata'] = json.dumps(record.metadata)
+        elif record.op == OP_METADATA:
+            fields['metadata'] = json.dumps(record.metadata)
+        return fields
+
+    @staticmethod
+    def _decode(entry_id, fields):
+        fields = {(key.decode() if isinstance(key, bytes) else key): value for key, value in fields.items()}
+        op = int(fields['op'])
+        if op == OP_ADD:
+            vector = np.frombuffer(fields['vector'], dtype='<f4').astype('float32')
+            return WALRecord(_entry_version(entry_id), op, int(fields['image_id']), vector, json.loads(fields['metadata']))
+        if op == OP_METADATA:
+            return WALRecord(_entry_version(entry_id), op, int(fields['image_id']), metadata=json.loads(fields['metadata']))
+        return WALRecord(_entry_version(entry_id), op, int(fields['image_id']))
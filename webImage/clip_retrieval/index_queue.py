@@ -0,0 +1,221 @@
+import json
+import os
+import socket
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Redis list chứa job (LPUSH khi enqueue, worker lấy từ đầu bên phải => FIFO)
+QUEUE_KEY = 'pixoria:clip_index_queue'
+# Job đang được xử lý, mỗi worker (hostname:pid) một list riêng; worker chết giữa chừng thì worker khác
+# trả các job của nó lại queue khi heartbeat hết hạn
+PROCESSING_PREFIX = 'pixoria:clip_index_queue:processing:'
+CONSUMERS_KEY = 'pixoria:clip_index_queue:consumers'
+HEARTBEAT_PREFIX = 'pixoria:clip_index_queue:alive:'
+HEARTBEAT_TTL = 5 * 60
+# Job lỗi quá MAX_ATTEMPTS lần được chuyển sang dead-letter list thay vì thử lại mãi
+DEAD_LETTER_KEY = 'pixoria:clip_index_queue:dead'
+MAX_ATTEMPTS = getattr(settings, 'CLIP_INDEX_QUEUE_MAX_ATTEMPTS', 5)
+
+# Trạng thái index của từng ảnh (pending / indexed / removed / failed)
+STATUS_TTL = 60 * 60 * 24
+
+OP_ADD = 'add'
+OP_REMOVE = 'remove'
+# Chỉ title / description đổi: cập nhật metadata trong index, không tải / encode lại ảnh
+OP_METADATA = 'metadata'
+
+
+def _redis():
+    from django_redis import get_redis_connection
+    return get_redis_connection('default')
+
+
+def _status_key(image_id):
+    return f'clip_index_status:{image_id}'
+
+
+def consumer_id():
+    """Tên của worker hiện tại trong queue (hostname:pid)"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def processing_key(consumer=None):
+    return PROCESSING_PREFIX + (consumer or consumer_id())
+
+
+def _encode(job):
+    return json.dumps({key: value for key, value in job.items() if key != 'raw'})
+
+
+def _decode(raw):
+    job = json.loads(raw)
+    job['raw'] = raw
+    return job
+
+
+def enqueue(op, image_id):
+    """Đưa một job add / remove / metadata vào queue và đánh dấu ảnh là 'pending'"""
+    job = _encode({'op': op, 'image_id': image_id, 'enqueued_at': time.time(), 'attempts': 0})
+    _redis().lpush(QUEUE_KEY, job)
+    set_status(image_id, 'pending')
+
+
+def enqueue_add(image_id):
+    enqueue(OP_ADD, image_id)
+
+
+def enqueue_remove(image_id):
+    enqueue(OP_REMOVE, image_id)
+
+
+def enqueue_metadata(image_id):
+    enqueue(OP_METADATA, image_id)
+
+
+def set_status(image_id, status):
+    cache.set(_status_key(image_id), status, STATUS_TTL)
+
+
+def get_status(image_id):
+    return cache.get(_status_key(image_id))
+
+
+def queue_length():
+    return _redis().llen(QUEUE_KEY)
+
+
+def dead_letter_length():
+    return _redis().llen(DEAD_LETTER_KEY)
+
+
+def heartbeat(consumer=None):
+    """Đánh dấu worker còn sống; job của worker không gửi heartbeat trong HEARTBEAT_TTL giây bị lấy lại"""
+    consumer = consumer or consumer_id()
+    with _redis().pipeline(transaction=False) as pipe:
+        pipe.sadd(CONSUMERS_KEY, consumer)
+        pipe.set(HEARTBEAT_PREFIX + consumer, int(time.time()), ex=HEARTBEAT_TTL)
+        pipe.execute()
+
+
+def _retry(pipe, jobs, max_attempts):
+    """Thêm lệnh trả jobs về queue (attempts + 1) vào pipe; trả về các job bị chuyển sang dead-letter"""
+    retried, dead = [], []
+    for job in jobs:
+        job = dict(job, attempts=job.get('attempts', 0) + 1)
+        (dead if job['attempts'] >= max_attempts else retried).append(_encode(job))
+    if retried:
+        # Đẩy lại vào phía được lấy ra trước, giữ nguyên thứ tự ban đầu
+        pipe.rpush(QUEUE_KEY, *reversed(retried))
+    if dead:
+        pipe.lpush(DEAD_LETTER_KEY, *dead)
+    return [json.loads(raw) for raw in dead]
+
+
+def requeue_unfinished(max_attempts=None):
+    """
+    Trả về queue các job còn trong processing list của worker đã dừng (cùng pid của lần chạy trước, hoặc
+    heartbeat đã hết hạn). Mỗi lần bị trả lại tính là một lần thử: job làm worker chết liên tục sẽ vào
+    dead-letter list.
+
+    Returns:
+        tuple: (số job được trả lại, các job bị chuyển sang dead-letter)
+    """
+    from redis.exceptions import WatchError
+
+    max_attempts = max_attempts or MAX_ATTEMPTS
+    connection = _redis()
+    current = consumer_id()
+    requeued, dead = 0, []
+    for consumer in connection.smembers(CONSUMERS_KEY):
+        consumer = consumer.decode() if isinstance(consumer, bytes) else consumer
+        if consumer != current and connection.exists(HEARTBEAT_PREFIX + consumer):
+            continue
+        key = processing_key(consumer)
+        with connection.pipeline() as pipe:
+            try:
+                # WATCH: hai worker cùng lấy lại một list thì chỉ một worker thành công
+                pipe.watch(key)
+                jobs = [_decode(raw) for raw in reversed(pipe.lrange(key, 0, -1))]
+                pipe.multi()
+                dead.extend(_retry(pipe, jobs, max_attempts))
+                pipe.delete(key)
+                if consumer != current:
+                    pipe.srem(CONSUMERS_KEY, consumer)
+                pipe.execute()
+            except WatchError:
+                continue
+        requeued += len(jobs)
+    return requeued - len(dead), dead
+
+
+def pop_batch(max_size, timeout=5, wait_ms=50):
+    """
+    Lấy tối đa max_size job: chờ tối đa timeout giây cho job đầu tiên,
+    sau đó gom thêm các job tới trong vòng wait_ms.
+
+    Job được chuyển sang processing list của worker này cho tới khi ack_batch() / retry_batch().
+    """
+    connection = _redis()
+    key = processing_key()
+    heartbeat()
+    first = connection.brpoplpush(QUEUE_KEY, key, timeout=timeout)
+    if first is None:
+        return []
+
+    raw_jobs = [first]
+    deadline = time.monotonic() + wait_ms / 1000.0
+    while len(raw_jobs) < max_size:
+        raw = connection.rpoplpush(QUEUE_KEY, key)
+        if raw is None:
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.005)
+            continue
+        raw_jobs.append(raw)
+    return [_decode(raw) for raw in raw_jobs]
+
+
+def ack_batch(jobs):
+    """Xác nhận các job đã được xử lý xong (chỉ xoá đúng các job này khỏi processing list)"""
+    key = processing_key()
+    with _redis().pipeline(transaction=True) as pipe:
+        for job in jobs:
+            pipe.lrem(key, 1, job['raw'])
+        pipe.execute()
+    heartbeat()
+
+
+def retry_batch(jobs, max_attempts=None):
+    """
+    Trả các job của một batch lỗi về queue để thử lại; job đã thử max_attempts lần vào dead-letter list.
+
+    Returns:
+        list: Các job bị chuyển sang dead-letter.
+    """
+    key = processing_key()
+    with _redis().pipeline(transaction=True) as pipe:
+        for job in jobs:
+            pipe.lrem(key, 1, job['raw'])
+        dead = _retry(pipe, jobs, max_attempts or MAX_ATTEMPTS)
+        pipe.execute()
+    return dead
+
+
+def coalesce(jobs):
+    """
+    Chỉ giữ job cuối cùng của mỗi ảnh (ví dụ add rồi remove trong cùng batch => remove).
+    Sửa metadata sau một add vẫn là add (add đọc metadata mới nhất).
+
+    Returns:
+        tuple: (ids cần add, ids cần remove, ids chỉ cần cập nhật metadata), giữ thứ tự xuất hiện.
+    """
+    last_op = {}
+    for job in jobs:
+        op = last_op.pop(job['image_id'], None)
+        last_op[job['image_id']] = OP_ADD if op == OP_ADD and job['op'] == OP_METADATA else job['op']
+    adds = [image_id for image_id, op in last_op.items() if op == OP_ADD]
+    removes = [image_id for image_id, op in last_op.items() if op == OP_REMOVE]
+    metadata_updates = [image_id for image_id, op in last_op.items() if op == OP_METADATA]
+    return adds, removes, metadata_updates
@@ -0,0 +1,292 @@
+import copy
+
+import faiss
+import numpy as np
+
+from .index_factory import _extract_hnsw, _extract_ivf, read_index, set_search_defaults
+
+
+def is_public(metadata):
+    # Chỉ ảnh public được đưa vào index, metadata cũ không có trường này
+    return not metadata or bool(metadata.get('is_public', True))
+
+
+def merge_hits(distances, indices, extra_distances, extra_indices, k):
+    """Gộp hai tập kết quả (distances, indices) theo từng dòng, giữ k kết quả gần nhất"""
+    distances = np.concatenate([distances, extra_distances], axis=1)
+    indices = np.concatenate([indices, extra_indices], axis=1)
+    order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def _overlay(base, delta):
+    """Dict base + các thay đổi trong delta (None = đã xoá)"""
+    merged = dict(base)
+    for key, value in delta.items():
+        if value is None:
+            merged.pop(key, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+class IndexSnapshot:
+    """
+    Ảnh chụp bất biến của CLIP index: vector, id / url theo vị trí FAISS, metadata, tombstone và bitmap
+    visibility. Reader lấy engine.snapshot một lần cho mỗi request và dùng nó từ đầu đến cuối, không cần lock;
+    writer tạo snapshot mới (with_adds / with_deletes / rebased) rồi gán lại tham chiếu.
+
+    FAISS index (base) không bao giờ bị sửa sau khi publish. Vector thêm sau đó nằm trong delta nhỏ được
+    search chính xác bằng numpy, cho tới khi được gộp vào một bản sao của base (folded_index + rebased).
+    Id / metadata theo id cũng chia thành dict base (dùng chung giữa các snapshot) và delta nhỏ được copy
+    mỗi lần ghi, nên chi phí ghi chỉ tỉ lệ với delta (cộng một lần copy các mảng bool / int64 theo vị trí).
+    """
+
+    def __init__(self, index, embeddings, image_ids, image_urls, metadata_by_id, tombstones=(), index_info=None,
+                 version=0, source_path=None):
+        """
+        Args:
+            index: FAISS index chứa vector của mọi vị trí (snapshot mới chưa có delta).
+            embeddings (VectorStore): Vector full-precision theo vị trí.
+            image_ids (list): Id ảnh theo vị trí FAISS (kể cả vị trí đã tombstone).
+            image_urls (list): URL ảnh theo vị trí.
+            metadata_by_id (dict): Metadata theo id ảnh.
+            tombstones (iterable): Vị trí đã xoá nhưng vector còn nằm trong index.
+            source_path (str): File index đang được memory-map (None nếu index nằm trong bộ nhớ riêng).
+        """
+        self.index = index
+        self.base_size = index.ntotal
+        self.embeddings = embeddings
+        self.delta_vectors = np.empty((0, index.d), dtype='float32')
+        self.index_info = index_info or {}
+        self.version = version
+        self.source_path = source_path
+
+        self.ids = np.asarray(image_ids, dtype='int64')
+        self._urls = list(image_urls)
+        self._delta_urls = ()
+        self.dead = np.zeros(len(self.ids), dtype=bool)
+        self.dead[[pos for pos in tombstones if pos < len(self.ids)]] = True
+
+        self._positions = {
+            image_id: pos for pos, image_id in enumerate(self.ids.tolist()) if not self.dead[pos]
+        }
+        self._delta_positions = {}
+        self._metadata = metadata_by_id
+        self._delta_metadata = {}
+
+        # Visibility bitmap: live public vectors, plus the private (owner-visible) positions of each user
+        self.public_mask = np.zeros(len(self.ids), dtype=bool)
+        private_by_owner = {}
+        for image_id, pos in self._positions.items():
+            metadata = metadata_by_id.get(image_id)
+            if is_public(metadata):
+                self.public_mask[pos] = True
+            elif metadata.get('user_id') is not None:
+                private_by_owner.setdefault(metadata['user_id'], set()).add(pos)
+        self.private_by_owner = {owner: frozenset(positions) for owner, positions in private_by_owner.items()}
+        self._public_bitmap = None
+
+    @property
+    def size(self):
+        """Số vị trí (base + delta, kể cả tombstone)"""
+        return len(self.ids)
+
+    @property
+    def delta_size(self):
+        return self.size - self.base_size
+
+    @property
+    def tombstone_count(self):
+        return int(self.dead.sum())
+
+    @property
+    def mmapped(self):
+        return self.source_path is not None
+
+    # --- Đọc ---
+
+    def position_of(self, image_id):
+        """Vị trí FAISS của vector còn sống của ảnh, hoặc None"""
+        if image_id in self._delta_positions:
+            return self._delta_positions[image_id]
+        return self._positions.get(image_id)
+
+    def contains(self, image_id):
+        return self.position_of(image_id) is not None
+
+    def metadata(self, image_id):
+        if image_id in self._delta_metadata:
+            return self._delta_metadata[image_id]
+        return self._metadata.get(image_id)
+
+    def all_metadata(self):
+        return _overlay(self._metadata, self._delta_metadata)
+
+    def image_urls(self):
+        return self._urls + list(self._delta_urls)
+
+    def live_ids(self):
+        return self.ids[~self.dead]
+
+    def image_ids_at(self, positions):
+        """Id ảnh tại các vị trí FAISS (cùng shape); -1 với vị trí không hợp lệ hoặc đã tombstone"""
+        positions = np.asarray(positions, dtype='int64')
+        if not self.size:
+            return np.full(positions.shape, -1, dtype='int64')
+        valid = (positions >= 0) & (positions < self.size)
+        safe = np.where(valid, positions, 0)
+        return np.where(valid & ~self.dead[safe], self.ids[safe], -1)
+
+    def visibility(self, viewer_id=None):
+        """
+        Returns:
+            tuple: (mask, packed bitmap, số vị trí hợp lệ) cho người xem: ảnh public + ảnh private của chính họ
+        """
+        public_bitmap = self._public_bitmap
+        if public_bitmap is None:
+            # Hai reader có thể cùng tính lần đầu: kết quả giống nhau, gán tham chiếu là atomic
+            mask = self.public_mask
+            public_bitmap = self._public_bitmap = (mask, np.packbits(mask, bitorder='little'), int(mask.sum()))
+        owned = self.private_by_owner.get(viewer_id) if viewer_id is not None else None
+        if not owned:
+            return public_bitmap
+        mask = self.public_mask.copy()
+        mask[list(owned)] = True
+        return mask, np.packbits(mask, bitorder='little'), int(mask.sum())
+
+    def has_private(self, viewer_id):
+        """Người xem có ảnh private trong index => kết quả khác với danh sách public dùng chung"""
+        return viewer_id is not None and bool(self.private_by_owner.get(viewer_id))
+
+    # --- Ghi: trả về snapshot mới, snapshot hiện tại không đổi ---
+
+    def _derive(self, version):
+        snapshot = copy.copy(self)
+        snapshot.version = version
+        snapshot._public_bitmap = None
+        return snapshot
+
+    @staticmethod
+    def _set_visible(snapshot, pos, metadata, visible):
+        if is_public(metadata):
+            snapshot.public_mask[pos] = visible
+        else:
+            owner = metadata.get('user_id')
+            owned = snapshot.private_by_owner.get(owner, frozenset())
+            snapshot.private_by_owner[owner] = owned | {pos} if visible else owned - {pos}
+
+    def _prepare_write(self, version, grow=0):
+        snapshot = self._derive(version)
+        snapshot.dead = np.concatenate([self.dead, np.zeros(grow, dtype=bool)])
+        snapshot.public_mask = np.concatenate([self.public_mask, np.zeros(grow, dtype=bool)])
+        snapshot.private_by_owner = dict(self.private_by_owner)
+        snapshot._delta_positions = dict(self._delta_positions)
+        snapshot._delta_metadata = dict(self._delta_metadata)
+        return snapshot
+
+    def with_adds(self, image_ids, embeddings, metadatas, version):
+        """Snapshot có thêm các vector ở cuối (đánh index lại một ảnh sẽ tombstone vector cũ của nó)"""
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32').reshape(len(image_ids), -1)
+        start = self.size
+        snapshot = self._prepare_write(version, grow=len(image_ids))
+        snapshot.ids = np.concatenate([self.ids, np.asarray(image_ids, dtype='int64')])
+        snapshot.delta_vectors = np.concatenate([self.delta_vectors, embeddings])
+        snapshot.embeddings = self.embeddings.appended(embeddings)
+        snapshot._delta_urls = self._delta_urls + tuple(metadata.get('file') for metadata in metadatas)
+
+        for offset, (image_id, metadata) in enumerate(zip(image_ids, metadatas)):
+            old_position = snapshot.position_of(image_id)
+            if old_position is not None:
+                snapshot.dead[old_position] = True
+                self._set_visible(snapshot, old_position, snapshot.metadata(image_id), False)
+            snapshot._delta_positions[image_id] = start + offset
+            snapshot._delta_metadata[image_id] = metadata
+            self._set_visible(snapshot, start + offset, metadata, True)
+        return snapshot
+
+    def with_deletes(self, image_ids, version):
+        """
+        Returns:
+            tuple: (snapshot mới, danh sách id thực sự có trong index)
+        """
+        removed = [image_id for image_id in image_ids if self.contains(image_id)]
+        if not removed:
+            return self, []
+        snapshot = self._prepare_write(version)
+        for image_id in removed:
+            position = snapshot.position_of(image_id)
+            if position is None:
+                continue
+            snapshot.dead[position] = True
+            self._set_visible(snapshot, position, snapshot.metadata(image_id), False)
+            snapshot._delta_positions[image_id] = None
+            snapshot._delta_metadata[image_id] = None
+        return snapshot, removed
+
+    def with_metadata(self, image_ids, metadatas, version):
+        """
+        Snapshot với metadata mới cho các ảnh đã có trong index (vector và vị trí giữ nguyên).
+
+        Returns:
+            tuple: (snapshot mới, danh sách id thực sự có trong index)
+        """
+        updated = [(image_id, metadata) for image_id, metadata in zip(image_ids, metadatas) if self.contains(image_id)]
+        if not updated:
+            return self, []
+        snapshot = self._prepare_write(version)
+        for image_id, metadata in updated:
+            position = snapshot.position_of(image_id)
+            self._set_visible(snapshot, position, snapshot.metadata(image_id), False)
+            snapshot._delta_metadata[image_id] = metadata
+            self._set_visible(snapshot, position, metadata, True)
+        return snapshot, [image_id for image_id, _ in updated]
+
+    def with_embeddings(self, embeddings):
+        """Cùng dữ liệu, vector full-precision đọc từ nguồn khác (ví dụ file vừa ghi)"""
+        snapshot = self._derive(self.version)
+        snapshot.embeddings = embeddings
+        return snapshot
+
+    def folded_index(self):
+        """
+        Bản sao của base index đã thêm toàn bộ delta (chạy được song song với search trên snapshot này).
+        Index memory-map không copy được (inverted lists của IVF) thì đọc lại file gốc vào bộ nhớ.
+        """
+        try:
+            index = faiss.clone_index(self.index)
+        except RuntimeError:
+            if self.source_path is None:
+                raise
+            index = read_index(self.source_path)
+            set_search_defaults(index, *_search_defaults(self.index))
+        if self.delta_size:
+            index.add(self.delta_vectors)
+        return index
+
+    def rebased(self, index, index_info=None):
+        """
+        Snapshot dùng index (chứa vector của các vị trí [0, index.ntotal) của snapshot này) làm base mới;
+        vị trí sau đó vẫn ở trong delta. Id / metadata được gộp lại thành dict base.
+        """
+        size = index.ntotal
+        snapshot = self._derive(self.version)
+        snapshot.index = index
+        snapshot.base_size = size
+        snapshot.index_info = index_info or self.index_info
+        snapshot.source_path = None
+        snapshot.delta_vectors = self.delta_vectors[size - self.base_size:]
+        urls = self.image_urls()
+        snapshot._urls, snapshot._delta_urls = urls[:size], tuple(urls[size:])
+        snapshot._positions = _overlay(self._positions, self._delta_positions)
+        snapshot._delta_positions = {}
+        snapshot._metadata = self.all_metadata()
+        snapshot._delta_metadata = {}
+        return snapshot
+
+
+def _search_defaults(index):
+    """(nprobe, efSearch) hiện tại của index để áp lại cho bản sao"""
+    ivf = _extract_ivf(index)
+    hnsw = _extract_hnsw(index)
+    return (ivf.nprobe if ivf is not None else None), (hnsw.hnsw.efSearch if hnsw is not None else None)
@@ -0,0 +1,241 @@
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Số posting mới được gom trong delta trước khi gộp vào mảng CSR
+MERGE_THRESHOLD = 20000
+
+
+def tokenize(text):
+    """Tách từ, chuyển chữ thường và bỏ dấu tiếng Việt ("Hà Nội" và "ha noi" cho cùng token)"""
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', str(text).lower()).replace('đ', 'd')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return _TOKEN_RE.findall(text)
+
+
+class LexicalIndex:
+    """
+    Inverted index BM25 trên title / description của ảnh.
+
+    Postings nằm trong mảng CSR (offsets + doc + tf) gọn trong bộ nhớ; tài liệu thêm sau được gom
+    trong delta nhỏ rồi gộp định kỳ. Xoá chỉ đánh dấu doc là không còn sống, lần gộp sau bỏ hẳn.
+    Mỗi doc mang cờ public + owner để lọc visibility giống index vector.
+    """
+
+    def __init__(self, k1=1.2, b=0.75, title_weight=2.0):
+        self.k1 = k1
+        self.b = b
+        self.title_weight = title_weight
+        self.vocab = {}
+        self._offsets = np.zeros(1, dtype='int64')
+        self._docs = np.empty(0, dtype='int32')
+        self._tfs = np.empty(0, dtype='float32')
+        self._delta = {}
+        self._delta_size = 0
+
+        self._num_docs = 0
+        self._image_ids = np.empty(0, dtype='int64')
+        self._doc_len = np.empty(0, dtype='float32')
+        self._live = np.empty(0, dtype=bool)
+        self._public = np.empty(0, dtype=bool)
+        self._owner = np.empty(0, dtype='int64')
+        self._doc_by_image = {}
+        self._total_len = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_metadata(cls, metadatas, **kwargs):
+        index = cls(**kwargs)
+        for metadata in metadatas:
+            index.add(metadata['id'], metadata, merge=False)
+        index.merge()
+        return index
+
+    def __len__(self):
+        return len(self._doc_by_image)
+
+    def _term_frequencies(self, metadata):
+        tf = Counter()
+        for token in tokenize(metadata.get('title')):
+            tf[token] += self.title_weight
+        for token in tokenize(metadata.get('description')):
+            tf[token] += 1.0
+        return tf
+
+    def add(self, image_id, metadata, merge=True):
+        """Thêm (hoặc thay thế) tài liệu của một ảnh"""
+        with self._lock:
+            self._remove(image_id)
+            tf = self._term_frequencies(metadata)
+
+            doc = self._num_docs
+            self._reserve(doc + 1)
+            self._num_docs += 1
+            self._image_ids[doc] = image_id
+            self._doc_len[doc] = sum(tf.values())
+            self._live[doc] = True
+            self._public[doc] = bool(metadata.get('is_public', True))
+            owner = metadata.get('user_id')
+            self._owner[doc] = -1 if owner is None else int(owner)
+            self._doc_by_image[image_id] = doc
+            self._total_len += self._doc_len[doc]
+
+            for term, frequency in tf.items():
+                term_id = self.vocab.setdefault(term, len(self.vocab))
+                docs, tfs = self._delta.setdefault(term_id, ([], []))
+                docs.append(doc)
+                tfs.append(frequency)
+            self._delta_size += len(tf)
+
+            if merge and self._delta_size >= MERGE_THRESHOLD:
+                self._merge()
+
+    def remove(self, image_id):
+        with self._lock:
+            return self._remove(image_id)
+
+    def _remove(self, image_id):
+        doc = self._doc_by_image.pop(image_id, None)
+        if doc is None:
+            return False
+        self._live[doc] = False
+        self._total_len -= self._doc_len[doc]
+        return True
+
+    def _reserve(self, size):
+        """Tăng dung lượng các mảng theo doc (nhân đôi)"""
+        capacity = len(self._image_ids)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2, 1024)
+        for name in ('_image_ids', '_doc_len', '_live', '_public', '_owner'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def merge(self):
+        with self._lock:
+            self._merge()
+
+    def _merge(self):
+        """Gộp delta vào mảng CSR, bỏ posting của doc đã xoá và đánh số lại doc"""
+        num_terms = len(self.vocab)
+        base_terms = np.repeat(np.arange(len(self._offsets) - 1, dtype='int64'), np.diff(self._offsets))
+        delta_terms = [np.full(len(docs), term_id, dtype='int64') for term_id, (docs, _) in self._delta.items()]
+        delta_docs = [np.asarray(docs, dtype='int32') for docs, _ in self._delta.values()]
+        delta_tfs = [np.asarray(tfs, dtype='float32') for _, tfs in self._delta.values()]
+        terms = np.concatenate([base_terms] + delta_terms)
+        docs = np.concatenate([self._docs] + delta_docs)
+        tfs = np.concatenate([self._tfs] + delta_tfs)
+
+        live = self._live[:self._num_docs]
+        keep = live[docs]
+        terms, docs, tfs = terms[keep], docs[keep], tfs[keep]
+
+        # Đánh số lại doc còn sống liên tục từ 0
+        renumber = np.cumsum(live) - 1
+        docs = renumber[docs].astype('int32')
+        live_docs = np.flatnonzero(live)
+        for name in ('_image_ids', '_doc_len', '_live', '_public', '_owner'):
+            setattr(self, name, getattr(self, name)[live_docs].copy())
+        self._num_docs = len(live_docs)
+        self._doc_by_image = {int(image_id): doc for doc, image_id in enumerate(self._image_ids)}
+
+        order = np.argsort(terms, kind='stable')
+        self._docs = docs[order]
+        self._tfs = tfs[order]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=num_terms))]).astype('int64')
+        self._delta = {}
+        self._delta_size = 0
+
+    def _postings(self, term_id):
+        if term_id + 1 < len(self._offsets):
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            docs, tfs = self._docs[start:end], self._tfs[start:end]
+        else:
+            # Từ mới xuất hiện sau lần gộp gần nhất: chỉ có trong delta
+            docs, tfs = self._docs[:0], self._tfs[:0]
+        delta = self._delta.get(term_id)
+        if delta is not None:
+            docs = np.concatenate([docs, np.asarray(delta[0], dtype='int32')])
+            tfs = np.concatenate([tfs, np.asarray(delta[1], dtype='float32')])
+        return docs, tfs
+
+    def search(self, query_text, top_k=12, viewer_id=None):
+        """
+        Xếp hạng BM25 các ảnh người xem được thấy (public hoặc của chính họ).
+
+        Returns:
+            tuple: (image_ids, scores) giảm dần theo điểm, chỉ gồm ảnh khớp ít nhất một từ.
+        """
+        term_ids = [self.vocab[term] for term in dict.fromkeys(tokenize(query_text)) if term in self.vocab]
+        with self._lock:
+            num_live = len(self._doc_by_image)
+            if not term_ids or not num_live:
+                return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+            num_docs = self._num_docs
+            live = self._live[:num_docs]
+            avg_len = self._total_len / num_live
+
+            all_docs = []
+            all_weights = []
+            for term_id in term_ids:
+                docs, tfs = self._postings(term_id)
+                alive = live[docs]
+                docs, tfs = docs[alive], tfs[alive]
+                if not len(docs):
+                    continue
+                idf = math.log(1.0 + (num_live - len(docs) + 0.5) / (len(docs) + 0.5))
+                norm = self.k1 * (1.0 - self.b + self.b * self._doc_len[docs] / avg_len)
+                all_docs.append(docs)
+                all_weights.append(idf * tfs * (self.k1 + 1.0) / (tfs + norm))
+            if not all_docs:
+                return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+
+            scores = np.bincount(np.concatenate(all_docs), weights=np.concatenate(all_weights), minlength=num_docs)
+            eligible = self._public[:num_docs].copy()
+            if viewer_id is not None:
+                eligible |= self._owner[:num_docs] == int(viewer_id)
+            scores[~(eligible & live)] = 0.0
+
+            candidates = np.flatnonzero(scores > 0)
+            if len(candidates) > top_k:
+                candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+            candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+            return self._image_ids[candidates].copy(), scores[candidates].astype('float32')
+
+
+def fuse_scores(vector_ids, vector_scores, lexical_ids, lexical_scores, vector_weight=0.5):
+    """
+    Trộn xếp hạng CLIP và BM25: điểm CLIP được chuẩn hoá min-max trên danh sách ứng viên,
+    điểm BM25 chia cho điểm cao nhất, rồi cộng có trọng số theo image id.
+
+    Returns:
+        tuple: (image_ids, scores) giảm dần theo điểm đã trộn.
+    """
+    ids = np.concatenate([np.asarray(vector_ids, dtype='int64'), np.asarray(lexical_ids, dtype='int64')])
+    if not len(ids):
+        return ids, np.empty(0, dtype='float32')
+
+    vector_scores = np.asarray(vector_scores, dtype='float64')
+    if len(vector_scores):
+        spread = vector_scores.max() - vector_scores.min()
+        vector_scores = (vector_scores - vector_scores.min()) / spread if spread > 0 else np.ones_like(vector_scores)
+    lexical_scores = np.asarray(lexical_scores, dtype='float64')
+    if len(lexical_scores):
+        lexical_scores = lexical_scores / lexical_scores.max()
+
+    weights = np.concatenate([vector_scores * vector_weight, lexical_scores * (1.0 - vector_weight)])
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    fused = np.bincount(inverse, weights=weights, minlength=len(unique_ids))
+    order = np.argsort(-fused, kind='stable')
+    return unique_ids[order], fused[order].astype('float32')
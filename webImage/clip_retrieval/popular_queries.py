@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import cache
+
+from .query_cache import normalize_query
+
+# Redis sorted set: member = truy vấn đã chuẩn hoá, score = số lần tìm (có suy giảm theo thời gian)
+POPULAR_QUERIES_KEY = 'clip_popular_queries'
+
+# Truy vấn dài hơn không được theo dõi (giới hạn kích thước key trong Redis)
+MAX_QUERY_LENGTH = 200
+
+# Khi trọng số 2 ** (tuổi / half_life) vượt 2 ** RESCALE_EXPONENT, toàn bộ score được chia lại về mốc mới
+RESCALE_EXPONENT = 32
+
+
+def _redis():
+    from django_redis import get_redis_connection
+    return get_redis_connection('default')
+
+
+class PopularQueryTracker:
+    """
+    Đếm tần suất truy vấn văn bản trong một Redis sorted set với suy giảm theo thời gian (forward decay):
+    mỗi lần tìm cộng 2 ** ((now - landmark) / half_life), nên score chia cho trọng số hiện tại bằng
+    số lần tìm gần đây, lượt tìm cách đây một half_life chỉ tính một nửa.
+    Lượt tìm được gom trong process và ghi vào Redis mỗi flush_interval giây (một pipeline).
+    """
+
+    def __init__(self, half_life=6 * 60 * 60, max_size=10000, flush_interval=1.0, key=POPULAR_QUERIES_KEY):
+        """
+        Args:
+            half_life (float): Sau half_life giây một lượt tìm chỉ còn được tính một nửa.
+            max_size (int): Số truy vấn tối đa giữ trong sorted set (các truy vấn ít phổ biến nhất bị bỏ).
+            flush_interval (float): Khoảng thời gian (giây) giữa hai lần ghi lượt tìm vào Redis.
+        """
+        self.half_life = float(half_life)
+        self.max_size = max(int(max_size), 1)
+        self.flush_interval = flush_interval
+        self.key = key
+        self.landmark_key = f'{key}:landmark'
+
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, query_text):
+        """Ghi nhận một lượt tìm (không gọi Redis trên request path trừ khi đến lúc flush)"""
+        normalized = normalize_query(query_text or '')
+        if not normalized or len(normalized) > MAX_QUERY_LENGTH:
+            return
+        with self._lock:
+            self._pending[normalized] += 1
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def _weight(self, landmark, now):
+        return 2.0 ** ((now - landmark) / self.half_life)
+
+    def flush(self):
+        """Ghi các lượt tìm đang gom vào Redis (ZINCRBY trong một transaction)"""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+
+        from redis.exceptions import WatchError
+
+        try:
+            with _redis().pipeline() as pipe:
+                for _ in range(3):
+                    try:
+                        # WATCH landmark: lượt ghi của worker khác đang rescale sẽ được thử lại với mốc mới
+                        pipe.watch(self.landmark_key)
+                        now = time.time()
+                        landmark = pipe.get(self.landmark_key)
+                        landmark = float(landmark) if landmark is not None else now
+                        pipe.multi()
+                        if (now - landmark) / self.half_life > RESCALE_EXPONENT:
+                            pipe.zunionstore(self.key, {self.key: 1.0 / self._weight(landmark, now)})
+                            landmark = now
+                        pipe.set(self.landmark_key, landmark)
+                        weight = self._weight(landmark, now)
+                        for query, count in pending.items():
+                            pipe.zincrby(self.key, count * weight, query)
+                        # Chỉ giữ max_size truy vấn phổ biến nhất
+                        pipe.zremrangebyrank(self.key, 0, -self.max_size - 1)
+                        pipe.execute()
+                        return
+                    except WatchError:
+                        continue
+        except Exception as e:
+            print(f"⚠️ Không ghi được thống kê truy vấn phổ biến: {e}")
+
+    def top(self, limit=100):
+        """
+        Truy vấn phổ biến nhất hiện tại.
+
+        Returns:
+            list: [(query, score)] theo score giảm dần; score ~ số lượt tìm gần đây (đã suy giảm).
+        """
+        connection = _redis()
+        landmark = connection.get(self.landmark_key)
+        entries = connection.zrevrange(self.key, 0, max(int(limit), 1) - 1, withscores=True)
+        if not entries:
+            return []
+        weight = self._weight(float(landmark) if landmark is not None else time.time(), time.time())
+        return [(query.decode() if isinstance(query, bytes) else query, score / weight) for query, score in entries]
+
+
+class PopularQueryRefresher:
+    """
+    Luồng nền tính trước kết quả cho top_n truy vấn phổ biến mỗi khi thế hệ cache tìm kiếm đổi (index thay đổi)
+    hoặc sau refresh_every giây, để các truy vấn này gần như không bao giờ chạy model trên request path.
+    Mỗi lượt làm mới chỉ một worker chạy (marker trong Redis theo thế hệ).
+    """
+
+    def __init__(self, tracker, generation, warm, top_n=100, interval=5.0, refresh_every=60 * 60):
+        """
+        Args:
+            tracker (PopularQueryTracker): Nguồn truy vấn phổ biến.
+            generation (CacheGeneration): Thế hệ của cache kết quả tìm kiếm.
+            warm (callable): warm(query) -> bool, tính và cache kết quả; False = đang quá tải, thử lại sau.
+            interval (float): Khoảng thời gian (giây) giữa hai lần kiểm tra thế hệ.
+            refresh_every (float): Làm mới cả khi thế hệ không đổi, trước khi kết quả đã cache bị coi là cũ.
+        """
+        self.tracker = tracker
+        self.generation = generation
+        self.warm = warm
+        self.top_n = top_n
+        self.interval = interval
+        self.refresh_every = max(int(refresh_every), 1)
+
+        self._warmed = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._warmed_queries = 0
+        self._deferred = 0
+        self._last_run = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='clip-popular-queries', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tracker.flush()
+                self.refresh()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi làm mới truy vấn phổ biến: {e}")
+
+    def refresh(self):
+        """Làm mới kết quả của top_n truy vấn nếu thế hệ (hoặc chu kỳ refresh_every) đã đổi; trả về số truy vấn"""
+        generation = self.generation.current()
+        round_key = (generation, int(time.time() // self.refresh_every))
+        if round_key == self._warmed:
+            return 0
+
+        marker = f'clip_popular_refresh:g{generation}:{round_key[1]}'
+        if not cache.add(marker, 1, self.refresh_every):
+            # Worker khác đã (hoặc đang) làm mới thế hệ này
+            self._warmed = round_key
+            return 0
+
+        started = time.monotonic()
+        warmed = 0
+        for query, _ in self.tracker.top(self.top_n):
+            if not self.warm(query):
+                # Executor đang bận với request của người dùng: nhường và thử lại ở lần kiểm tra sau
+                cache.delete(marker)
+                with self._lock:
+                    self._deferred += 1
+                    self._warmed_queries += warmed
+                return warmed
+            warmed += 1
+
+        self._warmed = round_key
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._runs += 1
+            self._warmed_queries += warmed
+            self._last_run = {'generation': generation, 'queries': warmed, 'seconds': round(elapsed, 3),
+                              'at': time.time()}
+        print(f"🔥 Đã tính trước kết quả cho {warmed} truy vấn phổ biến (thế hệ {generation}, {elapsed:.1f}s)")
+        return warmed
+
+    def get_metrics(self):
+        with self._lock:
+            return {
+                'top_n': self.top_n,
+                'runs': self._runs,
+                'warmed_queries': self._warmed_queries,
+                'deferred': self._deferred,
+                'last_run': self._last_run,
+            }
@@ -0,0 +1,371 @@
+import base64
+import binascii
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import numpy as np
+from django.core.cache import cache
+
+# Embedding của truy vấn chỉ phụ thuộc vào model, nên có thể giữ lâu (7 ngày)
+EMBEDDING_CACHE_TTL = 60 * 60 * 24 * 7
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Khoảng thời gian giữa hai lần kiểm tra kết quả của worker đang giữ lock (giây)
+SINGLE_FLIGHT_POLL = 0.02
+
+
+def normalize_query(query_text):
+    """Chuẩn hoá truy vấn: bỏ khoảng trắng thừa và chuyển về chữ thường (CLIP tokenizer cũng lowercase)"""
+    return _WHITESPACE_RE.sub(' ', str(query_text)).strip().lower()
+
+
+def query_hash(query_text):
+    """Hash ổn định của truy vấn đã chuẩn hoá, dùng làm cache key"""
+    return hashlib.sha1(normalize_query(query_text).encode('utf-8')).hexdigest()
+
+
+class QueryEmbeddingCache:
+    """
+    Cache hai tầng cho embedding của truy vấn văn bản:
+    LRU trong process + Redis (lưu dạng float16 bytes).
+    """
+
+    def __init__(self, max_entries=1024, ttl=EMBEDDING_CACHE_TTL, prefix='clip_query_emb'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, digest):
+        return f'{self.prefix}:{digest}'
+
+    def get(self, digest):
+        """Trả về vector float32 hoặc None nếu chưa có trong cache"""
+        with self._lock:
+            vector = self._lru.get(digest)
+            if vector is not None:
+                self._lru.move_to_end(digest)
+                return vector
+
+        try:
+            raw = cache.get(self._key(digest))
+        except Exception as e:
+            print(f"Redis error reading query embedding: {e}")
+            raw = None
+        if raw is None:
+            return None
+
+        vector = np.frombuffer(raw, dtype='<f2').astype('float32')
+        self._remember(digest, vector)
+        return vector
+
+    def set(self, digest, vector):
+        vector = np.asarray(vector, dtype='float32').reshape(-1)
+        self._remember(digest, vector)
+        try:
+            cache.set(self._key(digest), vector.astype('<f2').tobytes(), self.ttl)
+        except Exception as e:
+            print(f"Redis error storing query embedding: {e}")
+
+    def _remember(self, digest, vector):
+        with self._lock:
+            self._lru[digest] = vector
+            self._lru.move_to_end(digest)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+
+class CacheGeneration:
+    """
+    Số thế hệ (generation) của một nhóm cache phụ thuộc vào index, lưu trong Redis.
+    Key của cache được gắn số thế hệ hiện tại: invalidate cả nhóm chỉ là một lệnh INCR (không SCAN keyspace),
+    các entry của thế hệ cũ không còn được đọc tới và tự hết hạn theo TTL.
+    """
+
+    def __init__(self, name, prefix='cache_generation'):
+        self.name = name
+        self.prefix = prefix
+
+    def _key(self):
+        return f'{self.prefix}:{self.name}'
+
+    def current(self):
+        """Thế hệ hiện tại; đọc trước khi tính kết quả và dùng lại đúng giá trị đó khi ghi cache"""
+        generation = cache.get(self._key())
+        if generation is None:
+            self._initialize()
+            generation = cache.get(self._key())
+        return int(generation)
+
+    def bump(self):
+        """Invalidate mọi entry của nhóm: một lệnh INCR"""
+        try:
+            return cache.incr(self._key())
+        except ValueError:
+            self._initialize()
+            return cache.incr(self._key())
+
+    def _initialize(self):
+        # Key bị mất (Redis restart / eviction) trong khi entry cũ có thể còn: bắt đầu từ mốc thời gian (µs)
+        # để không quay lại một thế hệ đã dùng
+        cache.add(self._key(), int(time.time() * 1000000), timeout=None)
+
+    @staticmethod
+    def key(generation, name, *parts):
+        """Key cache thuộc thế hệ generation, ví dụ key(g, 'clip_image_search', url, top_k)"""
+        return ':'.join([name, f'g{generation}'] + [str(part) for part in parts])
+
+
+class SingleFlightCache:
+    """
+    Cache kết quả tìm kiếm chống stampede:
+    - single-flight: khi entry chưa có, chỉ một request (trên mọi worker, nhờ lock ngắn trong Redis) tính kết quả,
+      các request khác chờ và dùng lại kết quả đó;
+    - stale-while-revalidate: entry quá soft_ttl vẫn được trả ngay, đồng thời một lần làm mới chạy nền.
+    Entry được lưu dạng (value, fresh_until) với TTL cứng ttl.
+    """
+
+    def __init__(self, ttl, soft_ttl=None, lock_ttl=10, wait=5.0, background=None):
+        """
+        Args:
+            ttl (int): TTL cứng (giây) của entry trong Redis.
+            soft_ttl (int): Sau soft_ttl giây entry bị coi là cũ và được làm mới nền (None = bằng ttl).
+            lock_ttl (int): TTL của lock tính toán, để lock của worker bị chết tự hết hạn.
+            wait (float): Thời gian tối đa chờ worker đang giữ lock; quá hạn thì tự tính.
+            background (callable): background(fn) chạy fn ở nền, trả về falsy nếu không còn chỗ (bỏ qua).
+        """
+        self.ttl = ttl
+        self.soft_ttl = min(soft_ttl or ttl, ttl)
+        self.lock_ttl = lock_ttl
+        self.wait = wait
+        self.background = background or self._run_in_thread
+
+        # Request cùng process chờ trên Future thay vì poll Redis
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(('hits', 'stale_hits', 'misses', 'coalesced', 'refreshes', 'lock_timeouts'), 0)
+
+    @staticmethod
+    def _run_in_thread(fn):
+        threading.Thread(target=fn, name='search-cache-refresh', daemon=True).start()
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+    def get_or_compute(self, key, compute, accept=None):
+        """
+        Giá trị đã cache của key, hoặc compute() (chỉ một lần cho mọi request đồng thời).
+
+        Args:
+            accept (callable): accept(value) -> bool, False nếu entry đã cache không dùng được
+                (ví dụ danh sách xếp hạng chưa đủ sâu).
+        """
+        entry = cache.get(key)
+        if entry is not None and (accept is None or accept(entry[0])):
+            value, fresh_until = entry
+            if time.time() < fresh_until:
+                self._count('hits')
+                return value
+            self._count('stale_hits')
+            self._refresh(key, compute)
+            return value
+        return self._compute_once(key, compute, accept)
+
+    def _write(self, key, value):
+        cache.set(key, (value, time.time() + self.soft_ttl), self.ttl)
+
+    def _acquire(self, lock_key):
+        token = uuid.uuid4().hex
+        return token if cache.add(lock_key, token, self.lock_ttl) else None
+
+    def _release(self, lock_key, token):
+        try:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+        except Exception as e:
+            print(f"Redis error releasing search cache lock: {e}")
+
+    def _refresh(self, key, compute):
+        """Làm mới entry cũ ở nền; lock bảo đảm chỉ một worker làm mới"""
+        lock_key = f'{key}:lock'
+        token = self._acquire(lock_key)
+        if token is None:
+            return
+
+        def refresh():
+            try:
+                self._write(key, compute())
+                self._count('refreshes')
+            except Exception as e:
+                print(f"Error refreshing search cache entry {key}: {e}")
+            finally:
+                self._release(lock_key, token)
+
+        if not self.background(refresh):
+            self._release(lock_key, token)
+
+    def _compute_once(self, key, compute, accept):
+        with self._lock:
+            flight = self._flights.get(key)
+            owner = flight is None
+            if owner:
+                flight = self._flights[key] = Future()
+
+        if not owner:
+            self._count('coalesced')
+            try:
+                value = flight.result(timeout=self.wait)
+            except FutureTimeoutError:
+                self._count('lock_timeouts')
+                return compute()
+            return value if accept is None or accept(value) else compute()
+
+        try:
+            value = self._compute_locked(key, compute, accept)
+            flight.set_result(value)
+            return value
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    def _compute_locked(self, key, compute, accept):
+        lock_key = f'{key}:lock'
+        deadline = time.monotonic() + self.wait
+        while True:
+            token = self._acquire(lock_key)
+            if token is not None:
+                try:
+                    self._count('misses')
+                    value = compute()
+                    self._write(key, value)
+                    return value
+                finally:
+                    self._release(lock_key, token)
+
+            # Worker khác đang tính cùng key: chờ kết quả của nó
+            time.sleep(SINGLE_FLIGHT_POLL)
+            entry = cache.get(key)
+            if entry is not None and (accept is None or accept(entry[0])):
+                self._count('coalesced')
+                return entry[0]
+            if time.monotonic() >= deadline:
+                # Worker giữ lock quá chậm (hoặc đã chết): tự tính thay vì chờ tiếp
+                self._count('lock_timeouts')
+                value = compute()
+                self._write(key, value)
+                return value
+
+    def get_metrics(self):
+        with self._lock:
+            return dict(self._counts, in_flight=len(self._flights))
+
+
+class RankedResultCache:
+    """
+    Cache danh sách xếp hạng (image_id, score) của một truy vấn.
+    Mọi top_k nhỏ hơn hoặc bằng độ sâu đã lưu đều được phục vụ bằng cách cắt mảng.
+    Entry thuộc một thế hệ của index (CacheGeneration), không cần xoá khi index thay đổi.
+    """
+
+    def __init__(self, ttl, soft_ttl=None, prefix='clip_text_rank', **options):
+        self.prefix = prefix
+        self.entries = SingleFlightCache(ttl, soft_ttl, **options)
+
+    def _key(self, digest, generation):
+        return f'{self.prefix}:g{generation}:{digest}'
+
+    def get_or_rank(self, digest, top_k, generation, rank_fn):
+        """
+        (ids, scores) đã cắt theo top_k, từ cache hoặc từ rank_fn() -> (ids, scores, complete)
+        (một lần cho mọi request đồng thời của cùng truy vấn).
+        """
+        def compute():
+            ids, scores, complete = rank_fn()
+            return (
+                np.asarray(ids, dtype='<i8').tobytes(),
+                np.asarray(scores, dtype='<f4').tobytes(),
+                bool(complete),
+            )
+
+        def deep_enough(entry):
+            # complete=True: index có ít ảnh hơn độ sâu yêu cầu, danh sách đã đầy đủ
+            ids_bytes, _, complete = entry
+            return complete or len(ids_bytes) // 8 >= top_k
+
+        ids_bytes, scores_bytes, _ = self.entries.get_or_compute(self._key(digest, generation), compute, deep_enough)
+        ids = np.frombuffer(ids_bytes, dtype='<i8')
+        scores = np.frombuffer(scores_bytes, dtype='<f4')
+        return ids[:top_k], scores[:top_k]
+
+
+def encode_cursor(token, offset):
+    """Cursor opaque cho client: token của danh sách xếp hạng + vị trí bắt đầu trang tiếp theo"""
+    return base64.urlsafe_b64encode(f'{token}:{int(offset)}'.encode('ascii')).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns: (token, offset) hoặc None nếu cursor không hợp lệ"""
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(str(cursor)) % 4)).decode('ascii')
+        token, offset = raw.rsplit(':', 1)
+        offset = int(offset)
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    if not token or offset < 0:
+        return None
+    return token, offset
+
+
+class RankedPageStore:
+    """
+    Danh sách xếp hạng sâu dùng cho phân trang bằng cursor, lưu trong Redis để mọi worker đọc được.
+    Token được suy ra từ truy vấn + phiên bản index, nên cùng truy vấn trên cùng phiên bản index dùng chung một danh sách.
+    """
+
+    def __init__(self, ttl, prefix='clip_search_pages'):
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, token):
+        return f'{self.prefix}:{token}'
+
+    @staticmethod
+    def make_token(*parts):
+        return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:24]
+
+    def get(self, token):
+        """Returns: (ids, scores, index_version, viewer_scope) hoặc None"""
+        try:
+            entry = cache.get(self._key(token))
+        except Exception as e:
+            print(f"Redis error reading search pages: {e}")
+            return None
+        if entry is None:
+            return None
+        ids_bytes, scores_bytes, version, scope = entry
+        return np.frombuffer(ids_bytes, dtype='<i8'), np.frombuffer(scores_bytes, dtype='<f4'), version, scope
+
+    def set(self, token, ids, scores, version, scope):
+        """scope: None nếu danh sách chỉ gồm ảnh public, hoặc viewer_id nếu có ảnh private của người xem"""
+        entry = (
+            np.asarray(ids, dtype='<i8').tobytes(),
+            np.asarray(scores, dtype='<f4').tobytes(),
+            version,
+            scope,
+        )
+        try:
+            cache.set(self._key(token), entry, self.ttl)
+        except Exception as e:
+            print(f"Redis error storing search pages: {e}")
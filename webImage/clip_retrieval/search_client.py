@@ -0,0 +1,126 @@
+import socket
+import threading
+
+from clip_retrieval import search_protocol as protocol
+from clip_retrieval.executor import InferenceOverloaded
+
+
+class SearchDaemonError(Exception):
+    """Lỗi do search daemon trả về (hoặc không kết nối được tới daemon)"""
+
+
+class CLIPSearchClient:
+    """
+    Client mode của CLIPImageSearch: cùng các method search / update, nhưng model và index
+    nằm trong search daemon (manage.py run_search_daemon), web worker không cần load torch / FAISS.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls, socket_path, timeout=30):
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.socket_path != str(socket_path):
+                cls._instance = cls(socket_path, timeout)
+            return cls._instance
+
+    def __init__(self, socket_path, timeout=30):
+        self.socket_path = str(socket_path)
+        self.timeout = timeout
+        # Mỗi luồng giữ một kết nối riêng (request / response nối tiếp trên cùng socket)
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise SearchDaemonError(f"Cannot connect to search daemon at {self.socket_path}: {e}")
+        return sock
+
+    def _call(self, op, body):
+        # Thử lại một lần với kết nối mới nếu kết nối cũ đã bị daemon đóng (ví dụ daemon restart)
+        for attempt in range(2):
+            sock = getattr(self._local, 'sock', None)
+            if sock is None:
+                sock = self._local.sock = self._connect()
+            try:
+                protocol.send_frame(sock, op, body)
+                frame = protocol.recv_frame(sock)
+                if frame is None:
+                    raise protocol.ProtocolError("Search daemon closed the connection")
+            except (OSError, protocol.ProtocolError) as e:
+                sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise SearchDaemonError(str(e))
+                continue
+
+            status, response = frame
+            if status == protocol.STATUS_OVERLOADED:
+                overloaded = protocol.unpack_json(response)
+                raise InferenceOverloaded(overloaded['message'], overloaded['retry_after'], overloaded['reason'])
+            if status != protocol.STATUS_OK:
+                raise SearchDaemonError(response.decode('utf-8', 'replace'))
+            return response
+
+    def search(self, query_text, top_k=12, use_cache=True, nprobe=None, ef_search=None, viewer_id=None):
+        body = protocol.pack_search(query_text, top_k, nprobe, ef_search, use_cache, viewer_id)
+        return protocol.unpack_results(self._call(protocol.OP_SEARCH_TEXT, body))
+
+    def search_hybrid(self, query_text, top_k=12, use_cache=True, nprobe=None, ef_search=None, viewer_id=None):
+        body = protocol.pack_search(query_text, top_k, nprobe, ef_search, use_cache, viewer_id)
+        return protocol.unpack_results(self._call(protocol.OP_SEARCH_HYBRID, body))
+
+    def search_by_image(self, image_path_or_url, top_k=12, use_cache=True, nprobe=None, ef_search=None,
+                        viewer_id=None):
+        body = protocol.pack_search(image_path_or_url, top_k, nprobe, ef_search, use_cache, viewer_id)
+        return protocol.unpack_results(self._call(protocol.OP_SEARCH_IMAGE, body))
+
+    def search_by_image_bytes(self, data, top_k=12, nprobe=None, ef_search=None, viewer_id=None):
+        body = protocol.pack_search(bytes(data), top_k, nprobe, ef_search, viewer_id=viewer_id)
+        return protocol.unpack_results(self._call(protocol.OP_SEARCH_IMAGE_BYTES, body))
+
+    def search_by_image_id(self, image_id, top_k=12, use_cache=True, viewer_id=None):
+        body = protocol.pack_search(image_id, top_k, use_cache=use_cache, viewer_id=viewer_id)
+        return protocol.unpack_results(self._call(protocol.OP_SEARCH_IMAGE_ID, body))
+
+    def search_batch(self, queries, viewer_id=None):
+        body = protocol.pack_json({'queries': list(queries), 'viewer_id': viewer_id})
+        return protocol.unpack_json(self._call(protocol.OP_SEARCH_BATCH, body))
+
+    def search_page(self, query_text=None, page_size=20, cursor=None, mode='vector', use_cache=True, nprobe=None,
+                    ef_search=None, viewer_id=None):
+        body = protocol.pack_json({
+            'query_text': query_text, 'page_size': page_size, 'cursor': cursor, 'mode': mode, 'use_cache': use_cache,
+            'nprobe': nprobe, 'ef_search': ef_search, 'viewer_id': viewer_id,
+        })
+        return protocol.unpack_json(self._call(protocol.OP_SEARCH_PAGE, body))
+
+    def encode_texts(self, texts):
+        return protocol.unpack_vectors(self._call(protocol.OP_ENCODE_TEXT, protocol.pack_json(list(texts))))
+
+    def update_index_for_images(self, image_ids, fetch_workers=None):
+        return protocol.unpack_ids(self._call(protocol.OP_UPDATE, protocol.pack_ids(image_ids)))
+
+    def update_index_for_image(self, image_id):
+        if not self.update_index_for_images([image_id]):
+            raise SearchDaemonError(f"Image {image_id} could not be indexed")
+        return True
+
+    def update_metadata_for_images(self, image_ids):
+        return protocol.unpack_ids(self._call(protocol.OP_UPDATE_METADATA, protocol.pack_ids(image_ids)))
+
+    def remove_images_from_index(self, image_ids):
+        return protocol.unpack_ids(self._call(protocol.OP_REMOVE, protocol.pack_ids(image_ids)))
+
+    def remove_from_index(self, image_id):
+        return bool(self.remove_images_from_index([image_id]))
+
+    def contains(self, image_id):
+        return self._call(protocol.OP_CONTAINS, protocol.pack_ids([image_id])) == b'\x01'
+
+    def get_metrics(self):
+        return protocol.unpack_json(self._call(protocol.OP_METRICS, b''))
@@ -0,0 +1,143 @@
+import json
+import socket
+import struct
+
+import numpy as np
+
+# Giao thức nhị phân giữa web worker và search daemon (Unix socket).
+# Mỗi frame: <I độ dài body> <B mã lệnh / trạng thái> body
+
+OP_SEARCH_TEXT = 1
+OP_SEARCH_IMAGE = 2
+OP_SEARCH_IMAGE_ID = 3
+OP_ENCODE_TEXT = 4
+OP_UPDATE = 5
+OP_REMOVE = 6
+OP_CONTAINS = 7
+OP_METRICS = 8
+OP_SEARCH_IMAGE_BYTES = 9
+OP_SEARCH_BATCH = 10
+OP_SEARCH_HYBRID = 11
+OP_SEARCH_PAGE = 12
+OP_UPDATE_METADATA = 13
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+# Executor của daemon đang quá tải: body là JSON {"retry_after": giây, "reason": ...}
+STATUS_OVERLOADED = 2
+
+_FRAME = struct.Struct('<IB')
+# top_k, nprobe, ef_search (0 = mặc định), use_cache, viewer_id (-1 = khách)
+_SEARCH = struct.Struct('<IIIBq')
+_COUNT = struct.Struct('<I')
+_MATRIX = struct.Struct('<II')
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def send_frame(sock, code, body=b''):
+    sock.sendall(_FRAME.pack(len(body), code) + body)
+
+
+def recv_frame(sock):
+    """Đọc một frame; trả về None nếu phía bên kia đã đóng kết nối"""
+    header = _recv_exact(sock, _FRAME.size)
+    if header is None:
+        return None
+    length, code = _FRAME.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame too large: {length} bytes")
+    body = _recv_exact(sock, length) if length else b''
+    if body is None:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return code, body
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        try:
+            chunk = sock.recv(remaining)
+        except socket.timeout:
+            raise ProtocolError("Timed out waiting for the search daemon")
+        if not chunk:
+            if remaining == size:
+                return None
+            raise ProtocolError("Connection closed in the middle of a frame")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def pack_search(text, top_k, nprobe=None, ef_search=None, use_cache=True, viewer_id=None):
+    """text: chuỗi truy vấn / URL / id, hoặc bytes (nội dung ảnh upload) được gửi nguyên vẹn"""
+    payload = text if isinstance(text, bytes) else str(text).encode('utf-8')
+    return _SEARCH.pack(int(top_k), int(nprobe or 0), int(ef_search or 0), int(bool(use_cache)),
+                        -1 if viewer_id is None else int(viewer_id)) + payload
+
+
+def unpack_search(body, raw=False):
+    """Returns: (text, top_k, nprobe, ef_search, use_cache, viewer_id); raw=True giữ text ở dạng bytes"""
+    top_k, nprobe, ef_search, use_cache, viewer_id = _SEARCH.unpack_from(body, 0)
+    text = body[_SEARCH.size:] if raw else body[_SEARCH.size:].decode('utf-8')
+    return text, top_k, nprobe or None, ef_search or None, bool(use_cache), None if viewer_id < 0 else viewer_id
+
+
+def pack_ids(ids):
+    return np.asarray(ids, dtype='<i8').tobytes()
+
+
+def unpack_ids(body):
+    return np.frombuffer(body, dtype='<i8').tolist()
+
+
+def pack_vectors(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype='<f4')
+    return _MATRIX.pack(*vectors.shape) + vectors.tobytes()
+
+
+def unpack_vectors(body):
+    rows, dimension = _MATRIX.unpack_from(body, 0)
+    return np.frombuffer(body, dtype='<f4', offset=_MATRIX.size).reshape(rows, dimension).astype('float32')
+
+
+def pack_results(results):
+    """
+    Danh sách kết quả: id (int64) và similarity_score (float32) ở dạng mảng nhị phân,
+    phần metadata còn lại dạng JSON gọn.
+    """
+    ids = [result.get('id', -1) for result in results]
+    scores = [result.get('similarity_score', 0.0) for result in results]
+    metadata = json.dumps(
+        [{key: value for key, value in result.items() if key not in ('id', 'similarity_score')}
+         for result in results],
+        separators=(',', ':'), default=str
+    ).encode('utf-8')
+    return _COUNT.pack(len(results)) + pack_ids(ids) + np.asarray(scores, dtype='<f4').tobytes() + metadata
+
+
+def unpack_results(body):
+    (count,) = _COUNT.unpack_from(body, 0)
+    offset = _COUNT.size
+    ids = np.frombuffer(body, dtype='<i8', count=count, offset=offset).tolist()
+    offset += count * 8
+    scores = np.frombuffer(body, dtype='<f4', count=count, offset=offset).tolist()
+    offset += count * 4
+    results = json.loads(body[offset:].decode('utf-8'))
+    for result, image_id, score in zip(results, ids, scores):
+        result['id'] = image_id
+        result['similarity_score'] = score
+    return results
+
+
+def pack_json(value):
+    return json.dumps(value, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def unpack_json(body):
+    return json.loads(body.decode('utf-8'))
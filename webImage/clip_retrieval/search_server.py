@@ -0,0 +1,141 @@
+import os
+import socketserver
+
+from clip_retrieval import search_protocol as protocol
+from clip_retrieval.executor import InferenceOverloaded
+
+
+class _SearchRequestHandler(socketserver.BaseRequestHandler):
+    """Một kết nối (thường là một luồng của web worker) gửi nhiều request nối tiếp nhau"""
+
+    def handle(self):
+        while True:
+            try:
+                frame = protocol.recv_frame(self.request)
+            except protocol.ProtocolError as e:
+                print(f"Search daemon: dropping connection: {e}")
+                return
+            if frame is None:
+                return
+
+            op, body = frame
+            try:
+                response = self.server.dispatch(op, body)
+            except InferenceOverloaded as e:
+                overloaded = {'retry_after': e.retry_after, 'reason': e.reason, 'message': str(e)}
+                protocol.send_frame(self.request, protocol.STATUS_OVERLOADED, protocol.pack_json(overloaded))
+                continue
+            except Exception as e:
+                protocol.send_frame(self.request, protocol.STATUS_ERROR, str(e).encode('utf-8'))
+                continue
+            protocol.send_frame(self.request, protocol.STATUS_OK, response)
+
+
+class SearchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Daemon giữ CLIP model + FAISS index duy nhất, phục vụ encode / search / update cho các web worker.
+    Các request đồng thời vẫn đi qua batcher và cache của engine.
+    """
+    daemon_threads = True
+    # Backlog của listen(): burst kết nối mới không bị từ chối (EAGAIN) trước khi tới executor của engine
+    request_queue_size = 128
+
+    def __init__(self, engine, socket_path):
+        self.engine = engine
+        self.socket_path = str(socket_path)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        super().__init__(self.socket_path, _SearchRequestHandler)
+        os.chmod(self.socket_path, 0o660)
+
+        self._handlers = {
+            protocol.OP_SEARCH_TEXT: self._search_text,
+            protocol.OP_SEARCH_IMAGE: self._search_image,
+            protocol.OP_SEARCH_IMAGE_ID: self._search_image_id,
+            protocol.OP_SEARCH_IMAGE_BYTES: self._search_image_bytes,
+            protocol.OP_SEARCH_BATCH: self._search_batch,
+            protocol.OP_SEARCH_HYBRID: self._search_hybrid,
+            protocol.OP_SEARCH_PAGE: self._search_page,
+            protocol.OP_ENCODE_TEXT: self._encode_text,
+            protocol.OP_UPDATE: self._update,
+            protocol.OP_REMOVE: self._remove,
+            protocol.OP_UPDATE_METADATA: self._update_metadata,
+            protocol.OP_CONTAINS: self._contains,
+            protocol.OP_METRICS: self._metrics,
+        }
+
+    def dispatch(self, op, body):
+        handler = self._handlers.get(op)
+        if handler is None:
+            raise protocol.ProtocolError(f"Unknown operation {op}")
+        return handler(body)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _search_text(self, body):
+        text, top_k, nprobe, ef_search, use_cache, viewer_id = protocol.unpack_search(body)
+        return protocol.pack_results(
+            self.engine.search(text, top_k=top_k, use_cache=use_cache, nprobe=nprobe, ef_search=ef_search,
+                               viewer_id=viewer_id)
+        )
+
+    def _search_hybrid(self, body):
+        text, top_k, nprobe, ef_search, use_cache, viewer_id = protocol.unpack_search(body)
+        return protocol.pack_results(
+            self.engine.search_hybrid(text, top_k=top_k, use_cache=use_cache, nprobe=nprobe, ef_search=ef_search,
+                                      viewer_id=viewer_id)
+        )
+
+    def _search_image(self, body):
+        path_or_url, top_k, nprobe, ef_search, use_cache, viewer_id = protocol.unpack_search(body)
+        return protocol.pack_results(
+            self.engine.search_by_image(path_or_url, top_k=top_k, use_cache=use_cache,
+                                        nprobe=nprobe, ef_search=ef_search, viewer_id=viewer_id)
+        )
+
+    def _search_image_bytes(self, body):
+        data, top_k, nprobe, ef_search, _, viewer_id = protocol.unpack_search(body, raw=True)
+        return protocol.pack_results(
+            self.engine.search_by_image_bytes(data, top_k=top_k, nprobe=nprobe, ef_search=ef_search,
+                                              viewer_id=viewer_id)
+        )
+
+    def _search_image_id(self, body):
+        image_id, top_k, _, _, use_cache, viewer_id = protocol.unpack_search(body)
+        return protocol.pack_results(
+            self.engine.search_by_image_id(int(image_id), top_k=top_k, use_cache=use_cache, viewer_id=viewer_id)
+        )
+
+    def _search_batch(self, body):
+        request = protocol.unpack_json(body)
+        return protocol.pack_json(self.engine.search_batch(request['queries'], viewer_id=request.get('viewer_id')))
+
+    def _search_page(self, body):
+        request = protocol.unpack_json(body)
+        return protocol.pack_json(self.engine.search_page(
+            request.get('query_text'), page_size=request.get('page_size', 20), cursor=request.get('cursor'),
+            mode=request.get('mode', 'vector'), use_cache=request.get('use_cache', True), nprobe=request.get('nprobe'),
+            ef_search=request.get('ef_search'), viewer_id=request.get('viewer_id')
+        ))
+
+    def _encode_text(self, body):
+        return protocol.pack_vectors(self.engine.encode_texts(protocol.unpack_json(body)))
+
+    def _update(self, body):
+        return protocol.pack_ids(self.engine.update_index_for_images(protocol.unpack_ids(body)))
+
+    def _remove(self, body):
+        return protocol.pack_ids(self.engine.remove_images_from_index(protocol.unpack_ids(body)))
+
+    def _update_metadata(self, body):
+        return protocol.pack_ids(self.engine.update_metadata_for_images(protocol.unpack_ids(body)))
+
+    def _contains(self, body):
+        (image_id,) = protocol.unpack_ids(body)
+        return b'\x01' if self.engine.contains(image_id) else b'\x00'
+
+    def _metrics(self, body):
+        return protocol.pack_json(self.engine.get_metrics())
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+
+# Manifest của snapshot hiện tại: seq của WAL đã được gộp vào + checksum từng file
+MANIFEST_NAME = 'snapshot.json'
+WAL_NAME = 'clip_index.wal'
+
+# Các file tạo nên một snapshot
+SNAPSHOT_FILES = (
+    'clip_faiss.index', 'clip_image_embeddings.npy', 'image_urls.json', 'image_ids.json',
+    'image_metadata.json', 'tombstones.json', 'index_info.json',
+)
+
+# File snapshot được ghi với hậu tố này trước, chỉ rename sau khi manifest đã commit
+PENDING_SUFFIX = '.snapshot'
+
+# Lock (Redis) giữa các process dùng chung thư mục index: chỉ process giữ lock được ghi snapshot
+# hoặc đụng tới file tạm của snapshot
+SNAPSHOT_LOCK_KEY = 'clip_index_snapshot_lock'
+SNAPSHOT_LOCK_TTL = 10 * 60
+
+# Windows không mở được thư mục bằng os.open (và không fsync được thư mục)
+O_DIRECTORY = getattr(os, 'O_DIRECTORY', None)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+# Chỉ xoá lock nếu nó vẫn là của người gọi (lock đã hết TTL có thể thuộc về process khác)
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Token khi không có Redis (coi như chỉ có một process)
+LOCAL_LOCK = 'local'
+
+
+def _redis():
+    from django_redis import get_redis_connection
+    return get_redis_connection('default')
+
+
+def acquire_snapshot_lock(wait=0):
+    """
+    Lấy lock snapshot, chờ tối đa wait giây.
+
+    Returns:
+        str | None: token của lock (truyền cho release_snapshot_lock), None nếu process khác đang giữ lock.
+    """
+    token = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+    deadline = time.monotonic() + wait
+    try:
+        connection = _redis()
+        while not connection.set(SNAPSHOT_LOCK_KEY, token, nx=True, ex=SNAPSHOT_LOCK_TTL):
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0.1)
+        return token
+    except Exception as e:
+        print(f"⚠️ Không lấy được lock snapshot trong Redis: {e}")
+        return LOCAL_LOCK
+
+
+def release_snapshot_lock(token):
+    """Trả lock bằng compare-and-delete: không xoá lock mà process khác đã lấy sau khi lock của mình hết hạn"""
+    if not token or token == LOCAL_LOCK:
+        return
+    try:
+        if not _redis().eval(_RELEASE_SCRIPT, 1, SNAPSHOT_LOCK_KEY, token):
+            print("⚠️ Lock snapshot đã hết hạn và thuộc về process khác, không xoá")
+    except Exception as e:
+        print(f"⚠️ Không trả được lock snapshot trong Redis: {e}")
+
+
+def pending_path(index_dir, name):
+    """Đường dẫn tạm để ghi file của snapshot mới"""
+    return os.path.join(index_dir, name + PENDING_SUFFIX)
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(index_dir):
+    path = os.path.join(index_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def commit_snapshot(index_dir, names, seq, rebuild=None):
+    """
+    Commit một snapshot đã được ghi ra các file tạm (pending_path).
+
+    Thứ tự: fsync file tạm -> ghi manifest (tmp + rename, đây là điểm commit) -> rename từng file.
+    Nếu crash sau điểm commit, recover_snapshot sẽ hoàn tất các lần rename còn dở.
+
+    rebuild: số lần index được rebuild ngoài engine (rebuild_clip_index); None = giữ số của snapshot trước.
+    Engine đang chạy load lại snapshot khi số này tăng.
+    """
+    if rebuild is None:
+        previous = load_manifest(index_dir)
+        rebuild = previous.get('rebuild', 0) if previous else 0
+    files = {}
+    for name in names:
+        path = pending_path(index_dir, name)
+        _fsync_path(path)
+        files[name] = {'sha256': file_checksum(path), 'size': os.path.getsize(path)}
+
+    manifest = {
+        'seq': seq,
+        'rebuild': rebuild,
+        'files': files,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    manifest_path = os.path.join(index_dir, MANIFEST_NAME)
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+    for name in names:
+        os.replace(pending_path(index_dir, name), os.path.join(index_dir, name))
+    _fsync_path(index_dir)
+    return manifest
+
+
+def recover_snapshot(index_dir, verify=False, repair=True):
+    """
+    Đưa thư mục index về snapshot đã commit gần nhất.
+
+    - File tạm thuộc snapshot đã commit (checksum khớp manifest) được rename nốt.
+    - File tạm của snapshot chưa commit bị xoá.
+    - verify=True: kiểm tra sha256 của mọi file (mặc định chỉ kiểm tra kích thước).
+    - repair=False (không giữ lock snapshot, process khác có thể đang ghi): không đụng tới file tạm;
+      với verify=True, file chưa khớp manifest (snapshot đang được commit dở) => SnapshotError.
+
+    Returns:
+        dict | None: manifest, hoặc None nếu thư mục chưa có snapshot (định dạng cũ).
+    """
+    manifest = load_manifest(index_dir)
+    if not repair and not verify:
+        return manifest
+    files = manifest['files'] if manifest else {}
+
+    for entry in os.listdir(index_dir) if repair else ():
+        if not entry.endswith(PENDING_SUFFIX):
+            continue
+        name = entry[:-len(PENDING_SUFFIX)]
+        path = os.path.join(index_dir, entry)
+        if name in files and file_checksum(path) == files[name]['sha256']:
+            print(f"Completing interrupted snapshot: {name}")
+            os.replace(path, os.path.join(index_dir, name))
+        else:
+            os.remove(path)
+
+    for name, expected in files.items():
+        path = os.path.join(index_dir, name)
+        if not os.path.exists(path) or os.path.getsize(path) != expected['size']:
+            raise SnapshotError(f"Snapshot file {name} is missing or has the wrong size")
+        if verify and file_checksum(path) != expected['sha256']:
+            raise SnapshotError(f"Snapshot file {name} failed checksum verification")
+    return manifest
+
+
+def reset_snapshot_state(index_dir):
+    """
+    Dùng sau khi các file index được tạo lại ngoài engine (generate_embeddings, rebuild_clip_index):
+    bỏ manifest và WAL cũ vì chúng mô tả bộ file trước đó.
+    """
+    for name in (MANIFEST_NAME, WAL_NAME):
+        path = os.path.join(index_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _fsync_path(path):
+    if O_DIRECTORY is None and os.path.isdir(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+
+
+class VectorStore:
+    """
+    Vector full-precision (float32) lưu trong file .npy.
+
+    Phần đã lưu có thể được memory-map (không chiếm RAM riêng của process),
+    các vector mới thêm được giữ tạm trong bộ nhớ cho tới lần save tiếp theo.
+    """
+
+    def __init__(self, base=None, dimension=None, mmap=False):
+        if base is None:
+            base = np.empty((0, dimension or 0), dtype='float32')
+        self._base = base
+        self.mmap = mmap
+        self._tail = []
+        self._tail_rows = 0
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """Đọc file .npy; mmap=True để dùng chung page cache giữa các process"""
+        return cls(np.load(path, mmap_mode='r' if mmap else None), mmap=mmap)
+
+    @property
+    def dimension(self):
+        return self._base.shape[1]
+
+    @property
+    def shape(self):
+        return (len(self), self.dimension)
+
+    def __len__(self):
+        return self._base.shape[0] + self._tail_rows
+
+    def __getitem__(self, positions):
+        if isinstance(positions, slice):
+            positions = np.arange(len(self))[positions]
+        return self.take(positions)
+
+    def append(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype='float32').reshape(-1, self.dimension)
+        self._tail.append(vectors)
+        self._tail_rows += vectors.shape[0]
+
+    def appended(self, vectors):
+        """Store mới có thêm vectors ở cuối; store hiện tại không đổi (reader đang dùng nó vẫn an toàn)"""
+        vectors = np.ascontiguousarray(vectors, dtype='float32').reshape(-1, self.dimension)
+        store = VectorStore(self._base, mmap=self.mmap)
+        store._tail = self._tail + [vectors]
+        store._tail_rows = self._tail_rows + vectors.shape[0]
+        return store
+
+    def take(self, positions):
+        """Lấy các vector theo vị trí (giữ nguyên thứ tự), trả về mảng float32 trong bộ nhớ"""
+        positions = np.asarray(positions, dtype='int64').reshape(-1)
+        result = np.empty((len(positions), self.dimension), dtype='float32')
+        base_rows = self._base.shape[0]
+
+        in_base = positions < base_rows
+        if in_base.any():
+            # Đọc theo thứ tự tăng dần để truy cập file tuần tự hơn
+            base_positions = positions[in_base]
+            order = np.argsort(base_positions)
+            rows = np.empty((len(base_positions), self.dimension), dtype='float32')
+            rows[order] = self._base[base_positions[order]]
+            result[in_base] = rows
+        if (~in_base).any():
+            tail = np.vstack(self._tail)
+            result[~in_base] = tail[positions[~in_base] - base_rows]
+        return result
+
+    def to_array(self):
+        """Toàn bộ vector dưới dạng một mảng trong bộ nhớ"""
+        return self.take(np.arange(len(self)))
+
+    def save(self, path):
+        """
+        Ghi toàn bộ vector ra file .npy (ghi file tạm rồi rename), sau đó
+        mở lại file dưới dạng base để giải phóng phần tail trong bộ nhớ.
+        """
+        tmp_path = f'{path}.tmp'
+        self.write(tmp_path)
+        os.replace(tmp_path, path)
+        self.reopen(path)
+
+    def write(self, path):
+        """Ghi toàn bộ vector ra file .npy tại path (không đổi trạng thái của store)"""
+        out = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=self.shape)
+        base_rows = self._base.shape[0]
+        chunk = 65536
+        for start in range(0, base_rows, chunk):
+            end = min(start + chunk, base_rows)
+            out[start:end] = self._base[start:end]
+        offset = base_rows
+        for vectors in self._tail:
+            out[offset:offset + len(vectors)] = vectors
+            offset += len(vectors)
+        out.flush()
+        del out
+
+    def reopen(self, path):
+        """Dùng file vừa ghi (chứa toàn bộ vector hiện có) làm base mới"""
+        self._base = np.load(path, mmap_mode='r' if self.mmap else None)
+        self._tail = []
+        self._tail_rows = 0
@@ -0,0 +1,197 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có khoá file, chỉ một process được ghi log
+    fcntl = None
+
+# Loại bản ghi trong log
+OP_ADD = 1
+OP_DELETE = 2
+# Chỉ sửa metadata (title / description ...) của ảnh đã có trong index, không có vector
+OP_METADATA = 3
+
+# length (payload), crc32 (seq + op + image_id + payload), seq, op, image_id
+_HEADER = struct.Struct('<IIQBq')
+_VECTOR_SIZE = struct.Struct('<I')
+
+
+class WALRecord:
+    __slots__ = ('seq', 'op', 'image_id', 'vector', 'metadata')
+
+    def __init__(self, seq, op, image_id, vector=None, metadata=None):
+        self.seq = seq
+        self.op = op
+        self.image_id = image_id
+        self.vector = vector
+        self.metadata = metadata
+
+
+class IndexWAL:
+    """
+    Write-ahead log chỉ ghi nối (append-only) cho các thay đổi của CLIP index.
+
+    Mỗi bản ghi add chứa vector + id + metadata, bản ghi delete chỉ chứa id.
+    Bản ghi có checksum CRC32; phần đuôi bị ghi dở (crash giữa chừng) được bỏ qua khi replay.
+    Nhiều process có thể ghi cùng một file: mỗi lần ghi / viết lại log giữ khoá file (flock).
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = str(path)
+        self.fsync = fsync
+        self.last_seq = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    def size(self):
+        """Số byte hiện có trong log"""
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def append_add(self, image_id, vector, metadata, sync=True, seq=None):
+        vector = np.ascontiguousarray(vector, dtype='<f4').reshape(-1).tobytes()
+        payload = _VECTOR_SIZE.pack(len(vector)) + vector + json.dumps(metadata).encode('utf-8')
+        return self._append(OP_ADD, image_id, payload, sync, seq)
+
+    def append_delete(self, image_id, sync=True, seq=None):
+        return self._append(OP_DELETE, image_id, b'', sync, seq)
+
+    def append_metadata(self, image_id, metadata, sync=True, seq=None):
+        return self._append(OP_METADATA, image_id, json.dumps(metadata).encode('utf-8'), sync, seq)
+
+    def sync(self):
+        """Đảm bảo các bản ghi đã ghi (sync=False) nằm trên đĩa; dùng một lần cho cả batch"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def _append(self, op, image_id, payload, sync=True, seq=None):
+        """Ghi một bản ghi; seq do caller cấp (version của log chung) hoặc tiếp nối bản ghi trước"""
+        with self._lock, self._file_lock():
+            seq = seq if seq is not None else self.last_seq + 1
+            header_tail = _HEADER.pack(0, 0, seq, op, image_id)[8:]
+            crc = zlib.crc32(header_tail + payload)
+            record = _HEADER.pack(len(payload), crc, seq, op, image_id) + payload
+
+            if self._file is not None and not self._is_current():
+                # Process khác đã viết lại log (truncate): ghi tiếp vào file mới
+                self._close()
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            # Một lần write cho cả bản ghi (flush ngay để process khác đọc / viết lại log thấy nó),
+            # rồi fsync trước khi thay đổi được áp dụng
+            self._file.write(record)
+            self._file.flush()
+            if sync and self.fsync:
+                os.fsync(self._file.fileno())
+            self.last_seq = max(self.last_seq, seq)
+            return seq
+
+    def _scan(self, data):
+        """Duyệt các bản ghi hợp lệ: (start, end, seq, op, image_id, payload); dừng ở bản ghi hỏng đầu tiên"""
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            length, crc, seq, op, image_id = _HEADER.unpack_from(data, offset)
+            end = offset + _HEADER.size + length
+            payload = data[offset + _HEADER.size:end]
+            if end > len(data) or zlib.crc32(data[offset + 8:offset + _HEADER.size] + payload) != crc:
+                return
+            yield offset, end, seq, op, image_id, payload
+            offset = end
+
+    def replay(self, after_seq=0):
+        """
+        Đọc các bản ghi có seq > after_seq theo thứ tự seq.
+        Đuôi log hỏng (ghi dở / sai checksum) bị cắt bỏ để lần ghi sau nối tiếp phần hợp lệ.
+        """
+        self.last_seq = max(self.last_seq, after_seq)
+        if not os.path.exists(self.path):
+            return []
+
+        with self._lock, self._file_lock():
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            entries = []
+            for _, offset, seq, op, image_id, payload in self._scan(data):
+                entries.append((seq, op, image_id, payload))
+
+            if offset < len(data):
+                print(f"Warning: discarding {len(data) - offset} bytes of incomplete WAL records in {self.path}")
+                self._close()
+                with open(self.path, 'r+b') as f:
+                    f.truncate(offset)
+
+        # Các worker ghi xen kẽ nên seq (version của log chung) trong file không nhất thiết tăng dần
+        records = []
+        for seq, op, image_id, payload in sorted(entries, key=lambda entry: entry[0]):
+            self.last_seq = max(self.last_seq, seq)
+            if seq <= after_seq:
+                # Đã nằm trong snapshot
+                continue
+            if op == OP_ADD:
+                (vector_size,) = _VECTOR_SIZE.unpack_from(payload, 0)
+                start = _VECTOR_SIZE.size
+                vector = np.frombuffer(payload[start:start + vector_size], dtype='<f4').astype('float32')
+                metadata = json.loads(payload[start + vector_size:].decode('utf-8'))
+                records.append(WALRecord(seq, op, image_id, vector, metadata))
+            elif op == OP_METADATA:
+                records.append(WALRecord(seq, op, image_id, metadata=json.loads(payload.decode('utf-8'))))
+            else:
+                records.append(WALRecord(seq, op, image_id))
+        return records
+
+    def truncate(self, through_seq=None):
+        """
+        Xoá các bản ghi đã nằm trong snapshot vừa commit (seq <= through_seq, None = toàn bộ log).
+        Bản ghi mới hơn (worker khác ghi trong lúc lưu snapshot) được giữ lại; seq vẫn tiếp tục tăng.
+        """
+        with self._lock, self._file_lock():
+            self._close()
+            kept = b''
+            if through_seq is not None and os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+                kept = b''.join(data[start:end] for start, end, seq, _, _, _ in self._scan(data) if seq > through_seq)
+
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(kept)
+                if kept and self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def _file_lock(self):
+        """Khoá giữa các process dùng chung file log (ghi bản ghi / viết lại log)"""
+        if fcntl is None:
+            yield
+            return
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _is_current(self):
+        """File đang mở vẫn là file log hiện tại (chưa bị thay bằng os.replace)"""
+        try:
+            return os.fstat(self._file.fileno()).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -5,10 +5,21 @@ from PIL import Image
 import numpy as np
 import requests
 from io import BytesIO
+from model_inference.encoders import build_encoder, sample_images, to_channels_last
 
 class FeatureExtractor:
-    def __init__(self, use_gpu=True):
- 
+    def __init__(self, use_gpu=True, backend='eager', quantization='none', artifact_dir=None, num_threads=0,
+                 channels_last=False):
+        """
+        Args:
+            use_gpu (bool): Sử dụng GPU nếu có.
+            backend (str): Backend inference trên CPU: eager, torchscript hoặc onnx.
+            quantization (str): Lượng tử hoá int8: none, dynamic hoặc static.
+            artifact_dir (str): Thư mục lưu model đã export (TorchScript / ONNX).
+            num_threads (int): Số luồng intra-op của session ONNX Runtime (0 = mặc định). Số luồng torch
+                của process không bị đổi ở đây.
+            channels_last (bool): Chạy conv với bộ nhớ channels_last.
+        """
         self.device = torch.device("cuda" if torch.cuda.is_available() and use_gpu else "cpu")
         print(f"Using device: {self.device}")
 
@@ -16,6 +27,8 @@ class FeatureExtractor:
         self.model = models.resnet50(weights=models.ResNet50_Weights.IMAGENET1K_V1)
         self.model = torch.nn.Sequential(*list(self.model.children())[:-1]).to(self.device)
         self.model.eval()
+        if channels_last:
+            to_channels_last(self.model)
 
         # Tiền xử lý ảnh đầu vào
         self.transform = transforms.Compose([
@@ -25,6 +38,14 @@ class FeatureExtractor:
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         ])
 
+        # Encoder theo backend đã chọn (kiểm tra parity với model gốc, lỗi thì quay về eager)
+        samples = sample_images(self.transform) if backend != 'eager' else None
+        self.encoder = build_encoder(
+            'resnet50', self.model, lambda model, images: model(images).flatten(1), samples, backend=backend,
+            quantization=quantization, device=self.device, artifact_dir=artifact_dir, num_threads=num_threads,
+            channels_last=channels_last
+        )
+
     def load_image(self, image_source):
         """
         Tải ảnh từ URL hoặc từ đường dẫn local.
@@ -61,10 +82,7 @@ class FeatureExtractor:
         if image is None:
             return None
         
-        image = self.transform(image).unsqueeze(0).to(self.device)
-        with torch.no_grad():
-            features = self.model(image).squeeze().cpu().numpy()
-        return features
+        return self.encoder(self.transform(image).unsqueeze(0))[0]
 
     def extract_features_batch(self, image_sources, batch_size=32):
         """
@@ -97,14 +115,8 @@ class FeatureExtractor:
             if not batch_images:
                 continue
                 
-            # Xử lý batch ảnh hợp lệ
-            batch_tensor = torch.stack(batch_images).to(self.device)
-            with torch.no_grad():
-                batch_features = self.model(batch_tensor).squeeze().cpu().numpy()
-                
-            # Xử lý trường hợp chỉ có một ảnh trong batch
-            if len(batch_images) == 1:
-                batch_features = batch_features.reshape(1, -1)
+            # Xử lý batch ảnh hợp lệ: (n, 2048) kể cả khi batch chỉ có một ảnh
+            batch_features = self.encoder(torch.stack(batch_images))
                 
             all_features.append(batch_features)
             valid_indices.extend(batch_valid_indices)
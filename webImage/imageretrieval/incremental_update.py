@@ -42,7 +42,7 @@ class IndexUpdater(IndexBuilder):
         
         if len(features) > 0:
             # Thêm features mới vào index
-            self.index.add(features)
+            self.add_features(features)
             
             # Thêm thông tin ảnh mới vào mapping
             self.image_data.extend(valid_images)
@@ -91,25 +91,19 @@ class IndexUpdater(IndexBuilder):
         else:
             cpu_index = self.index
             
-        # Tạo một index mới với cấu hình tương tự
-        new_index = faiss.IndexFlatL2(self.feature_dim)
-        
         # Copy tất cả vectors trừ những cái cần xóa
-        all_vectors = faiss.vector_float_to_array(cpu_index.get_xb())
-        all_vectors = all_vectors.reshape(cpu_index.ntotal, cpu_index.d)
+        # (index nén: lấy từ vector gốc để không mất thêm độ chính xác)
+        if self.raw_vectors is not None and len(self.raw_vectors) == cpu_index.ntotal:
+            all_vectors = self.raw_vectors.to_array()
+        else:
+            all_vectors = cpu_index.reconstruct_n(0, cpu_index.ntotal)
         
         keep_vectors = np.delete(all_vectors, indices_to_remove, axis=0)
         
+        # Thay thế index cũ bằng index mới cùng cấu hình (đã chuyển sang GPU nếu cần)
+        self.reset_index()
         if len(keep_vectors) > 0:
-            new_index.add(keep_vectors)
-            
-        # Thay thế index cũ bằng index mới
-        self.index = new_index
-        
-        # Chuyển lại sang GPU nếu cần
-        if self.use_gpu and faiss.get_num_gpus() > 0:
-            res = faiss.StandardGpuResources()
-            self.index = faiss.index_cpu_to_gpu(res, 0, self.index)
+            self.add_features(keep_vectors)
             
         # Cập nhật image_data
         self.image_data = new_image_data
@@ -6,32 +6,103 @@ import pickle
 from tqdm import tqdm
 import requests
 from imageretrieval.feature_extractor import FeatureExtractor
+from clip_retrieval.index_factory import coarse_dimension, factory_string, is_reduced, read_index, rerank_exact, write_index
+from clip_retrieval.vector_store import VectorStore
 
 class IndexBuilder:
-    def __init__(self, feature_dim=2048, use_gpu=True):
+    def __init__(self, feature_dim=2048, use_gpu=True, storage='float32', rerank_factor=4, pca_dim=None,
+                 min_candidates=0, extractor_options=None):
         """
         Xây dựng FAISS index.
         
         Args:
             feature_dim (int): Số chiều của vector đặc trưng.
             use_gpu (bool): Sử dụng GPU nếu có.
+            storage (str): Cách lưu vector trong index: float32, float16, int8 hoặc pq.
+            rerank_factor (int): Với index nén, số ứng viên (x top_k) được xếp hạng lại chính xác.
+            pca_dim (int): Giảm chiều bằng PCA trước khi vào index (tầng lọc thô), None / 0 = giữ nguyên 2048 chiều.
+            min_candidates (int): Số ứng viên tối thiểu được xếp hạng lại với index nén / giảm chiều.
+            extractor_options (dict): Backend inference của FeatureExtractor (backend, quantization, ...).
         """
         self.feature_dim = feature_dim
         self.use_gpu = use_gpu
-        self.extractor = FeatureExtractor(use_gpu=use_gpu)
+        self.storage = storage
+        self.rerank_factor = rerank_factor
+        self.pca_dim = pca_dim or None
+        self.min_candidates = min_candidates
+        self.extractor = FeatureExtractor(use_gpu=use_gpu, **(extractor_options or {}))
         self.image_data = []  # Lưu thông tin ảnh
 
         # Khởi tạo FAISS index với L2 distance
-        self.index = faiss.IndexFlatL2(feature_dim)
+        self.reset_index()
 
         # Nếu có GPU, chuyển index sang GPU
         if use_gpu and faiss.get_num_gpus() > 0:
             print(f"🚀 Using FAISS GPU (gpus available: {faiss.get_num_gpus()})")
-            res = faiss.StandardGpuResources()
-            self.index = faiss.index_cpu_to_gpu(res, 0, self.index)
         else:
             print("🖥️ Using FAISS CPU")
 
+    def reset_index(self):
+        """Tạo index rỗng theo kiểu storage đã cấu hình (index nén được tạo lại và train ở lần add đầu tiên)"""
+        self.index = self._create_index(0)
+
+        # Vector gốc float32 dùng để re-rank khi index được nén / giảm chiều
+        self.raw_vectors = VectorStore(dimension=self.feature_dim) if self.is_quantized else None
+        self._mmap_path = None
+
+    def _create_index(self, num_vectors):
+        """Index rỗng; num_vectors = số vector train (quyết định số bit mã PQ)"""
+        index = faiss.index_factory(
+            self.feature_dim,
+            factory_string('flat', self.feature_dim, num_vectors, storage=self.storage, pca_dim=self.pca_dim),
+            faiss.METRIC_L2
+        )
+        if self.use_gpu and faiss.get_num_gpus() > 0:
+            res = faiss.StandardGpuResources()
+            index = faiss.index_cpu_to_gpu(res, 0, index)
+        return index
+
+    @property
+    def is_quantized(self):
+        return self.storage != 'float32' or bool(self.pca_dim)
+
+    def add_features(self, features):
+        """Thêm vector vào index (train index nén nếu chưa train) và lưu lại vector gốc"""
+        features = np.ascontiguousarray(features, dtype='float32').reshape(-1, self.feature_dim)
+        if self._mmap_path is not None:
+            # Copy-on-write: index đang được mmap read-only, đọc lại vào bộ nhớ riêng trước khi sửa
+            self.index = read_index(self._mmap_path)
+            self._mmap_path = None
+        if not self.index.is_trained and self.pca_dim and len(features) < self.feature_dim:
+            # PCA cần ít nhất feature_dim vector để train: index nhỏ giữ nguyên số chiều
+            print(f"⚠️ Chỉ có {len(features)} vector, bỏ qua PCA{self.pca_dim}")
+            self.pca_dim = None
+            self.reset_index()
+        if not self.index.is_trained:
+            print(f"🎯 Training {self.storage} index on {len(features)} vectors...")
+            self.index = self._create_index(len(features))
+            self.index.train(features)
+        self.index.add(features)
+        if self.raw_vectors is not None:
+            self.raw_vectors.append(features)
+
+    @staticmethod
+    def _detect_storage(index):
+        """Kiểu storage của một flat index đã đọc từ file"""
+        index = faiss.downcast_index(index)
+        if isinstance(index, faiss.IndexPreTransform):
+            index = faiss.downcast_index(index.index)
+        if isinstance(index, faiss.IndexScalarQuantizer):
+            return 'float16' if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'int8'
+        if isinstance(index, faiss.IndexPQ):
+            return 'pq'
+        return 'float32'
+
+    @staticmethod
+    def raw_vectors_path(index_path):
+        """File .npy chứa vector gốc nằm cạnh file index"""
+        return os.path.splitext(str(index_path))[0] + '_vectors.npy'
+
     def load_s3_data(self, json_file=None, api_url=None, total_pages=None):
         """
         Tải dữ liệu ảnh từ file JSON hoặc từ API.
@@ -187,7 +258,7 @@ class IndexBuilder:
         
         if len(features) > 0:
             print("⚡ Adding features to FAISS index...")
-            self.index.add(features)
+            self.add_features(features)
             print(f"✅ Index built with {self.index.ntotal} images")
         else:
             print("❌ No valid images found. Index not built.")
@@ -203,23 +274,39 @@ class IndexBuilder:
         if self.use_gpu and faiss.get_num_gpus() > 0:
             faiss.write_index(faiss.index_gpu_to_cpu(self.index), str(index_path))
         else:
-            faiss.write_index(self.index, index_path)
+            write_index(self.index, index_path)
 
         with open(mapping_path, 'wb') as f:
             pickle.dump(self.image_data, f)
 
+        # Index nén: giữ vector gốc trên đĩa để re-rank
+        if self.raw_vectors is not None:
+            self.raw_vectors.save(self.raw_vectors_path(index_path))
+
         print(f"💾 Index saved to {index_path}")
         print(f"📝 Image mapping saved to {mapping_path}")
 
-    def load(self, index_path, mapping_path):
+    def load(self, index_path, mapping_path, mmap=False):
         """
         Tải FAISS index và mapping từ file.
         
         Args:
             index_path (str): Đường dẫn file FAISS index.
             mapping_path (str): Đường dẫn file mapping.
+            mmap (bool): Map file index read-only (các worker dùng chung page cache, chỉ áp dụng cho CPU).
         """
-        self.index = faiss.read_index(str(index_path))
+        mmap = mmap and not (self.use_gpu and faiss.get_num_gpus() > 0)
+        self.index = read_index(index_path, mmap=mmap)
+        self._mmap_path = str(index_path) if mmap else None
+
+        # Nhận biết index nén từ chính file index (không phụ thuộc cấu hình hiện tại)
+        self.storage = self._detect_storage(self.index)
+        self.pca_dim = coarse_dimension(self.index) if is_reduced(self.index) else None
+        self.raw_vectors = None
+        raw_path = self.raw_vectors_path(index_path)
+        if self.is_quantized and os.path.exists(raw_path):
+            # Memory-map: vector gốc ở trên đĩa, chỉ các ứng viên cần re-rank được đọc
+            self.raw_vectors = VectorStore.load(raw_path, mmap=True)
 
         if self.use_gpu and faiss.get_num_gpus() > 0:
             res = faiss.StandardGpuResources()
@@ -251,7 +338,13 @@ class IndexBuilder:
         query_feature = query_feature.reshape(1, -1)
             
         # Tìm kiếm ảnh tương tự
-        distances, indices = self.index.search(query_feature, top_k)
+        if self.raw_vectors is not None and self.rerank_factor > 1:
+            # Index nén / giảm chiều: lấy nhiều ứng viên hơn rồi xếp hạng lại bằng vector gốc 2048 chiều
+            candidates = min(max(top_k * self.rerank_factor, self.min_candidates), max(self.index.ntotal, 1))
+            _, candidate_indices = self.index.search(query_feature, candidates)
+            distances, indices = rerank_exact(query_feature, candidate_indices, self.raw_vectors, top_k)
+        else:
+            distances, indices = self.index.search(query_feature, top_k)
         
         # Tạo kết quả
         results = []
@@ -1,8 +1,9 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
+from django.conf import settings
 from datetime import timedelta
 import os
-from media.models import Image , INDEX_PATH, MAPPING_PATH
+from media.models import Image , INDEX_PATH, MAPPING_PATH, resnet_extractor_options
 from imageretrieval.incremental_update  import IndexUpdater
 
 class Command(BaseCommand):
@@ -27,7 +28,10 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        updater = IndexUpdater()
+        updater = IndexUpdater(storage=getattr(settings, 'RESNET_INDEX_STORAGE', 'float32'),
+                               pca_dim=getattr(settings, 'RESNET_INDEX_PCA_DIM', 0),
+                               min_candidates=getattr(settings, 'RESNET_RERANK_MIN_CANDIDATES', 200),
+                               extractor_options=resnet_extractor_options())
         
         # Xử lý tùy chọn rebuild (xây dựng lại)
         if options['rebuild']:
@@ -69,8 +73,8 @@ class Command(BaseCommand):
                 # Khởi tạo index với batch đầu tiên
                 features, valid_images = updater.extractor.extract_features_from_s3_data(batch, batch_size)
                 if features.shape[0] > 0:
-                    updater.index = updater.index.__class__(updater.feature_dim)
-                    updater.index.add(features)
+                    updater.reset_index()
+                    updater.add_features(features)
                     updater.image_data = valid_images
                     processed += len(valid_images)
             else:
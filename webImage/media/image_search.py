@@ -1,5 +1,6 @@
 from django.conf import settings  
 from imageretrieval.index_builder import IndexBuilder 
+from media.models import resnet_extractor_options
 
 # Tránh lỗi OpenMP
 import os
@@ -17,7 +18,9 @@ class ImageSearch:
         
     def __init__(self):
         """Khởi tạo ImageSearch với FAISS index"""
-        self.builder = IndexBuilder(use_gpu=True)
+        self.builder = IndexBuilder(use_gpu=True, rerank_factor=getattr(settings, 'RESNET_RERANK_FACTOR', 4),
+                                    min_candidates=getattr(settings, 'RESNET_RERANK_MIN_CANDIDATES', 200),
+                                    extractor_options=resnet_extractor_options())
         try:
             # Định nghĩa đường dẫn chính xác tới FAISS index và mapping
             index_path = settings.INDEX_DIR / "photo_index.faiss"
@@ -25,7 +28,7 @@ class ImageSearch:
             print(f"🔄 Đang tải index từ: {index_path}")
             print(f"🔄 Đang tải mapping từ: {mapping_path}")
             
-            self.builder.load(index_path, mapping_path)
+            self.builder.load(index_path, mapping_path, mmap=getattr(settings, 'RESNET_INDEX_MMAP', False))
             print(f"✅ Đã tải FAISS index với {self.builder.index.ntotal} ảnh")
         except Exception as e:
             print(f"❌ Không thể tải FAISS index: {e}")
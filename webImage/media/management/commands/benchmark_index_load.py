@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+def _memory_kb():
+    """RSS của process hiện tại: phần riêng (anon) và phần map từ file (dùng chung page cache)"""
+    usage = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS', 'RssAnon', 'RssFile')):
+                name, value = line.split(':', 1)
+                usage[name] = int(value.split()[0])
+    return usage
+
+
+def _load_worker(index_path, embedding_path, mmap, start_event, results):
+    """Chạy trong process con: đọc index + embeddings như một worker Django rồi đo thời gian / RSS"""
+    from clip_retrieval.index_factory import read_index
+
+    start_event.wait()
+    before = _memory_kb()
+    started = time.perf_counter()
+
+    index = read_index(index_path, mmap=mmap)
+    embeddings = np.load(embedding_path, mmap_mode='r' if mmap else None) if embedding_path else None
+    load_seconds = time.perf_counter() - started
+
+    # Một truy vấn + đọc toàn bộ embeddings, để các trang thực sự được nạp vào bộ nhớ
+    query = np.zeros((1, index.d), dtype='float32')
+    index.search(query, 10)
+    if embeddings is not None:
+        float(np.asarray(embeddings).sum())
+    first_query_seconds = time.perf_counter() - started - load_seconds
+
+    after = _memory_kb()
+    results.put({
+        'load_ms': load_seconds * 1000,
+        'first_query_ms': first_query_seconds * 1000,
+        'rss_mb': after.get('VmRSS', 0) / 1024.0,
+        'private_mb': (after.get('RssAnon', 0) - before.get('RssAnon', 0)) / 1024.0,
+        'shared_mb': (after.get('RssFile', 0) - before.get('RssFile', 0)) / 1024.0,
+    })
+
+
+class Command(BaseCommand):
+    help = 'So sánh thời gian khởi động và RSS khi đọc index bình thường và khi memory-map (nhiều worker)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', choices=['clip', 'resnet'], default='clip',
+                            help='Index cần đo (mặc định: clip)')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Số process đọc index đồng thời (mặc định: 4)')
+
+    def handle(self, *args, **options):
+        if options['index'] == 'clip':
+            index_path = os.path.join(settings.INDEX_CLIP_DIR, 'clip_faiss.index')
+            embedding_path = os.path.join(settings.INDEX_CLIP_DIR, 'clip_image_embeddings.npy')
+        else:
+            from imageretrieval.index_builder import IndexBuilder
+            index_path = os.path.join(settings.INDEX_DIR, 'photo_index.faiss')
+            embedding_path = IndexBuilder.raw_vectors_path(index_path)
+        if not os.path.exists(embedding_path):
+            embedding_path = None
+
+        size_mb = sum(os.path.getsize(p) for p in (index_path, embedding_path) if p) / (1024.0 * 1024.0)
+        self.stdout.write(f"📦 {options['index']} index: {size_mb:.1f} MB trên đĩa, {options['workers']} worker")
+        self.stdout.write(f"{'mode':<8}{'load ms':>10}{'1st query ms':>14}{'RSS MB':>10}"
+                          f"{'private MB':>12}{'shared MB':>11}")
+
+        for mode in ('heap', 'mmap'):
+            rows = self._run(index_path, embedding_path, mode == 'mmap', options['workers'])
+            avg = {key: sum(row[key] for row in rows) / len(rows) for key in rows[0]}
+            self.stdout.write(
+                f"{mode:<8}{avg['load_ms']:>10.1f}{avg['first_query_ms']:>14.1f}{avg['rss_mb']:>10.1f}"
+                f"{avg['private_mb']:>12.1f}{avg['shared_mb']:>11.1f}"
+            )
+            self.stdout.write(f"         tổng bộ nhớ riêng của {len(rows)} worker: "
+                              f"{sum(row['private_mb'] for row in rows):.1f} MB")
+
+    def _run(self, index_path, embedding_path, mmap, workers):
+        # spawn: mỗi worker là một process mới, không kế thừa trang bộ nhớ của process cha
+        context = multiprocessing.get_context('spawn')
+        start_event = context.Event()
+        results = context.Queue()
+        processes = [
+            context.Process(target=_load_worker, args=(index_path, embedding_path, mmap, start_event, results))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        start_event.set()
+        rows = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        return rows
@@ -0,0 +1,91 @@
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from model_inference.encoders import (
+    BACKENDS, QUANTIZATIONS, SAMPLE_QUERIES, InferenceParityError, build_encoder, check_parity, configure_threads,
+    measure_throughput, sample_images, to_channels_last
+)
+
+
+class Command(BaseCommand):
+    help = 'Đo throughput (ảnh/s, truy vấn/s) và parity với eager của từng backend inference trên CPU'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=['clip', 'resnet', 'all'], default='all',
+                            help='Encoder cần đo (mặc định: all)')
+        parser.add_argument('--backends', default=','.join(BACKENDS),
+                            help='Danh sách backend, phân tách bằng dấu phẩy (mặc định: tất cả)')
+        parser.add_argument('--quantization', default=','.join(QUANTIZATIONS),
+                            help='Danh sách kiểu lượng tử hoá, phân tách bằng dấu phẩy (mặc định: tất cả)')
+        parser.add_argument('--batch-size', type=int, default=16,
+                            help='Số input mỗi lần encode (mặc định: 16)')
+        parser.add_argument('--seconds', type=float, default=3.0,
+                            help='Thời gian đo cho mỗi backend (mặc định: 3)')
+        parser.add_argument('--threads', type=int, default=0,
+                            help='Số luồng intra-op, 0 = mặc định của torch')
+        parser.add_argument('--channels-last', action='store_true',
+                            help='Chạy encoder ảnh với bộ nhớ channels_last')
+
+    def handle(self, *args, **options):
+        backends = [name.strip() for name in options['backends'].split(',') if name.strip()]
+        quantizations = [name.strip() for name in options['quantization'].split(',') if name.strip()]
+        unknown = set(backends) - set(BACKENDS) | set(quantizations) - set(QUANTIZATIONS)
+        if unknown:
+            raise CommandError(f"Unknown backend / quantization: {', '.join(sorted(unknown))}")
+        configure_threads(options['threads'])
+
+        failures = []
+        for name, module, forward, samples, unit, channels_last in self._encoders(options):
+            self.stdout.write(f"\n🧪 {name} ({len(samples)} input mẫu, batch {options['batch_size']})")
+            self.stdout.write(f"{'backend':<14}{'quant':<10}{unit:>12}{'speedup':>10}{'cosine':>10}")
+            artifact_dir = tempfile.mkdtemp(prefix='benchmark-inference-')
+            eager = build_encoder(name, module, forward, samples)
+            baseline = None
+
+            for backend in backends:
+                for quantization in (['none'] if backend == 'eager' else quantizations):
+                    label = f"{backend:<14}{quantization:<10}"
+                    try:
+                        encoder = build_encoder(
+                            name, module, forward, samples, backend=backend, quantization=quantization,
+                            artifact_dir=artifact_dir, num_threads=options['threads'],
+                            channels_last=channels_last, strict=True
+                        )
+                        similarity = check_parity(eager, encoder, samples, threshold=-1)
+                        rate = measure_throughput(encoder, samples, options['batch_size'], options['seconds'])
+                    except InferenceParityError as e:
+                        failures.append(str(e))
+                        self.stdout.write(f"{label}❌ {e}")
+                        continue
+                    except Exception as e:
+                        self.stdout.write(f"{label}⚠️ không hỗ trợ: {str(e).splitlines()[0][:120]}")
+                        continue
+
+                    if baseline is None and backend == 'eager':
+                        baseline = rate
+                    speedup = f"{rate / baseline:.2f}x" if baseline else '-'
+                    self.stdout.write(f"{label}{rate:>12.1f}{speedup:>10}{similarity:>10.4f}")
+
+        if failures:
+            raise CommandError("Backend không đạt parity với eager:\n" + "\n".join(failures))
+
+    def _encoders(self, options):
+        """(tên, module, forward, input mẫu, đơn vị throughput, channels_last) của từng encoder cần đo"""
+        if options['model'] in ('clip', 'all'):
+            import clip
+
+            model, preprocess = clip.load("ViT-B/32", "cpu")
+            if options['channels_last']:
+                to_channels_last(model.visual)
+            yield ('clip-vit-b32-text', model, lambda m, tokens: m.encode_text(tokens),
+                   clip.tokenize(SAMPLE_QUERIES), 'queries/s', False)
+            yield ('clip-vit-b32-image', model, lambda m, images: m.encode_image(images),
+                   sample_images(preprocess), 'images/s', options['channels_last'])
+
+        if options['model'] in ('resnet', 'all'):
+            from imageretrieval.feature_extractor import FeatureExtractor
+
+            extractor = FeatureExtractor(use_gpu=False, channels_last=options['channels_last'])
+            yield ('resnet50', extractor.model, lambda m, images: m(images).flatten(1),
+                   sample_images(extractor.transform), 'images/s', options['channels_last'])
@@ -0,0 +1,77 @@
+import os
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from clip_retrieval.index_factory import INDEX_TYPES, STORAGE_TYPES, storage_report, two_stage_report
+from imageretrieval.index_builder import IndexBuilder
+
+
+class Command(BaseCommand):
+    help = ('So sánh bytes/ảnh và recall của các kiểu lưu trữ (float32, float16, int8, pq) cho CLIP hoặc ResNet index; '
+            'với --pca: latency / recall của tìm kiếm hai tầng (PCA + re-rank)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--index', choices=['clip', 'resnet'], default='clip',
+                            help='Index cần đánh giá (mặc định: clip)')
+        parser.add_argument('--type', choices=INDEX_TYPES, default='flat',
+                            help='Cấu trúc index dùng khi so sánh (mặc định: flat)')
+        parser.add_argument('--storage', nargs='+', choices=STORAGE_TYPES, default=list(STORAGE_TYPES),
+                            help='Các kiểu lưu trữ cần so sánh')
+        parser.add_argument('--k', type=int, default=10, help='Recall@k (mặc định: 10)')
+        parser.add_argument('--rerank-factor', type=int, default=4,
+                            help='Số ứng viên (x k) được re-rank chính xác (mặc định: 4)')
+        parser.add_argument('--pca', nargs='+', type=int, default=None,
+                            help='So sánh tìm kiếm hai tầng với các số chiều PCA này (ví dụ: --pca 64 128)')
+        parser.add_argument('--candidates', type=int, default=200,
+                            help='Số ứng viên tầng PCA được re-rank chính xác (mặc định: 200)')
+        parser.add_argument('--sample', type=int, default=0,
+                            help='Chỉ dùng N vector ngẫu nhiên (0 = tất cả)')
+
+    def handle(self, *args, **options):
+        vectors = self._load_vectors(options['index'])
+        if options['sample'] and options['sample'] < len(vectors):
+            rng = np.random.default_rng(0)
+            vectors = vectors[np.sort(rng.choice(len(vectors), options['sample'], replace=False))]
+
+        self.stdout.write(f"📊 {options['index']} index: {vectors.shape[0]} vector x {vectors.shape[1]} chiều")
+        if options['pca']:
+            return self._two_stage(vectors, options)
+        rows = storage_report(vectors, options['type'], options['storage'], k=options['k'],
+                              rerank_factor=options['rerank_factor'])
+
+        k = options['k']
+        self.stdout.write(f"{'storage':<10}{'factory':<22}{'bytes/ảnh':>12}{'x nhỏ hơn':>12}"
+                          f"{f'recall@{k}':>12}{'+ re-rank':>12}")
+        for row in rows:
+            self.stdout.write(
+                f"{row['storage']:<10}{row['factory']:<22}{row['bytes_per_image']:>12}"
+                f"{row['raw_bytes_per_image'] / max(row['bytes_per_image'], 1e-9):>12.1f}"
+                f"{row[f'recall_at_{k}']:>12}{row[f'recall_at_{k}_reranked']:>12}"
+            )
+
+    def _two_stage(self, vectors, options):
+        k = options['k']
+        storage = options['storage'][0] if len(options['storage']) == 1 else 'float32'
+        rows = two_stage_report(vectors, options['pca'], options['type'], storage, k=k,
+                                candidates=options['candidates'])
+        self.stdout.write(f"{'chiều':<8}{'factory':<22}{'ứng viên':>10}{'bytes/ảnh':>12}"
+                          f"{'recall thô':>12}{f'recall@{k}':>12}{'ms/query':>10}")
+        for row in rows:
+            self.stdout.write(
+                f"{row['pca_dim']:<8}{row['factory']:<22}{row['candidates']:>10}{row['bytes_per_image']:>12}"
+                f"{row[f'recall_at_{k}_coarse']:>12}{row[f'recall_at_{k}']:>12}{row['ms_per_query']:>10}"
+            )
+
+    def _load_vectors(self, name):
+        if name == 'clip':
+            return np.load(os.path.join(settings.INDEX_CLIP_DIR, 'clip_image_embeddings.npy')).astype('float32')
+
+        index_path = os.path.join(settings.INDEX_DIR, 'photo_index.faiss')
+        raw_path = IndexBuilder.raw_vectors_path(index_path)
+        if os.path.exists(raw_path):
+            return np.load(raw_path).astype('float32')
+        index = faiss.read_index(index_path)
+        return index.reconstruct_n(0, index.ntotal)
@@ -0,0 +1,106 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from clip_retrieval import index_queue
+
+
+class Command(BaseCommand):
+    help = 'Worker xử lý hàng đợi index CLIP theo batch (tải ảnh song song, encode một lần, ghi WAL một lần)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=32,
+                            help='Số job tối đa mỗi batch (mặc định: 32)')
+        parser.add_argument('--wait-ms', type=int, default=200,
+                            help='Thời gian gom thêm job sau job đầu tiên (mặc định: 200ms)')
+        parser.add_argument('--fetch-workers', type=int, default=getattr(settings, 'CLIP_INDEX_FETCH_WORKERS', 8),
+                            help='Số luồng tải ảnh song song (mặc định: CLIP_INDEX_FETCH_WORKERS)')
+        parser.add_argument('--once', action='store_true',
+                            help='Xử lý hết các job hiện có rồi thoát')
+
+    def handle(self, *args, **options):
+        # Với search daemon, daemon là nơi duy nhất sửa index; worker chỉ gửi batch qua socket
+        from media.models import get_clip_search
+        clip_search = get_clip_search()
+
+        self._recover()
+        self.stdout.write(
+            f"🚀 Worker index CLIP {index_queue.consumer_id()} đang chạy ({index_queue.queue_length()} job đang chờ, "
+            f"{index_queue.dead_letter_length()} job trong dead-letter)"
+        )
+
+        last_recovery = time.monotonic()
+        while True:
+            jobs = index_queue.pop_batch(options['batch_size'], timeout=1 if options['once'] else 5,
+                                         wait_ms=options['wait_ms'])
+            if not jobs:
+                if options['once']:
+                    break
+                # Lúc rảnh: lấy lại job của các worker đã chết (heartbeat hết hạn)
+                if time.monotonic() - last_recovery >= index_queue.HEARTBEAT_TTL:
+                    self._recover()
+                    last_recovery = time.monotonic()
+                continue
+
+            started = time.monotonic()
+            adds, removes, metadata_updates = index_queue.coalesce(jobs)
+            try:
+                removed = clip_search.remove_images_from_index(removes) if removes else []
+                updated = clip_search.update_metadata_for_images(metadata_updates) if metadata_updates else []
+                # Ảnh chưa có trong index (ví dụ add trước đó bị lỗi): index đầy đủ
+                updated_set = set(updated)
+                adds += [image_id for image_id in metadata_updates if image_id not in updated_set]
+                indexed = clip_search.update_index_for_images(adds, fetch_workers=options['fetch_workers']) if adds else []
+            except Exception as e:
+                # Trả batch về hàng đợi và thử lại sau; job lỗi quá nhiều lần vào dead-letter
+                self.stderr.write(self.style.ERROR(f"❌ Lỗi khi xử lý batch {len(jobs)} job: {e}"))
+                self._mark_dead(index_queue.retry_batch(jobs))
+                time.sleep(5)
+                continue
+
+            for image_id in removes:
+                index_queue.set_status(image_id, 'removed')
+            for image_id in updated:
+                index_queue.set_status(image_id, 'indexed')
+            indexed_set = set(indexed)
+            # Ảnh chưa có trong database (transaction tạo ảnh chưa commit): thử lại sau thay vì bỏ job
+            not_visible = self._not_visible([image_id for image_id in adds if image_id not in indexed_set])
+            for image_id in adds:
+                if image_id not in not_visible:
+                    index_queue.set_status(image_id, 'indexed' if image_id in indexed_set else 'failed')
+            retry = {}
+            for job in jobs:
+                if job['op'] != index_queue.OP_REMOVE and job['image_id'] in not_visible:
+                    retry[job['image_id']] = job
+            index_queue.ack_batch([job for job in jobs if job not in retry.values()])
+            if retry:
+                self._mark_dead(index_queue.retry_batch(list(retry.values())))
+                time.sleep(1)
+
+            self.stdout.write(
+                f"✅ Batch {len(jobs)} job: +{len(indexed)}/{len(adds)} ảnh, -{len(removed)} ảnh, "
+                f"~{len(updated)} metadata "
+                f"trong {(time.monotonic() - started) * 1000:.0f}ms"
+            )
+
+    def _not_visible(self, image_ids):
+        """Các id chưa đọc được từ database (job tới trước khi row được commit)"""
+        if not image_ids:
+            return set()
+        from media.models import Image
+        return set(image_ids) - set(Image.objects.filter(id__in=image_ids).values_list('id', flat=True))
+
+    def _recover(self):
+        requeued, dead = index_queue.requeue_unfinished()
+        if requeued:
+            self.stdout.write(f"♻️ Đưa lại {requeued} job chưa hoàn tất vào hàng đợi")
+        self._mark_dead(dead)
+
+    def _mark_dead(self, jobs):
+        for job in jobs:
+            index_queue.set_status(job['image_id'], 'failed')
+        if jobs:
+            self.stderr.write(self.style.ERROR(
+                f"☠️ {len(jobs)} job đã lỗi {index_queue.MAX_ATTEMPTS} lần, chuyển sang {index_queue.DEAD_LETTER_KEY}"
+            ))
@@ -0,0 +1,135 @@
+import json
+import os
+
+import faiss
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from clip_retrieval.index_factory import INDEX_TYPES, STORAGE_TYPES, build_index, describe_index, save_index_info
+from clip_retrieval.query_cache import CacheGeneration
+from clip_retrieval.snapshot import (
+    SNAPSHOT_FILES, WAL_NAME, acquire_snapshot_lock, commit_snapshot, pending_path, recover_snapshot,
+    release_snapshot_lock
+)
+from clip_retrieval.wal import OP_ADD, IndexWAL
+
+INDEX_DIR = settings.INDEX_CLIP_DIR
+
+
+class Command(BaseCommand):
+    help = 'Xây dựng lại CLIP FAISS index từ embeddings đã lưu (không cần encode lại ảnh)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--type',
+            choices=INDEX_TYPES,
+            default=getattr(settings, 'CLIP_INDEX_TYPE', 'flat'),
+            help='Loại index: flat, ivf_flat, ivf_pq, hnsw (mặc định: CLIP_INDEX_TYPE)'
+        )
+        parser.add_argument(
+            '--storage',
+            choices=STORAGE_TYPES,
+            default=getattr(settings, 'CLIP_INDEX_STORAGE', 'float32'),
+            help='Kiểu lưu vector: float32, float16, int8, pq (mặc định: CLIP_INDEX_STORAGE)'
+        )
+        parser.add_argument('--pca-dim', type=int, default=getattr(settings, 'CLIP_INDEX_PCA_DIM', 0),
+                            help='Giảm chiều bằng PCA trước khi vào index, 0 = không giảm (mặc định: CLIP_INDEX_PCA_DIM)')
+        parser.add_argument('--nlist', type=int, default=getattr(settings, 'CLIP_IVF_NLIST', None),
+                            help='Số cluster IVF (mặc định: tự tính theo số ảnh)')
+        parser.add_argument('--nprobe', type=int, default=getattr(settings, 'CLIP_IVF_NPROBE', 16),
+                            help='nprobe dùng khi đo recall (IVF)')
+        parser.add_argument('--ef-search', type=int, default=getattr(settings, 'CLIP_HNSW_EF_SEARCH', 64),
+                            help='efSearch dùng khi đo recall (HNSW)')
+        parser.add_argument('--train-size', type=int, default=100000,
+                            help='Số vector tối đa dùng để train index (mặc định: 100000)')
+
+    def handle(self, *args, **options):
+        # Worker đang chạy có thể đang ghi snapshot vào cùng thư mục
+        token = acquire_snapshot_lock()
+        if not token:
+            self.stdout.write(self.style.ERROR("❌ Một worker đang ghi snapshot CLIP index, hãy thử lại sau"))
+            return
+        try:
+            self._rebuild(options)
+        finally:
+            release_snapshot_lock(token)
+
+    def _rebuild(self, options):
+        # Snapshot gần nhất + các thay đổi trong WAL chưa được gộp vào snapshot
+        manifest = recover_snapshot(INDEX_DIR)
+        wal = IndexWAL(os.path.join(INDEX_DIR, WAL_NAME))
+        records = wal.replay(after_seq=manifest['seq'] if manifest else 0)
+
+        embeddings = np.load(os.path.join(INDEX_DIR, 'clip_image_embeddings.npy'))
+        with open(os.path.join(INDEX_DIR, 'image_ids.json'), 'r') as f:
+            image_ids = json.load(f)
+        with open(os.path.join(INDEX_DIR, 'image_urls.json'), 'r') as f:
+            image_urls = json.load(f)
+        with open(os.path.join(INDEX_DIR, 'image_metadata.json'), 'r') as f:
+            metadata_by_id = {item['id']: item for item in json.load(f)}
+
+        if len(image_ids) != embeddings.shape[0]:
+            self.stdout.write(self.style.ERROR(
+                f"❌ {len(image_ids)} ids nhưng có {embeddings.shape[0]} embeddings, không thể rebuild"
+            ))
+            return
+
+        # Bỏ luôn các vị trí đã bị xoá (tombstone) khi rebuild
+        tombstone_path = os.path.join(INDEX_DIR, 'tombstones.json')
+        tombstones = set()
+        if os.path.exists(tombstone_path):
+            with open(tombstone_path, 'r') as f:
+                tombstones = set(json.load(f))
+        live = {}
+        for pos, image_id in enumerate(image_ids):
+            if pos not in tombstones:
+                live[image_id] = (embeddings[pos], image_urls[pos])
+
+        for record in records:
+            live.pop(record.image_id, None)
+            if record.op == OP_ADD:
+                live[record.image_id] = (record.vector, record.metadata.get('file'))
+                metadata_by_id[record.image_id] = record.metadata
+            else:
+                metadata_by_id.pop(record.image_id, None)
+
+        image_ids = list(live)
+        image_urls = [url for _, url in live.values()]
+        embeddings = np.ascontiguousarray(
+            np.stack([vector for vector, _ in live.values()]) if live else embeddings[:0], dtype='float32'
+        )
+        metadata = [metadata_by_id[image_id] for image_id in image_ids if image_id in metadata_by_id]
+
+        self.stdout.write(f"🔨 Đang xây dựng index {options['type']} cho {len(image_ids)} ảnh...")
+        index, description = build_index(
+            embeddings, options['type'], nlist=options['nlist'], train_size=options['train_size'],
+            storage=options['storage'], pca_dim=options['pca_dim']
+        )
+        info = describe_index(index, description, options['type'], embeddings,
+                              options['nprobe'], options['ef_search'], storage=options['storage'],
+                              rerank_factor=getattr(settings, 'CLIP_RERANK_FACTOR', 4),
+                              min_candidates=getattr(settings, 'CLIP_RERANK_MIN_CANDIDATES', 200))
+
+        # Ghi dưới dạng một snapshot mới (file tạm + manifest + rename), rồi xoá WAL đã được gộp vào
+        faiss.write_index(index, pending_path(INDEX_DIR, 'clip_faiss.index'))
+        with open(pending_path(INDEX_DIR, 'clip_image_embeddings.npy'), 'wb') as f:
+            np.save(f, embeddings)
+        for name, data in (('image_ids.json', image_ids), ('image_urls.json', image_urls),
+                           ('image_metadata.json', metadata), ('tombstones.json', [])):
+            with open(pending_path(INDEX_DIR, name), 'w') as f:
+                json.dump(data, f)
+        save_index_info(pending_path(INDEX_DIR, 'index_info.json'), info)
+        # Chỉ các bản ghi đã replay ở trên nằm trong snapshot; bản ghi worker khác ghi thêm trong lúc
+        # rebuild (seq lớn hơn) vẫn được giữ lại trong WAL
+        seq = max((record.seq for record in records), default=manifest['seq'] if manifest else 0)
+        rebuild = (manifest.get('rebuild', 0) if manifest else 0) + 1
+        commit_snapshot(INDEX_DIR, SNAPSHOT_FILES, seq, rebuild=rebuild)
+        wal.truncate(through_seq=seq)
+        # Engine đang chạy thấy số rebuild mới trong manifest và load lại; kết quả cache của index cũ bị bỏ
+        CacheGeneration('clip_search').bump()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Đã lưu index {description} ({index.ntotal} vector), "
+            f"recall@10 so với flat: {info['recall_at_10_vs_flat']}"
+        ))
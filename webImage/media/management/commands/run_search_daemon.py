@@ -0,0 +1,39 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Chạy search daemon giữ CLIP model + FAISS index, phục vụ các web worker qua Unix socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=getattr(settings, 'CLIP_SEARCH_SOCKET', '') or None,
+                            help='Đường dẫn Unix socket (mặc định: CLIP_SEARCH_SOCKET)')
+
+    def handle(self, *args, **options):
+        socket_path = options['socket']
+        if not socket_path:
+            raise CommandError('Cần --socket hoặc CLIP_SEARCH_SOCKET')
+
+        from clip_retrieval.clip_search import CLIPImageSearch
+        from clip_retrieval.search_server import SearchServer
+
+        # Daemon luôn dùng engine trong process (không tự kết nối tới chính nó)
+        engine = CLIPImageSearch.get_instance()
+        server = SearchServer(engine, socket_path)
+
+        def shutdown(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, shutdown)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"🚀 Search daemon đang lắng nghe tại {socket_path} ({engine.snapshot.size} vector)"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write("👋 Search daemon đã dừng")
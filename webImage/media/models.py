@@ -1,13 +1,11 @@
 import os
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils.timezone import now
 from django.utils.timesince import timesince
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.conf import settings
-from imageretrieval.incremental_update import IndexUpdater
-from clip_retrieval.clip_search import CLIPImageSearch
 from pathlib import Path
 
 
@@ -21,21 +19,74 @@ INDEX_DIR = settings.INDEX_DIR
 INDEX_PATH = os.path.join(settings.INDEX_DIR, "photo_index.faiss")
 MAPPING_PATH = os.path.join(settings.INDEX_DIR, "photo_mapping.pkl")
 
+
+def resnet_extractor_options():
+    """Backend inference của ResNet50 theo settings (truyền cho IndexBuilder -> FeatureExtractor)"""
+    return {
+        'backend': getattr(settings, 'RESNET_INFERENCE_BACKEND', 'eager'),
+        'quantization': getattr(settings, 'RESNET_INFERENCE_QUANTIZATION', 'none'),
+        'artifact_dir': getattr(settings, 'INFERENCE_ARTIFACT_DIR', None),
+        'num_threads': getattr(settings, 'INFERENCE_NUM_THREADS', 0),
+        'channels_last': getattr(settings, 'INFERENCE_CHANNELS_LAST', False),
+    }
+
 INDEX_CLIP_DIR = settings.INDEX_CLIP_DIR
 INDEX_CLIP_PATH = os.path.join(settings.INDEX_CLIP_DIR, "photo_index_clip.faiss")
 MAPPING_CLIP_PATH = os.path.join(settings.INDEX_CLIP_DIR, "photo_mapping_clip.pkl")
 
 # Replace the module-level instantiation with a function to get the singleton instance
 def get_clip_search():
+    """Engine CLIP trong process, hoặc client tới search daemon nếu CLIP_SEARCH_SOCKET được cấu hình"""
+    socket_path = getattr(settings, 'CLIP_SEARCH_SOCKET', '')
+    if socket_path:
+        from clip_retrieval.search_client import CLIPSearchClient
+        return CLIPSearchClient.get_instance(socket_path, timeout=getattr(settings, 'CLIP_SEARCH_TIMEOUT', 30))
+    # Import lazily: torch / clip / faiss are only loaded when a search actually needs them
+    from clip_retrieval.clip_search import CLIPImageSearch
     return CLIPImageSearch.get_instance()
 
+# Thêm / xoá ảnh khỏi CLIP index được đưa vào hàng đợi, worker process_index_queue xử lý theo batch
+INDEX_QUEUE_ENABLED = getattr(settings, 'CLIP_INDEX_QUEUE_ENABLED', True)
+
+def queue_clip_index_update(image_id, remove=False, metadata=False):
+    """
+    Đưa job add / remove vào hàng đợi; nếu hàng đợi không dùng được thì cập nhật trực tiếp.
+    metadata=True: chỉ title / description đổi, không tải / encode lại ảnh.
+    """
+    if INDEX_QUEUE_ENABLED:
+        try:
+            from clip_retrieval import index_queue
+            if remove:
+                index_queue.enqueue_remove(image_id)
+            elif metadata:
+                index_queue.enqueue_metadata(image_id)
+            else:
+                index_queue.enqueue_add(image_id)
+            return 'pending'
+        except Exception as e:
+            print(f"⚠️ Không thể đưa image #{image_id} vào hàng đợi index: {e}. Cập nhật trực tiếp.")
+
+    clip_search = get_clip_search()
+    if remove:
+        return 'removed' if clip_search.remove_from_index(image_id) else 'not_indexed'
+    if metadata and clip_search.update_metadata_for_images([image_id]):
+        return 'indexed'
+    clip_search.update_index_for_image(image_id)
+    return 'indexed'
+
 # Singleton pattern để giữ updater trong bộ nhớ
 _updater_instance = None
 
 def get_updater():
     global _updater_instance
     if _updater_instance is None:
-        _updater_instance = IndexUpdater()
+        from imageretrieval.incremental_update import IndexUpdater
+        _updater_instance = IndexUpdater(
+            storage=getattr(settings, 'RESNET_INDEX_STORAGE', 'float32'),
+            pca_dim=getattr(settings, 'RESNET_INDEX_PCA_DIM', 0),
+            min_candidates=getattr(settings, 'RESNET_RERANK_MIN_CANDIDATES', 200),
+            extractor_options=resnet_extractor_options()
+        )
         # Tạo thư mục nếu chưa tồn tại
         os.makedirs(INDEX_DIR, exist_ok=True)
         # Nếu index đã tồn tại, load nó
@@ -101,6 +152,8 @@ class Image(models.Model):
         # Kiểm tra nếu đây là cập nhật (không phải tạo mới) 
         # và trạng thái is_public đã thay đổi
         is_update = self.pk is not None
+        metadata_changed = False
+        index_update = None
         
         if is_update:
             try:
@@ -109,52 +162,54 @@ class Image(models.Model):
                 
                 # Xử lý thay đổi trạng thái is_public
                 if was_public != self.is_public:
-                    if self.is_public:
-                        # Ảnh từ private -> public: thêm vào index
-                        self._add_to_indices()
-                    else:
-                        # Ảnh từ public -> private: xóa khỏi index
-                        self._remove_from_indices()
+                    # private -> public: thêm vào index; public -> private: xóa khỏi index
+                    index_update = self._add_to_indices if self.is_public else self._remove_from_indices
+                else:
+                    metadata_changed = self.is_public and (
+                        (old_instance.title, old_instance.description) != (self.title, self.description)
+                    )
             except Exception as e:
                 print(f"Lỗi khi kiểm tra thay đổi is_public: {e}")
         
         # Lưu bình thường
         super().save(*args, **kwargs)
+        if index_update is not None:
+            # Sau khi commit: worker đọc row mới, metadata trong index có đúng is_public
+            transaction.on_commit(index_update)
+        if metadata_changed:
+            # Sửa title / description: cập nhật sau khi commit để worker đọc được nội dung mới
+            # (lexical index BM25 + metadata của kết quả tìm kiếm; vector không đổi)
+            transaction.on_commit(self._update_index_metadata)
         self.user.update_counts()
           # Cache ảnh khi lưu
         from django.core.cache import cache
         cache_key = f'image:{self.id}'
         cache.set(cache_key, self, 60*60*24)  # Cache trong 24 giờ
+        # Card trong kết quả tìm kiếm được render lại ở lần tìm kiếm sau
+        from .search_hydration import invalidate_card
+        invalidate_card(self.id)
     
     def _add_to_indices(self):
-        """Thêm ảnh vào CLIP index tìm kiếm"""
-        # Thêm vào CLIP index
+        """Thêm ảnh vào CLIP index tìm kiếm (qua hàng đợi)"""
         try:
-            get_clip_search().update_index_for_image(self.id)
-            print(f"✅ Added image #{self.id} to CLIP index due to visibility change")
+            status = queue_clip_index_update(self.id)
+            print(f"✅ Image #{self.id} CLIP indexing {status}")
         except Exception as e:
             print(f"❌ Error adding image #{self.id} to CLIP index: {e}")
     
+    def _update_index_metadata(self):
+        """Cập nhật title / description của ảnh trong CLIP index (qua hàng đợi, không encode lại ảnh)"""
+        try:
+            status = queue_clip_index_update(self.id, metadata=True)
+            print(f"✅ Image #{self.id} CLIP metadata update {status}")
+        except Exception as e:
+            print(f"❌ Error updating image #{self.id} metadata in CLIP index: {e}")
+    
     def _remove_from_indices(self):
-        """Xóa ảnh khỏi CLIP index tìm kiếm"""
-        # Xóa khỏi CLIP index
+        """Xóa ảnh khỏi CLIP index tìm kiếm (qua hàng đợi; worker bỏ qua ảnh không có trong index)"""
         try:
-            # Kiểm tra xem ảnh có tồn tại trong CLIP index hay không
-            clip_search = get_clip_search()
-            
-            # Kiểm tra sự tồn tại của ảnh trong metadata của index
-            image_exists = False
-            for img_id in clip_search.image_ids:
-                if str(img_id) == str(self.id):
-                    image_exists = True
-                    break
-            
-            if image_exists:
-                # Sử dụng phương thức remove_from_index đã sửa đổi (bỏ rebuild)
-                clip_search.remove_from_index(self.id)
-                print(f"✅ Removed image #{self.id} from CLIP index due to visibility change")
-            else:
-                print(f"⚠️ Image #{self.id} not found in CLIP index, skipping removal")
+            status = queue_clip_index_update(self.id, remove=True)
+            print(f"✅ Image #{self.id} CLIP removal {status} due to visibility change")
         except Exception as e:
             print(f"❌ Error removing image #{self.id} from CLIP index: {e}")
     
@@ -251,12 +306,9 @@ class Image(models.Model):
 def update_clip_index(sender, instance, created, **kwargs):
     """Update CLIP index when a new image is added"""
     if created and instance.is_public:  # Only process if the image is newly created and public
-        # Update CLIP index
-        try:
-            get_clip_search().update_index_for_image(instance.id)
-            print(f"✅ Successfully added image #{instance.id} to the CLIP index")
-        except Exception as e:
-            print(f"❌ Error updating CLIP index for image #{instance.id}: {e}")
+        # Update CLIP index (queued, the response does not wait for download + encode)
+        # Chỉ đưa vào hàng đợi sau khi commit: worker chạy trước đó sẽ không thấy row mới
+        transaction.on_commit(instance._add_to_indices)
 
 
 @receiver(post_delete, sender=Image)
@@ -265,24 +317,20 @@ def remove_image_from_index(sender, instance, **kwargs):
     # Cập nhật số lượng ảnh cho user
     if instance.user:
         instance.user.update_counts()
+    from .search_hydration import invalidate_card
+    invalidate_card(instance.id)
     if instance.is_public:  # Only process if the image is public
-        # Remove from CLIP index
-        try:
-            # Kiểm tra xem ảnh có tồn tại trong CLIP index hay không
-            clip_search = get_clip_search()
-            # Kiểm tra sự tồn tại của ảnh trong metadata của index
-            image_exists = False
-            for img_id in clip_search.image_ids:
-                if str(img_id) == str(instance.id):
-                    image_exists = True
-                    break
-            if image_exists:
-                clip_search.remove_from_index(instance.id)
-                print(f"✅ Successfully removed image #{instance.id} from the CLIP index")
-            else:
-                print(f"⚠️ Image #{instance.id} not found in CLIP index, skipping removal")
-        except Exception as e:
-            print(f"❌ Error removing image #{instance.id} from the CLIP index: {e}")
+        # Remove from CLIP index (queued, after commit; instance.id is reset once the delete finishes)
+        image_id = instance.id
+        
+        def remove():
+            try:
+                status = queue_clip_index_update(image_id, remove=True)
+                print(f"✅ Image #{image_id} CLIP removal {status}")
+            except Exception as e:
+                print(f"❌ Error removing image #{image_id} from the CLIP index: {e}")
+        
+        transaction.on_commit(remove)
 
 class ImageCategory(models.Model):
     image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name="categories")
@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .models import Image
+
+# "Image card" đã render cho kết quả tìm kiếm: TTL ngắn, đọc một lần bằng MGET cho cả trang kết quả
+CARD_CACHE_TTL = getattr(settings, 'SEARCH_CARD_CACHE_TTL', 60)
+
+
+def card_key(image_id):
+    return f'search_card:{image_id}'
+
+
+def invalidate_card(image_id):
+    try:
+        cache.delete(card_key(image_id))
+    except Exception as e:
+        print(f"⚠️ Không thể xoá cache card của ảnh #{image_id}: {e}")
+
+
+def render_card(image):
+    """Thông tin một ảnh trong kết quả tìm kiếm (không phụ thuộc truy vấn hay người xem)"""
+    return {
+        'id': image.id,
+        'file': image.file.url if hasattr(image.file, 'url') else str(image.file),
+        'title': image.title,
+        'description': image.description,
+        'created_at': image.created_at,
+        'user': str(image.user),
+        'user_id': image.user_id,
+        'likes': image.likes,
+        'downloads': image.downloads,
+        'is_public': image.is_public,
+    }
+
+
+def visibility_filter(viewer_id=None):
+    """Ảnh public, hoặc ảnh của chính người xem (viewer_id là UserProfile id)"""
+    if viewer_id is None:
+        return Q(is_public=True)
+    return Q(is_public=True) | Q(user_id=viewer_id)
+
+
+def _visible(card, viewer_id):
+    return card['is_public'] or (viewer_id is not None and card['user_id'] == viewer_id)
+
+
+def load_cards(ids, viewer_id=None):
+    """
+    Card của các ảnh người xem được thấy: card có trong cache được đọc bằng một MGET,
+    phần còn lại bằng một query in_bulk (select_related user__user, lọc visibility trong SQL).
+
+    Returns:
+        dict: image_id -> card
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+
+    try:
+        cached = cache.get_many([card_key(image_id) for image_id in ids])
+    except Exception as e:
+        print(f"⚠️ Không đọc được cache card: {e}")
+        cached = {}
+    cards = {image_id: cached[card_key(image_id)] for image_id in ids if card_key(image_id) in cached}
+
+    missing = [image_id for image_id in ids if image_id not in cards]
+    if missing:
+        images = Image.objects.select_related('user__user').filter(visibility_filter(viewer_id)).in_bulk(missing)
+        rendered = {image_id: render_card(image) for image_id, image in images.items()}
+        cards.update(rendered)
+        if rendered:
+            try:
+                cache.set_many({card_key(image_id): card for image_id, card in rendered.items()}, CARD_CACHE_TTL)
+            except Exception as e:
+                print(f"⚠️ Không ghi được cache card: {e}")
+
+    # Card trong cache có thể là ảnh private của người khác: áp dụng lại cùng quy tắc visibility
+    return {image_id: card for image_id, card in cards.items() if _visible(card, viewer_id)}
+
+
+def attach_cards(results, cards):
+    """Card + similarity_score cho từng kết quả có card, giữ nguyên thứ tự"""
+    hydrated = []
+    for result in results:
+        card = cards.get(result.get('id'))
+        if card is None:
+            continue
+        item = dict(card)
+        item['similarity_score'] = result.get('similarity_score', 0)
+        hydrated.append(item)
+    return hydrated
+
+
+def hydrate_results(results, viewer_id=None):
+    """
+    Gắn dữ liệu database cho kết quả FAISS bằng load_cards().
+
+    Returns:
+        list: card + similarity_score, giữ nguyên thứ tự xếp hạng; ảnh đã xoá hoặc
+        người xem không được thấy bị bỏ qua.
+    """
+    return attach_cards(results, load_cards([result['id'] for result in results if result.get('id') is not None],
+                                            viewer_id))
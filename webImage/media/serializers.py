@@ -2,7 +2,6 @@ from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import Image, Category, Collection, UserProfile, ImageCategory, Notification , Follow, LikedImage, DownloadedImage
 from django.utils.timesince import timesince
-from .image_search import ImageSearch
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
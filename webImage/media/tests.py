@@ -1,3 +1,1799 @@
-from django.test import TestCase
+import importlib.util
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from clip_retrieval import index_queue, popular_queries, search_protocol
+from clip_retrieval.batcher import TextQueryBatcher
+from clip_retrieval.executor import InferenceExecutor, InferenceOverloaded
+from clip_retrieval.lexical_index import LexicalIndex, fuse_scores, tokenize
+from clip_retrieval.query_cache import (
+    CacheGeneration, QueryEmbeddingCache, RankedResultCache, SingleFlightCache, query_hash
+)
+from clip_retrieval.search_client import CLIPSearchClient, SearchDaemonError
+from clip_retrieval.search_server import SearchServer
+from clip_retrieval.snapshot import (
+    SNAPSHOT_FILES, SnapshotError, acquire_snapshot_lock, commit_snapshot, pending_path, recover_snapshot,
+    release_snapshot_lock
+)
+from clip_retrieval.wal import IndexWAL
+
+from .models import Image, UserProfile
+from .search_hydration import hydrate_results
+from .views import ImageSearchViewSet, ImageViewSet
 
 # Create your tests here.
+
+# Các module nặng chỉ được load khi thực sự cần tìm kiếm
+HEAVY_MODULES = ('torch', 'torchvision', 'clip', 'faiss')
+
+IMPORT_CHECK = """
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+import media.models, media.views, media.serializers, media.urls
+print(json.dumps({
+    'seconds': time.perf_counter() - started,
+    'loaded': [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+class ImportBudgetTests(SimpleTestCase):
+    """Import app media (như migrate / shell / worker boot) không được kéo theo torch, clip, faiss"""
+
+    # Thời gian tối đa cho django.setup() + import các module của app media
+    IMPORT_BUDGET_SECONDS = 5.0
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Chạy trong process mới để sys.modules không bị ảnh hưởng bởi các test khác
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'webImage.settings')
+        completed = subprocess.run(
+            [sys.executable, '-c', IMPORT_CHECK % (HEAVY_MODULES,)],
+            cwd=str(settings.BASE_DIR), env=env, capture_output=True, text=True, timeout=120,
+        )
+        cls.returncode = completed.returncode
+        cls.stderr = completed.stderr
+        cls.result = json.loads(completed.stdout.strip().splitlines()[-1]) if completed.returncode == 0 else None
+
+    def test_media_app_imports_cleanly(self):
+        self.assertEqual(self.returncode, 0, self.stderr)
+
+    def test_media_app_does_not_import_ml_stack(self):
+        self.assertIsNotNone(self.result, self.stderr)
+        self.assertEqual(self.result['loaded'], [], f"media app imports pulled in {self.result['loaded']}")
+
+    def test_media_app_import_time_budget(self):
+        self.assertIsNotNone(self.result, self.stderr)
+        self.assertLess(self.result['seconds'], self.IMPORT_BUDGET_SECONDS)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+)
+class SearchHydrationTests(TestCase):
+    """Kết quả tìm kiếm được gắn dữ liệu database bằng một query, bất kể số kết quả"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = UserProfile.objects.create(user=User.objects.create_user('owner', password='x'))
+        cls.other = UserProfile.objects.create(user=User.objects.create_user('other', password='x'))
+        # bulk_create: không chạy signal index CLIP
+        Image.objects.bulk_create(
+            [Image(user=cls.owner, file=f'image/{i}.jpg', title=f'public {i}') for i in range(20)] +
+            [Image(user=cls.owner, file='image/private.jpg', title='private', is_public=False)]
+        )
+        cls.public_ids = list(Image.objects.filter(is_public=True).values_list('id', flat=True))
+        cls.private_id = Image.objects.get(is_public=False).id
+
+    def setUp(self):
+        cache.clear()
+
+    def _hits(self, ids):
+        return [{'id': image_id, 'similarity_score': 1.0 / (rank + 1)} for rank, image_id in enumerate(ids)]
+
+    def test_one_query_for_all_hits_in_rank_order(self):
+        ranked = list(reversed(self.public_ids))
+        with self.assertNumQueries(1):
+            results = hydrate_results(self._hits(ranked))
+        self.assertEqual([item['id'] for item in results], ranked)
+        self.assertEqual(results[0]['user'], 'owner')
+
+    def test_cached_cards_need_no_queries(self):
+        hydrate_results(self._hits(self.public_ids))
+        with self.assertNumQueries(0):
+            results = hydrate_results(self._hits(self.public_ids))
+        self.assertEqual(len(results), len(self.public_ids))
+
+    def test_private_and_deleted_hits_are_dropped(self):
+        hits = self._hits([self.private_id, self.public_ids[0], 10 ** 9])
+        self.assertEqual([item['id'] for item in hydrate_results(hits)], [self.public_ids[0]])
+        self.assertEqual([item['id'] for item in hydrate_results(hits, self.other.id)], [self.public_ids[0]])
+        self.assertEqual([item['id'] for item in hydrate_results(hits, self.owner.id)],
+                         [self.private_id, self.public_ids[0]])
+        # Card private của owner đã nằm trong cache nhưng vẫn không hiện cho người khác
+        with self.assertNumQueries(1):
+            self.assertEqual([item['id'] for item in hydrate_results(hits)], [self.public_ids[0]])
+
+    def _page(self, ids, next_cursor=None, expired=False):
+        return {'results': self._hits(ids), 'next_cursor': next_cursor, 'index_version': 3, 'stale': False,
+                'expired': expired}
+
+    def test_text_search_query_count(self):
+        engine = mock.Mock()
+        engine.search_page.return_value = self._page(self.public_ids, next_cursor='abc')
+        view = ImageSearchViewSet.as_view({'post': 'search_by_text'})
+        request = APIRequestFactory().post('/api/image-search/text/', {'query': 'cat', 'top_k': 20, 'mode': 'vector'},
+                                           format='json')
+        with mock.patch('media.views.get_clip_search', return_value=engine), self.assertNumQueries(1):
+            response = view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 20)
+        self.assertEqual(response.data['next_cursor'], 'abc')
+        self.assertEqual(engine.search_page.call_args.kwargs['viewer_id'], None)
+        self.assertEqual(engine.search_page.call_args.kwargs['mode'], 'vector')
+
+    def test_text_search_defaults_to_vector(self):
+        engine = mock.Mock()
+        engine.search_page.return_value = self._page(self.public_ids[:5])
+        view = ImageSearchViewSet.as_view({'post': 'search_by_text'})
+        factory = APIRequestFactory()
+        with mock.patch('media.views.get_clip_search', return_value=engine), \
+                mock.patch.object(ImageSearchViewSet, 'HYBRID_SEARCH_ENABLED', True):
+            response = view(factory.post('/api/image-search/text/', {'query': 'cat'}, format='json'))
+            # similarity_score giữ nghĩa độ tương đồng CLIP trừ khi client chọn hybrid
+            self.assertEqual(engine.search_page.call_args.kwargs['mode'], 'vector')
+            view(factory.post('/api/image-search/text/', {'query': 'cat', 'mode': 'hybrid'}, format='json'))
+            self.assertEqual(engine.search_page.call_args.kwargs['mode'], 'hybrid')
+        self.assertEqual(response.data['count'], 5)
+
+    def test_overloaded_search_returns_503_with_retry_after(self):
+        engine = mock.Mock()
+        engine.search_page.side_effect = InferenceOverloaded('queue full', retry_after=3)
+        view = ImageSearchViewSet.as_view({'post': 'search_by_text'})
+        request = APIRequestFactory().post('/api/image-search/text/', {'query': 'cat'}, format='json')
+        with mock.patch('media.views.get_clip_search', return_value=engine):
+            response = view(request)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '3')
+        # Quá tải thì không thử lại (không làm hàng đợi đầy thêm)
+        self.assertEqual(engine.search_page.call_count, 1)
+
+    def test_text_search_next_page_by_cursor(self):
+        engine = mock.Mock()
+        engine.search_page.side_effect = [self._page(self.public_ids[10:15]), self._page([], expired=True)]
+        view = ImageSearchViewSet.as_view({'post': 'search_by_text'})
+        with mock.patch('media.views.get_clip_search', return_value=engine):
+            response = view(APIRequestFactory().post('/api/image-search/text/', {'cursor': 'abc', 'top_k': 5},
+                                                     format='json'))
+            expired = view(APIRequestFactory().post('/api/image-search/text/', {'cursor': 'old'}, format='json'))
+        self.assertEqual([item['id'] for item in response.data['results']], self.public_ids[10:15])
+        self.assertIsNone(response.data['next_cursor'])
+        self.assertEqual(engine.search_page.call_args_list[0].kwargs['cursor'], 'abc')
+        self.assertEqual(expired.status_code, 410)
+
+    def test_similar_endpoint_uses_indexed_vector(self):
+        engine = mock.Mock()
+        engine.search_by_image_id.return_value = self._hits(self.public_ids[1:6])
+        view = ImageViewSet.as_view({'get': 'search_similar'})
+        with mock.patch('media.views.get_clip_search', return_value=engine):
+            response = view(APIRequestFactory().get('/images/1/similar/', {'top_k': 5}), pk=self.public_ids[0])
+            hidden = view(APIRequestFactory().get('/images/1/similar/'), pk=self.private_id)
+        self.assertEqual([item['id'] for item in response.data['results']], self.public_ids[1:6])
+        engine.search_by_image_id.assert_called_once_with(self.public_ids[0], top_k=5, viewer_id=None)
+        self.assertEqual(hidden.status_code, 404)
+
+    def test_popular_queries_for_admins_only(self):
+        view = ImageSearchViewSet.as_view({'get': 'popular_queries'}, **ImageSearchViewSet.popular_queries.kwargs)
+        admin = User.objects.create_user('admin', password='x', is_staff=True)
+        with mock.patch('media.views.PopularQueryTracker') as tracker:
+            tracker.return_value.top.return_value = [('nature', 12.5), ('city night', 3.25)]
+            anonymous = view(APIRequestFactory().get('/api/image-search/popular-queries/'))
+            request = APIRequestFactory().get('/api/image-search/popular-queries/', {'limit': 2})
+            force_authenticate(request, user=admin)
+            response = view(request)
+        self.assertIn(anonymous.status_code, (401, 403))
+        self.assertEqual(response.data['queries'], [{'query': 'nature', 'score': 12.5},
+                                                    {'query': 'city night', 'score': 3.25}])
+        tracker.return_value.top.assert_called_once_with(2)
+
+    def test_batch_search_hydrates_with_one_query(self):
+        engine = mock.Mock()
+        engine.search_batch.return_value = [self._hits(self.public_ids[:5]), self._hits(self.public_ids[5:8]),
+                                            self._hits(self.public_ids[8:10])]
+        view = ImageSearchViewSet.as_view({'post': 'search_batch'})
+        request = APIRequestFactory().post('/api/image-search/batch/', {'queries': [
+            {'key': 'beach', 'text': 'beach', 'top_k': 5},
+            {'text': 'forest', 'top_k': 3},
+            {'key': 'hidden', 'image_id': self.private_id},
+        ]}, format='json')
+        with mock.patch('media.views.get_clip_search', return_value=engine), self.assertNumQueries(1):
+            response = view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.data['results']['beach']['results']], self.public_ids[:5])
+        self.assertEqual(response.data['results']['forest']['count'], 3)
+        # Ảnh nguồn là ảnh private của người khác: không trả về kết quả
+        self.assertEqual(response.data['results']['hidden']['count'], 0)
+        self.assertEqual(engine.search_batch.call_args.args[0][0], {'text': 'beach', 'top_k': 5})
+
+    def test_batch_search_rejects_duplicate_keys(self):
+        engine = mock.Mock()
+        view = ImageSearchViewSet.as_view({'post': 'search_batch'})
+        # Cùng text, không có key riêng: key mặc định trùng nhau
+        request = APIRequestFactory().post('/api/image-search/batch/', {'queries': [
+            {'text': 'beach', 'top_k': 5}, {'key': 'more', 'text': 'beach', 'top_k': 10}, {'text': 'beach'},
+        ]}, format='json')
+        with mock.patch('media.views.get_clip_search', return_value=engine):
+            response = view(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('#2', response.data['error'])
+        engine.search_batch.assert_not_called()
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+)
+class ImageMetadataReindexTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('owner', password='x')
+        self.user = user
+        profile = UserProfile.objects.create(user=user)
+        Image.objects.bulk_create([Image(user=profile, file='image/a.jpg', title='old title')])
+        self.image = Image.objects.get()
+
+    def _patch(self, data):
+        request = APIRequestFactory().patch(f'/api/images/{self.image.id}/', data, format='json')
+        force_authenticate(request, self.user)
+        return ImageViewSet.as_view({'patch': 'partial_update'})(request, pk=self.image.id)
+
+    @mock.patch('media.models.queue_clip_index_update', return_value='pending')
+    def test_title_edit_reindexes_after_commit(self, queue_update):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self._patch({'title': 'Sài Gòn về đêm'})
+        self.assertEqual(response.status_code, 200)
+        queue_update.assert_called_once_with(self.image.id, metadata=True)
+
+        queue_update.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            self._patch({'likes': 3})
+        queue_update.assert_not_called()
+
+    @mock.patch('media.models.queue_clip_index_update', return_value='pending')
+    def test_new_and_deleted_images_are_queued_after_commit(self, queue_update):
+        profile = UserProfile.objects.get(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            image = Image.objects.create(user=profile, file='image/b.jpg')
+            image_id = image.id
+            queue_update.assert_not_called()
+        queue_update.assert_called_once_with(image_id)
+
+        queue_update.reset_mock()
+        with self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+            queue_update.assert_not_called()
+        queue_update.assert_called_once_with(image_id, remove=True)
+
+    @mock.patch('media.models.queue_clip_index_update')
+    def test_made_public_image_is_visible_to_other_users(self, queue_update):
+        import faiss
+        from clip_retrieval.index_snapshot import IndexSnapshot
+        from clip_retrieval.vector_store import VectorStore
+
+        Image.objects.filter(pk=self.image.id).update(is_public=False)
+        indexed = []
+
+        def index_image(image_id, remove=False):
+            # Như worker của hàng đợi: metadata lấy từ row trong database lúc job chạy
+            image = Image.objects.get(pk=image_id)
+            indexed.append({'id': image.id, 'file': image.file.url, 'is_public': image.is_public,
+                            'user_id': image.user.id})
+            return 'indexed'
+
+        queue_update.side_effect = index_image
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self._patch({'is_public': True})
+            queue_update.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        queue_update.assert_called_once_with(self.image.id)
+
+        empty = IndexSnapshot(faiss.IndexFlatL2(4), VectorStore(np.zeros((0, 4), dtype='float32')), [], [], {})
+        snapshot = empty.with_adds([self.image.id], np.ones((1, 4), dtype='float32'), indexed, 1)
+        stranger = UserProfile.objects.create(user=User.objects.create_user('stranger', password='x'))
+        for viewer_id in (None, stranger.id):
+            mask, _, eligible = snapshot.visibility(viewer_id)
+            self.assertEqual(eligible, 1)
+            self.assertEqual(snapshot.image_ids_at(np.flatnonzero(mask)).tolist(), [self.image.id])
+
+
+class LexicalIndexTests(SimpleTestCase):
+    def _index(self):
+        return LexicalIndex.from_metadata([
+            {'id': 1, 'title': 'Hà Nội mùa thu', 'description': 'phố cổ', 'user_id': 1},
+            {'id': 2, 'title': 'Sunset', 'description': 'ha noi sunset over the lake', 'user_id': 1},
+            {'id': 3, 'title': 'Beach', 'description': 'sunset beach', 'user_id': 2, 'is_public': False},
+            {'id': 4, 'title': 'Forest', 'description': 'green forest', 'user_id': 2},
+        ])
+
+    def test_tokenize_folds_case_and_diacritics(self):
+        self.assertEqual(tokenize('Hà Nội, ĐÀ LẠT!'), ['ha', 'noi', 'da', 'lat'])
+        self.assertEqual(tokenize(None), [])
+
+    def test_bm25_matches_closed_form(self):
+        index = self._index()
+        image_ids, scores = index.search('forest', top_k=5)
+        self.assertEqual(image_ids.tolist(), [4])
+        # Doc 4: tf = 2 (title, trọng số 2) + 1 (description), độ dài 2 + 2 = 4;
+        # độ dài các doc 10, 8, 4, 4 (token của title tính 2 lần)
+        tf, doc_len, avg_len = 3.0, 4.0, 26 / 4
+        idf = np.log(1 + (4 - 1 + 0.5) / (1 + 0.5))
+        expected = idf * tf * 2.2 / (tf + 1.2 * (0.25 + 0.75 * doc_len / avg_len))
+        self.assertAlmostEqual(float(scores[0]), expected, places=5)
+
+    def test_rare_terms_weigh_more(self):
+        index = self._index()
+        # Cùng doc 2, cùng tf = 1: 'lake' chỉ có ở doc 2, 'noi' có ở doc 1 và 2 nên idf nhỏ hơn
+        lake_ids, lake = index.search('lake')
+        noi_ids, noi = index.search('noi')
+        self.assertEqual(lake_ids.tolist(), [2])
+        self.assertGreater(float(lake[0]), float(noi[noi_ids.tolist().index(2)]))
+
+    def test_visibility_and_delta_after_merge(self):
+        index = self._index()
+        self.assertEqual(index.search('sunset')[0].tolist(), [2])
+        self.assertEqual(sorted(index.search('sunset', viewer_id=2)[0].tolist()), [2, 3])
+
+        # Thêm / sửa / xoá sau lần gộp: kết quả như nhau trước và sau khi gộp delta vào CSR
+        index.add(5, {'id': 5, 'title': 'Sunset lake', 'user_id': 3})
+        index.add(1, {'id': 1, 'title': 'Autumn', 'description': '', 'user_id': 1})
+        index.remove(4)
+        before = index.search('sunset lake ha noi forest')
+        index.merge()
+        after = index.search('sunset lake ha noi forest')
+        self.assertEqual(before[0].tolist(), after[0].tolist())
+        np.testing.assert_allclose(before[1], after[1], rtol=1e-6)
+        self.assertEqual(set(after[0].tolist()), {2, 5})
+
+    def test_fusion_orders_by_weighted_sum(self):
+        image_ids, scores = fuse_scores([1, 2, 3], [0.9, 0.8, 0.5], [2, 4], [6.0, 3.0], vector_weight=0.5)
+        # CLIP min-max: 1 -> 1, 2 -> 0.75, 3 -> 0; BM25 / max: 2 -> 1, 4 -> 0.5
+        self.assertEqual(image_ids.tolist(), [2, 1, 4, 3])
+        np.testing.assert_allclose(scores, [0.875, 0.5, 0.25, 0.0], rtol=1e-6)
+
+
+@skipUnless(importlib.util.find_spec('torch'), 'torch chưa được cài')
+class InferenceBackendTests(SimpleTestCase):
+    """Backend export / lượng tử hoá phải cho output gần như trùng với model eager"""
+
+    def setUp(self):
+        import torch
+
+        torch.manual_seed(0)
+        self.module = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, 3, padding=1), torch.nn.ReLU(), torch.nn.AdaptiveAvgPool2d(4), torch.nn.Flatten(),
+            torch.nn.Linear(128, 64), torch.nn.ReLU(), torch.nn.Linear(64, 32)
+        ).eval()
+        self.samples = torch.rand(8, 3, 32, 32)
+
+    @staticmethod
+    def _forward(module, inputs):
+        return module(inputs)
+
+    def _cosine(self, expected, actual):
+        expected = expected / np.linalg.norm(expected, axis=1, keepdims=True)
+        actual = actual / np.linalg.norm(actual, axis=1, keepdims=True)
+        return float((expected * actual).sum(axis=1).min())
+
+    def test_exported_backends_match_eager(self):
+        from model_inference.encoders import PARITY_THRESHOLD, build_encoder
+
+        expected = build_encoder('test', self.module, self._forward, self.samples)(self.samples)
+        backends = [('torchscript', 'none'), ('torchscript', 'dynamic')]
+        if importlib.util.find_spec('onnxruntime') and importlib.util.find_spec('onnx'):
+            backends += [('onnx', 'none'), ('onnx', 'dynamic')]
+        for backend, quantization in backends:
+            with self.subTest(backend=backend, quantization=quantization):
+                encoder = build_encoder('test', self.module, self._forward, self.samples, backend=backend,
+                                        quantization=quantization, artifact_dir=tempfile.mkdtemp(), strict=True)
+                actual = encoder(self.samples)
+                self.assertEqual((encoder.backend, actual.shape), (backend, expected.shape))
+                if quantization == 'none':
+                    np.testing.assert_allclose(actual, expected, rtol=1e-3, atol=1e-4)
+                self.assertGreaterEqual(self._cosine(expected, actual), PARITY_THRESHOLD)
+
+    def test_channels_last_leaves_shared_module_untouched(self):
+        from model_inference.encoders import build_encoder, to_channels_last
+
+        expected = build_encoder('test', self.module, self._forward, None)(self.samples)
+        encoder = build_encoder('test', self.module, self._forward, None, channels_last=True)
+        # Encoder không đổi layout trọng số của module dùng chung, chỉ đổi layout input
+        self.assertTrue(self.module[0].weight.is_contiguous())
+        np.testing.assert_allclose(encoder(self.samples), expected, rtol=1e-4, atol=1e-5)
+
+        to_channels_last(self.module)
+        np.testing.assert_allclose(encoder(self.samples), expected, rtol=1e-4, atol=1e-5)
+
+
+@mock.patch('clip_retrieval.executor.set_thread_budget')
+class InferenceExecutorTests(SimpleTestCase):
+    def test_full_queue_rejects_immediately(self, set_thread_budget):
+        executor = InferenceExecutor(max_workers=1, max_queue=1, deadline=5, thread_budget=4)
+        release = threading.Event()
+        started = threading.Event()
+
+        def blocking():
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(executor.run(blocking))) for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        while executor.get_metrics()['queued'] < 1:
+            threading.Event().wait(0.01)
+
+        with self.assertRaises(InferenceOverloaded) as raised:
+            executor.run(blocking)
+        self.assertEqual(raised.exception.reason, 'queue_full')
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ['done', 'done'])
+        metrics = executor.get_metrics()
+        self.assertEqual((metrics['rejected_queue_full'], metrics['completed']), (1, 2))
+        set_thread_budget.assert_called_with(4)
+
+    def test_deadline_exceeded(self, set_thread_budget):
+        executor = InferenceExecutor(max_workers=1, max_queue=4, deadline=0.05)
+        release = threading.Event()
+        with self.assertRaises(InferenceOverloaded) as raised:
+            executor.run(release.wait, 5)
+        release.set()
+        self.assertEqual(raised.exception.reason, 'deadline')
+        self.assertEqual(executor.get_metrics()['deadline_exceeded'], 1)
+
+
+class TextQueryBatcherTests(SimpleTestCase):
+    @staticmethod
+    def _search_fn(batches, release=None):
+        def search(texts, top_k):
+            if release is not None:
+                release.wait(5)
+            batches.append(list(texts))
+            return tuple(np.arange(len(texts) * top_k, dtype='float32').reshape(len(texts), top_k) for _ in range(2))
+        return search
+
+    def _search_concurrently(self, batcher, texts):
+        results, errors = {}, {}
+
+        def search(text):
+            try:
+                results[text] = batcher.search(text, 3, timeout=5)
+            except Exception as e:
+                errors[text] = e
+
+        threads = [threading.Thread(target=search, args=(text,)) for text in texts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results, errors
+
+    def test_concurrent_submits_share_one_encode(self):
+        batches = []
+        batcher = TextQueryBatcher(self._search_fn(batches), window_ms=300, max_batch_size=32)
+        texts = ['cat', 'dog', 'cat', 'sunset']
+        futures = [batcher.submit(text, 3) for text in texts]
+        rows = [future.result(5) for future in futures]
+        # Một lần search_fn cho cả batch, text trùng chỉ encode một lần
+        self.assertEqual(batches, [['cat', 'dog', 'sunset']])
+        self.assertEqual([row[0].shape for row in rows], [(1, 3)] * 4)
+        np.testing.assert_array_equal(rows[0][0], rows[2][0])
+        self.assertEqual(batcher.get_metrics()['batch_size_histogram'], {4: 1})
+
+    def test_max_batch_size_is_enforced(self):
+        batches = []
+        batcher = TextQueryBatcher(self._search_fn(batches), window_ms=300, max_batch_size=4)
+        results, errors = self._search_concurrently(batcher, [f'query {i}' for i in range(10)])
+        self.assertEqual((len(results), errors), (10, {}))
+        self.assertLessEqual(max(len(batch) for batch in batches), 4)
+        self.assertEqual(sum(len(batch) for batch in batches), 10)
+
+    def test_error_reaches_every_caller(self):
+        def failing(texts, top_k):
+            raise RuntimeError('encode failed')
+
+        batcher = TextQueryBatcher(failing, window_ms=300, max_batch_size=8)
+        results, errors = self._search_concurrently(batcher, ['a', 'b', 'c'])
+        self.assertEqual(results, {})
+        self.assertEqual(sorted(errors), ['a', 'b', 'c'])
+        self.assertTrue(all(str(error) == 'encode failed' for error in errors.values()))
+
+    @mock.patch('clip_retrieval.executor.set_thread_budget')
+    def test_batch_can_exceed_executor_workers(self, set_thread_budget):
+        executor = InferenceExecutor(max_workers=2, max_queue=16)
+        batches = []
+        batcher = TextQueryBatcher(self._search_fn(batches), window_ms=500, max_batch_size=8)
+        # Caller chờ batcher trong luồng của mình (như CLIPImageSearch), không chiếm worker của executor
+        threads = [threading.Thread(target=batcher.search, args=(f'query {i}', 5)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([len(batch) for batch in batches], [8])
+        self.assertGreater(len(batches[0]), executor.max_workers)
+
+    def test_full_queue_and_deadline_raise_overloaded(self):
+        release = threading.Event()
+        batches = []
+        batcher = TextQueryBatcher(self._search_fn(batches, release), window_ms=0, max_batch_size=1, max_pending=2)
+        # Truy vấn đầu chặn luồng batcher, các truy vấn sau nằm trong hàng đợi
+        first = batcher.submit('first', 5)
+        while batcher.get_metrics()['pending']:
+            time.sleep(0.01)
+        queued = batcher.submit('queued', 5)
+        with self.assertRaises(InferenceOverloaded) as raised:
+            batcher.search('late', 5, timeout=0.05)
+        self.assertEqual(raised.exception.reason, 'deadline')
+        with self.assertRaises(InferenceOverloaded) as raised:
+            batcher.submit('rejected', 5)
+        self.assertEqual(raised.exception.reason, 'queue_full')
+        self.assertFalse(batcher.has_room())
+
+        release.set()
+        first.result(5)
+        queued.result(5)
+        # Truy vấn bị huỷ / quá deadline không được encode
+        self.assertEqual(batches, [['first'], ['queued']])
+        metrics = batcher.get_metrics()
+        self.assertEqual((metrics['rejected_queue_full'], metrics['deadline_exceeded']), (1, 1))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheGenerationTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bump_hides_previous_entries(self):
+        generation = CacheGeneration('clip_search')
+        old = generation.current()
+        cache.set(generation.key(old, 'clip_image_id_search', 7, 12), ['stale'])
+        self.assertEqual(generation.bump(), old + 1)
+        self.assertIsNone(cache.get(generation.key(generation.current(), 'clip_image_id_search', 7, 12)))
+
+    def test_lost_generation_never_reuses_old_value(self):
+        generation = CacheGeneration('clip_search')
+        old = generation.bump()
+        cache.delete(generation._key())
+        self.assertGreater(generation.current(), old)
+
+
+class PopularQueryTrackerTests(SimpleTestCase):
+    """Cần Redis (django_redis) thật; sorted set dùng key riêng của test"""
+    KEY = 'test:clip_popular_queries'
+
+    def setUp(self):
+        try:
+            self.redis = popular_queries._redis()
+            self.redis.ping()
+        except Exception as e:
+            self.skipTest(f"Redis không khả dụng: {e}")
+        self.addCleanup(self.redis.delete, self.KEY, f'{self.KEY}:landmark')
+        self.redis.delete(self.KEY, f'{self.KEY}:landmark')
+
+    def make_tracker(self, **kwargs):
+        return popular_queries.PopularQueryTracker(key=self.KEY, flush_interval=3600, **kwargs)
+
+    def test_counts_are_batched_and_normalized(self):
+        tracker = self.make_tracker()
+        for query in ['Hồ Gươm', '  hồ   gươm ', 'hồ gươm', 'phố cổ', 'x' * 300, '   ']:
+            tracker.record(query)
+        # Chưa tới flush_interval: chưa ghi gì vào Redis
+        self.assertEqual(tracker.top(), [])
+
+        tracker.flush()
+        top = tracker.top()
+        self.assertEqual([query for query, _ in top], ['hồ gươm', 'phố cổ'])
+        self.assertAlmostEqual(top[0][1], 3.0, places=3)
+        self.assertAlmostEqual(top[1][1], 1.0, places=3)
+        self.assertEqual(len(tracker.top(limit=1)), 1)
+
+    def test_old_searches_decay_and_rare_queries_are_trimmed(self):
+        tracker = self.make_tracker(half_life=100, max_size=2)
+        with mock.patch.object(popular_queries.time, 'time', return_value=1000.0):
+            for _ in range(6):
+                tracker.record('old')
+            tracker.flush()
+        with mock.patch.object(popular_queries.time, 'time', return_value=1200.0):
+            for query in ['new', 'new', 'rare']:
+                tracker.record(query)
+            tracker.flush()
+            top = dict(tracker.top())
+        # 6 lượt tìm cách đây 2 half_life chỉ còn tính là 1.5, 'rare' (1 lượt) bị bỏ
+        self.assertEqual(set(top), {'new', 'old'})
+        self.assertAlmostEqual(top['new'], 2.0, places=3)
+        self.assertAlmostEqual(top['old'], 1.5, places=3)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PopularQueryRefresherTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.tracker = mock.Mock(**{'top.return_value': [('hồ gươm', 5.0), ('phố cổ', 2.0)]})
+        self.generation = CacheGeneration('clip_search')
+        self.warm = mock.Mock(return_value=True)
+
+    def make_refresher(self):
+        return popular_queries.PopularQueryRefresher(self.tracker, self.generation, self.warm, top_n=2)
+
+    def test_top_queries_are_warmed_once_per_generation(self):
+        refresher = self.make_refresher()
+        self.assertEqual(refresher.refresh(), 2)
+        self.assertEqual([c.args[0] for c in self.warm.call_args_list], ['hồ gươm', 'phố cổ'])
+        self.tracker.top.assert_called_once_with(2)
+
+        # Cùng thế hệ: không làm lại, kể cả ở worker khác
+        self.assertEqual(refresher.refresh(), 0)
+        self.assertEqual(self.make_refresher().refresh(), 0)
+
+        # Index đổi: tính lại cho thế hệ mới
+        self.generation.bump()
+        self.assertEqual(refresher.refresh(), 2)
+        self.assertEqual(self.warm.call_count, 4)
+        self.assertEqual(refresher.get_metrics()['runs'], 2)
+
+    def test_busy_executor_defers_the_round(self):
+        refresher = self.make_refresher()
+        self.warm.side_effect = [True, False, True, True]
+        self.assertEqual(refresher.refresh(), 1)
+        self.assertEqual(refresher.get_metrics()['deferred'], 1)
+        # Marker đã được xoá: lần kiểm tra sau làm lại cả lượt
+        self.assertEqual(refresher.refresh(), 2)
+        self.assertEqual(self.warm.call_count, 4)
+        self.assertEqual(refresher.get_metrics()['warmed_queries'], 3)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class QueryCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_query_embedding_is_shared_across_processes(self):
+        vector = np.random.default_rng(0).standard_normal(16).astype('float32')
+        digest = query_hash('  Hà   Nội  ')
+        self.assertEqual(digest, query_hash('hà nội'))
+        QueryEmbeddingCache(max_entries=1).set(digest, vector)
+
+        # Process khác (LRU rỗng) đọc từ Redis, lưu dạng float16
+        other = QueryEmbeddingCache(max_entries=1)
+        np.testing.assert_allclose(other.get(digest), vector, rtol=1e-3, atol=1e-3)
+        self.assertEqual(other.get(digest).dtype, np.float32)
+        self.assertIsNone(other.get(query_hash('hồ gươm')))
+
+        # LRU chỉ giữ max_entries vector, phần bị đẩy ra vẫn còn trong Redis
+        other.set(query_hash('hồ gươm'), vector)
+        self.assertEqual(list(other._lru), [query_hash('hồ gươm')])
+        self.assertIsNotNone(other.get(digest))
+
+    def test_smaller_top_k_is_sliced_from_a_deeper_ranking(self):
+        ranked = RankedResultCache(ttl=60)
+        rank_fn = mock.Mock(return_value=(np.arange(100, 150), np.linspace(1, 0, 50), False))
+
+        ids, scores = ranked.get_or_rank('lake', 50, 1, rank_fn)
+        self.assertEqual(ids.tolist(), list(range(100, 150)))
+        for top_k in (10, 1, 50):
+            ids, scores = ranked.get_or_rank('lake', top_k, 1, rank_fn)
+            self.assertEqual(ids.tolist(), list(range(100, 100 + top_k)))
+            self.assertEqual(len(scores), top_k)
+        self.assertEqual(rank_fn.call_count, 1)
+
+        # Sâu hơn danh sách đã lưu (và danh sách chưa đầy đủ): xếp hạng lại; thế hệ khác: entry khác
+        ranked.get_or_rank('lake', 80, 1, rank_fn)
+        ranked.get_or_rank('lake', 10, 2, rank_fn)
+        self.assertEqual(rank_fn.call_count, 3)
+
+    def test_complete_ranking_serves_any_depth(self):
+        ranked = RankedResultCache(ttl=60)
+        rank_fn = mock.Mock(return_value=(np.arange(5), np.ones(5), True))
+        ranked.get_or_rank('lake', 100, 1, rank_fn)
+        ids, _ = ranked.get_or_rank('lake', 200, 1, rank_fn)
+        self.assertEqual((ids.tolist(), rank_fn.call_count), (list(range(5)), 1))
+
+
+
+class IndexWALTests(SimpleTestCase):
+    def test_workers_share_one_log(self):
+        path = os.path.join(tempfile.mkdtemp(), 'clip_index.wal')
+        worker_a, worker_b = IndexWAL(path, fsync=False), IndexWAL(path, fsync=False)
+        # Version do log chung cấp: hai worker ghi xen kẽ, không theo thứ tự
+        worker_a.append_add(7, [0.5, 0.25], {'id': 7}, seq=2)
+        worker_b.append_delete(3, seq=1)
+        worker_b.append_delete(4, seq=3)
+
+        self.assertEqual([record.seq for record in IndexWAL(path).replay()], [1, 2, 3])
+
+        # Snapshot ở version 2: bản ghi mới hơn của worker khác vẫn được giữ
+        worker_a.truncate(through_seq=2)
+        worker_b.append_delete(5, seq=4)
+        records = IndexWAL(path).replay()
+        self.assertEqual([(record.seq, record.image_id) for record in records], [(3, 4), (4, 5)])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class IndexQueueTests(SimpleTestCase):
+    """Cần Redis (django_redis) thật; các key dùng prefix riêng của test"""
+    # Worker đọc (không ghi) bảng Image để biết ảnh đã được commit chưa
+    databases = {'default'}
+
+    KEYS = {
+        'QUEUE_KEY': 'test:clip_index_queue', 'PROCESSING_PREFIX': 'test:clip_index_queue:processing:',
+        'CONSUMERS_KEY': 'test:clip_index_queue:consumers', 'HEARTBEAT_PREFIX': 'test:clip_index_queue:alive:',
+        'DEAD_LETTER_KEY': 'test:clip_index_queue:dead',
+    }
+
+    def setUp(self):
+        try:
+            self.redis = index_queue._redis()
+            self.redis.ping()
+        except Exception as e:
+            self.skipTest(f"Redis không khả dụng: {e}")
+        patcher = mock.patch.multiple(index_queue, **self.KEYS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._clear)
+        self._clear()
+
+    def _clear(self):
+        keys = self.redis.keys('test:clip_index_queue*')
+        if keys:
+            self.redis.delete(*keys)
+
+    def _as(self, consumer):
+        return mock.patch.object(index_queue, 'consumer_id', return_value=consumer)
+
+    def test_ack_only_removes_own_jobs(self):
+        for image_id in (1, 2, 3):
+            index_queue.enqueue_add(image_id)
+        with self._as('host-a:1'):
+            jobs_a = index_queue.pop_batch(2, timeout=1, wait_ms=0)
+        with self._as('host-b:2'):
+            jobs_b = index_queue.pop_batch(2, timeout=1, wait_ms=0)
+        self.assertEqual([job['image_id'] for job in jobs_a + jobs_b], [1, 2, 3])
+
+        with self._as('host-a:1'):
+            index_queue.ack_batch(jobs_a[:1])
+        self.assertEqual(self.redis.llen(index_queue.processing_key('host-a:1')), 1)
+        self.assertEqual(self.redis.llen(index_queue.processing_key('host-b:2')), 1)
+
+    def test_failing_job_moves_to_dead_letter(self):
+        index_queue.enqueue_add(7)
+        index_queue.enqueue_add(8)
+        with self._as('host-a:1'):
+            jobs = index_queue.pop_batch(1, timeout=1, wait_ms=0)
+            self.assertEqual(index_queue.retry_batch(jobs, max_attempts=2), [])
+            # Thử lại giữ thứ tự: job 7 vẫn được lấy trước job 8
+            jobs = index_queue.pop_batch(1, timeout=1, wait_ms=0)
+            self.assertEqual((jobs[0]['image_id'], jobs[0]['attempts']), (7, 1))
+            dead = index_queue.retry_batch(jobs, max_attempts=2)
+
+        self.assertEqual([(job['image_id'], job['attempts']) for job in dead], [(7, 2)])
+        self.assertEqual(index_queue.dead_letter_length(), 1)
+        self.assertEqual(index_queue.queue_length(), 1)
+        self.assertEqual(self.redis.llen(index_queue.processing_key('host-a:1')), 0)
+
+    def test_worker_retries_images_not_yet_committed(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        image_id = 10 ** 9
+        index_queue.enqueue_add(image_id)
+        engine = mock.Mock()
+        # Lần đầu row chưa đọc được; lần sau (đã commit) ảnh được index
+        engine.update_index_for_images.side_effect = [[], [image_id]]
+        with self._as('host-a:1'), mock.patch('media.models.get_clip_search', return_value=engine), \
+                mock.patch('media.management.commands.process_index_queue.time.sleep'):
+            call_command('process_index_queue', '--once', '--wait-ms=0', stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(engine.update_index_for_images.call_count, 2)
+        self.assertEqual(index_queue.get_status(image_id), 'indexed')
+        self.assertEqual((index_queue.queue_length(), index_queue.dead_letter_length()), (0, 0))
+        self.assertEqual(self.redis.llen(index_queue.processing_key('host-a:1')), 0)
+
+    def test_jobs_of_dead_consumer_are_requeued(self):
+        for image_id in (1, 2):
+            index_queue.enqueue_add(image_id)
+        with self._as('host-a:1'):
+            index_queue.pop_batch(2, timeout=1, wait_ms=0)
+
+        with self._as('host-b:2'):
+            # host-a còn heartbeat: job của nó không bị lấy lại
+            self.assertEqual(index_queue.requeue_unfinished(), (0, []))
+            self.redis.delete(index_queue.HEARTBEAT_PREFIX + 'host-a:1')
+            self.assertEqual(index_queue.requeue_unfinished(), (2, []))
+            jobs = index_queue.pop_batch(2, timeout=1, wait_ms=0)
+
+        self.assertEqual([(job['image_id'], job['attempts']) for job in jobs], [(1, 1), (2, 1)])
+        self.assertEqual(self.redis.llen(index_queue.processing_key('host-a:1')), 0)
+        self.assertFalse(self.redis.sismember(index_queue.CONSUMERS_KEY, 'host-a:1'))
+
+
+class SnapshotRecoveryTests(SimpleTestCase):
+    def test_pending_files_are_only_touched_under_the_lock(self):
+        index_dir = tempfile.mkdtemp()
+        with open(pending_path(index_dir, 'image_ids.json'), 'w') as f:
+            f.write('[1, 2]')
+        commit_snapshot(index_dir, ['image_ids.json'], 3)
+        # Worker khác đang ghi snapshot tiếp theo (chưa commit)
+        with open(pending_path(index_dir, 'image_ids.json'), 'w') as f:
+            f.write('[1, 2, 3]')
+
+        self.assertEqual(recover_snapshot(index_dir, repair=False)['seq'], 3)
+        self.assertTrue(os.path.exists(pending_path(index_dir, 'image_ids.json')))
+
+        self.assertEqual(recover_snapshot(index_dir)['seq'], 3)
+        self.assertFalse(os.path.exists(pending_path(index_dir, 'image_ids.json')))
+
+    def test_unlocked_read_rejects_a_half_committed_snapshot(self):
+        index_dir = tempfile.mkdtemp()
+        with open(pending_path(index_dir, 'image_ids.json'), 'w') as f:
+            f.write('[1, 2]')
+        commit_snapshot(index_dir, ['image_ids.json'], 3)
+        with open(pending_path(index_dir, 'image_ids.json'), 'w') as f:
+            f.write('[1, 2, 3]')
+        # Worker khác dừng giữa manifest và rename
+        replace = os.replace
+        with mock.patch('clip_retrieval.snapshot.os.replace',
+                        side_effect=lambda src, dst: replace(src, dst) if src.endswith('.tmp') else 1 / 0):
+            with self.assertRaises(ZeroDivisionError):
+                commit_snapshot(index_dir, ['image_ids.json'], 4)
+
+        with self.assertRaises(SnapshotError):
+            recover_snapshot(index_dir, verify=True, repair=False)
+        self.assertEqual(recover_snapshot(index_dir)['seq'], 4)
+        self.assertEqual(recover_snapshot(index_dir, verify=True, repair=False)['seq'], 4)
+
+    def test_lock_is_only_released_by_its_owner(self):
+        from clip_retrieval import snapshot
+
+        try:
+            redis = snapshot._redis()
+            redis.ping()
+        except Exception as e:
+            self.skipTest(f"Redis không khả dụng: {e}")
+        key = 'test:clip_index_snapshot_lock'
+        self.addCleanup(redis.delete, key)
+        with mock.patch.object(snapshot, 'SNAPSHOT_LOCK_KEY', key):
+            token_a = acquire_snapshot_lock()
+            self.assertIsNone(acquire_snapshot_lock())
+            # Lock của A hết TTL, B lấy lock
+            redis.delete(key)
+            token_b = acquire_snapshot_lock()
+            release_snapshot_lock(token_a)
+            self.assertEqual(redis.get(key).decode(), token_b)
+            release_snapshot_lock(token_b)
+            self.assertIsNone(redis.get(key))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RebuildIndexCommandTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        self.index_dir = index_dir.name
+
+    def _write_snapshot(self, image_ids):
+        import faiss
+
+        vectors = np.eye(8, dtype='float32')[:len(image_ids)]
+        index = faiss.IndexFlatL2(8)
+        index.add(vectors)
+        faiss.write_index(index, pending_path(self.index_dir, 'clip_faiss.index'))
+        with open(pending_path(self.index_dir, 'clip_image_embeddings.npy'), 'wb') as f:
+            np.save(f, vectors)
+        for name, data in (('image_ids.json', image_ids), ('image_urls.json', [f'{i}.jpg' for i in image_ids]),
+                           ('image_metadata.json', [{'id': i, 'file': f'{i}.jpg'} for i in image_ids]),
+                           ('tombstones.json', []), ('index_info.json', {})):
+            with open(pending_path(self.index_dir, name), 'w') as f:
+                json.dump(data, f)
+        commit_snapshot(self.index_dir, SNAPSHOT_FILES, 0)
+
+    def test_records_appended_during_rebuild_stay_in_the_wal(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from clip_retrieval.snapshot import WAL_NAME, load_manifest
+
+        self._write_snapshot([1, 2, 3])
+        wal = IndexWAL(os.path.join(self.index_dir, WAL_NAME), fsync=False)
+        wal.append_add(4, np.eye(8, dtype='float32')[3], {'id': 4, 'file': '4.jpg'})
+        wal.append_delete(2)
+        replay = IndexWAL.replay
+
+        def replay_then_append(log, after_seq=0):
+            records = replay(log, after_seq)
+            # Worker khác ghi thêm một bản ghi trong lúc index đang được rebuild
+            IndexWAL(log.path, fsync=False).append_delete(3, seq=3)
+            return records
+
+        generation = CacheGeneration('clip_search')
+        before = generation.current()
+        with mock.patch('media.management.commands.rebuild_clip_index.INDEX_DIR', self.index_dir), \
+                mock.patch.object(IndexWAL, 'replay', replay_then_append):
+            call_command('rebuild_clip_index', stdout=StringIO())
+
+        manifest = load_manifest(self.index_dir)
+        self.assertEqual((manifest['seq'], manifest['rebuild']), (2, 1))
+        with open(os.path.join(self.index_dir, 'image_ids.json')) as f:
+            self.assertEqual(json.load(f), [1, 3, 4])
+        pending = IndexWAL(os.path.join(self.index_dir, WAL_NAME)).replay(after_seq=manifest['seq'])
+        self.assertEqual([(record.seq, record.image_id) for record in pending], [(3, 3)])
+        self.assertGreater(generation.current(), before)
+
+        # Snapshot ghi sau đó (bởi engine) giữ số rebuild
+        self._write_snapshot([1, 3, 4])
+        self.assertEqual(load_manifest(self.index_dir)['rebuild'], 1)
+
+
+class IndexSnapshotTests(SimpleTestCase):
+    def test_readers_see_consistent_snapshots_during_writes(self):
+        import faiss
+        from clip_retrieval.index_snapshot import IndexSnapshot
+        from clip_retrieval.vector_store import VectorStore
+
+        def vectors(image_ids):
+            # Thành phần đầu của vector = id ảnh: kiểm tra được vị trí / id / vector có khớp nhau
+            return np.array([[image_id, 1, 0, 0] for image_id in image_ids], dtype='float32')
+
+        def metadata(image_id):
+            return {'id': image_id, 'file': f'{image_id}.jpg', 'is_public': image_id % 3 != 0, 'user_id': 1}
+
+        index = faiss.IndexFlatL2(4)
+        index.add(vectors(range(100)))
+        state = {'snapshot': IndexSnapshot(index, VectorStore(vectors(range(100))), list(range(100)),
+                                           [f'{i}.jpg' for i in range(100)], {i: metadata(i) for i in range(100)})}
+        done, errors = threading.Event(), []
+
+        def read():
+            while not done.is_set():
+                snapshot = state['snapshot']
+                live = snapshot.live_ids().tolist()
+                mask, _, eligible = snapshot.visibility(1)
+                try:
+                    self.assertEqual(eligible, len(live))
+                    for image_id in live[::7]:
+                        position = snapshot.position_of(image_id)
+                        self.assertEqual(snapshot.image_ids_at([position]).tolist(), [image_id])
+                        self.assertEqual(snapshot.embeddings[[position]][0][0], image_id)
+                        self.assertEqual(snapshot.metadata(image_id)['id'], image_id)
+                        if position < snapshot.base_size:
+                            self.assertEqual(snapshot.index.reconstruct(position)[0], image_id)
+                except AssertionError as e:
+                    errors.append(e)
+                    done.set()
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for thread in readers:
+            thread.start()
+        for step in range(200):
+            snapshot = state['snapshot']
+            if step % 3:
+                added = [100 + step * 2, 100 + step * 2 + 1, step]
+                snapshot = snapshot.with_adds(added, vectors(added), [metadata(i) for i in added], step)
+            else:
+                snapshot, _ = snapshot.with_deletes([step, step + 1], step)
+            if step % 25 == 24:
+                snapshot = snapshot.rebased(snapshot.folded_index())
+            state['snapshot'] = snapshot
+        done.set()
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        final = state['snapshot']
+        self.assertEqual(final.index.ntotal, final.base_size)
+        self.assertEqual(sorted(final.live_ids().tolist()), sorted(final.all_metadata()))
+
+
+@skipUnless(importlib.util.find_spec('torch') and importlib.util.find_spec('torchvision'), 'torch chưa được cài')
+class ResNetIndexBuilderTests(SimpleTestCase):
+    """IndexBuilder với index nén, không load ResNet (vector truy vấn: extract_features mock)"""
+    dimension = 64
+
+    def make_builder(self, vectors, **options):
+        from imageretrieval.index_builder import IndexBuilder
+
+        with mock.patch('imageretrieval.index_builder.FeatureExtractor'):
+            builder = IndexBuilder(feature_dim=self.dimension, use_gpu=False, **options)
+        builder.add_features(vectors)
+        builder.image_data = [{'id': pos} for pos in range(len(vectors))]
+        return builder
+
+    def make_vectors(self, count, seed=0):
+        return np.random.default_rng(seed).standard_normal((count, self.dimension)).astype('float32')
+
+    def test_pq_codes_are_sized_for_the_training_set(self):
+        import faiss
+        from clip_retrieval.index_factory import factory_string
+
+        with mock.patch('imageretrieval.index_builder.factory_string', wraps=factory_string) as spy:
+            builder = self.make_builder(self.make_vectors(1000), storage='pq')
+        # Index được tạo lại khi train, theo số vector thực tế
+        self.assertEqual([call.args[2] for call in spy.call_args_list], [0, 1000])
+        self.assertEqual(factory_string('flat', self.dimension, 256 * 39, storage='pq'), 'PQ8x8')
+        self.assertEqual(faiss.downcast_index(builder.index).pq.nbits, 4)
+        self.assertEqual((builder.index.ntotal, builder.raw_vectors.shape), (1000, (1000, self.dimension)))
+
+    def test_compressed_index_is_reranked_with_exact_distances(self):
+        vectors = self.make_vectors(2000)
+        query = self.make_vectors(1, seed=1)
+        builder = self.make_builder(vectors, storage='pq', rerank_factor=2, min_candidates=2000)
+        builder.extractor.extract_features.return_value = query[0]
+
+        results = builder.search('query.jpg', top_k=10)
+
+        distances = ((vectors - query) ** 2).sum(axis=1)
+        exact = np.argsort(distances)[:10]
+        self.assertEqual([result['id'] for result in results], exact.tolist())
+        np.testing.assert_allclose([result['distance'] for result in results], distances[exact], rtol=1e-4)
+
+    def test_saved_index_keeps_its_storage_and_raw_vectors(self):
+        vectors = self.make_vectors(500)
+        builder = self.make_builder(vectors, storage='int8')
+        directory = tempfile.mkdtemp()
+        builder.save(os.path.join(directory, 'resnet.index'), os.path.join(directory, 'mapping.pkl'))
+
+        loaded = self.make_builder(vectors[:0].reshape(0, self.dimension))
+        loaded.load(os.path.join(directory, 'resnet.index'), os.path.join(directory, 'mapping.pkl'), mmap=True)
+        self.assertEqual((loaded.storage, loaded.index.ntotal), ('int8', 500))
+        np.testing.assert_array_equal(loaded.raw_vectors[[3, 499]], vectors[[3, 499]])
+
+
+@skipUnless(importlib.util.find_spec('torch') and importlib.util.find_spec('clip'), 'torch / clip chưa được cài')
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CLIPEngineTestCase(SimpleTestCase):
+    """Engine thật trên index nhỏ trong thư mục tạm, không load model CLIP (vector truy vấn: self.queries)"""
+    dimension = 16
+
+    def setUp(self):
+        cache.clear()
+        self.queries = {}
+
+    def make_vectors(self, count, seed=0):
+        vectors = np.random.default_rng(seed).standard_normal((count, self.dimension)).astype('float32')
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    @staticmethod
+    def make_metadata(image_ids, is_public=lambda image_id: True, owner=lambda image_id: 1):
+        return [{'id': image_id, 'file': f'{image_id}.jpg', 'title': f'image {image_id}', 'description': '',
+                 'is_public': is_public(image_id), 'user_id': owner(image_id)} for image_id in image_ids]
+
+    def make_engine(self, vectors, metadata, index_type='flat', storage='float32', pca_dim=None, **constants):
+        """Ghi index + metadata vào thư mục tạm rồi khởi tạo CLIPImageSearch (constants: hằng số của clip_search)"""
+        from clip_retrieval import clip_search
+        from clip_retrieval.index_factory import build_index, describe_index, save_index_info, write_index
+
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        index, description = build_index(vectors, index_type, storage=storage, pca_dim=pca_dim)
+        write_index(index, os.path.join(index_dir.name, 'clip_faiss.index'))
+        save_index_info(os.path.join(index_dir.name, 'index_info.json'),
+                        describe_index(index, description, index_type, vectors, storage=storage))
+        np.save(os.path.join(index_dir.name, 'clip_image_embeddings.npy'), vectors)
+        for name, data in (('image_ids.json', [item['id'] for item in metadata]),
+                           ('image_urls.json', [item['file'] for item in metadata]),
+                           ('image_metadata.json', metadata)):
+            with open(os.path.join(index_dir.name, name), 'w') as f:
+                json.dump(data, f)
+
+        model = mock.Mock(**{'visual.input_resolution': 224})
+        patches = [
+            mock.patch.multiple(clip_search, INDEX_DIR=index_dir.name, INDEX_SYNC_ENABLED=False,
+                                POPULAR_QUERIES_ENABLED=False, **constants),
+            mock.patch.object(clip_search.CLIPImageSearch, '_initialized', False),
+            mock.patch.object(clip_search.clip, 'load', return_value=(model, None)),
+            mock.patch.object(clip_search.CLIPImageSearch, '_load_encoders'),
+            mock.patch.object(clip_search.CLIPImageSearch, 'encode_texts',
+                              lambda engine, texts: np.stack([self.queries[text] for text in texts])),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        return clip_search.CLIPImageSearch()
+
+    def exact_ranking(self, vectors, image_ids, query, top_k):
+        """Xếp hạng chính xác (brute force) trên các ảnh cho trước"""
+        order = np.argsort(((vectors - query) ** 2).sum(axis=1), kind='stable')[:top_k]
+        return [image_ids[pos] for pos in order]
+
+
+class IndexTombstoneTests(CLIPEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = self.make_vectors(100)
+        self.image_ids = list(range(1, 101))
+        # Chỉ compact khi test gọi compact()
+        self.engine = self.make_engine(self.vectors, self.make_metadata(self.image_ids), COMPACTION_THRESHOLD=1.0)
+        self.queries['lake'] = self.vectors[42]
+
+    def live_ranking(self, deleted):
+        live = [pos for pos, image_id in enumerate(self.image_ids) if image_id not in deleted]
+        return self.exact_ranking(self.vectors[live], [self.image_ids[pos] for pos in live], self.vectors[42], 100)
+
+    def search_ids(self):
+        return [result['id'] for result in self.engine.search('lake', top_k=100, use_cache=False)]
+
+    def test_deleted_ids_are_never_returned(self):
+        deleted = {3, 17, 42, 43, 99}
+        self.assertEqual(sorted(self.engine.remove_images_from_index(sorted(deleted))), sorted(deleted))
+        self.assertEqual(self.engine.snapshot.tombstone_count, 5)
+        # Vector vẫn còn trong FAISS nhưng vị trí đã bị tombstone
+        self.assertEqual(self.search_ids(), self.live_ranking(deleted))
+
+        self.assertTrue(self.engine.compact())
+        self.assertEqual((self.engine.snapshot.size, self.engine.snapshot.tombstone_count), (95, 0))
+        # Vị trí đã dời: id vẫn phải khớp đúng vector
+        self.assertEqual(self.search_ids(), self.live_ranking(deleted))
+        self.assertFalse(any(self.engine.contains(image_id) for image_id in deleted))
+
+    def test_load_reads_again_when_a_snapshot_is_committed_meanwhile(self):
+        from clip_retrieval import clip_search
+
+        self.engine.remove_images_from_index([5])
+        self.assertTrue(self.engine._save_data(force=True))
+        load_manifest = clip_search.load_manifest
+        # Worker khác giữ lock snapshot và commit snapshot mới trong lúc đọc
+        manifests = iter([{'seq': -1}])
+        with mock.patch.object(self.engine, '_acquire_snapshot_lock', return_value=None), \
+                mock.patch.object(clip_search, 'load_manifest',
+                                  side_effect=lambda index_dir: next(manifests, None) or load_manifest(index_dir)) as m:
+            self.engine.load_data()
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual((self.engine.snapshot.size, self.engine.snapshot.tombstone_count), (100, 1))
+        self.assertFalse(self.engine.contains(5))
+
+    def test_writes_are_not_blocked_while_the_snapshot_is_serialized(self):
+        import threading
+        from clip_retrieval import clip_search
+
+        self.engine.remove_images_from_index([5])
+        write_index = clip_search.faiss.write_index
+        writer = threading.Thread(target=self.engine.remove_images_from_index, args=([6],))
+
+        def write_during_save(index, path):
+            writer.start()
+            writer.join(timeout=5)
+            self.assertFalse(writer.is_alive())
+            write_index(index, path)
+
+        with mock.patch.object(clip_search.faiss, 'write_index', side_effect=write_during_save):
+            self.assertTrue(self.engine._save_data(force=True))
+
+        # Snapshot ở seq 1; bản ghi xoá 6 vẫn nằm trong WAL
+        self.assertEqual((self.engine._snapshot_seq, self.engine._applied_seq), (1, 2))
+        self.assertEqual([record.image_id for record in self.engine.wal.replay(after_seq=1)], [6])
+        self.assertFalse(self.engine.contains(6))
+
+    def test_skipped_save_is_not_reported_as_saved(self):
+        self.engine.remove_images_from_index([5])
+        with mock.patch.object(self.engine, '_acquire_snapshot_lock', return_value=None):
+            self.assertFalse(self.engine._save_data(force=True))
+        self.assertEqual((self.engine._snapshot_seq, self.engine._applied_seq), (0, 1))
+
+    def test_followers_do_not_bump_the_cache_generation(self):
+        from clip_retrieval.wal import OP_DELETE, WALRecord
+
+        # Worker khác đã ghi (và bump thế hệ cache) bản ghi xoá ảnh 3 vào log chung
+        self.engine.index_log = mock.Mock(**{'read_after.side_effect': [[WALRecord(1, OP_DELETE, 3)], []],
+                                             'latest.return_value': 1})
+        generation = self.engine.search_generation.current()
+        stale_key = self.engine._cache_generation()
+
+        self.assertEqual(self.engine.sync_index(), 1)
+        self.assertFalse(self.engine.contains(3))
+        self.assertEqual(self.engine.search_generation.current(), generation)
+        # Entry tính trên snapshot cũ nằm ở key khác
+        self.assertNotEqual(self.engine._cache_generation(), stale_key)
+
+    def test_engine_reloads_a_rebuilt_snapshot(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from clip_retrieval import clip_search
+
+        self.engine.remove_images_from_index([5, 6])
+        self.assertFalse(self.engine._reload_if_rebuilt())
+        with mock.patch('media.management.commands.rebuild_clip_index.INDEX_DIR', clip_search.INDEX_DIR):
+            call_command('rebuild_clip_index', stdout=StringIO())
+
+        self.assertTrue(self.engine._reload_if_rebuilt())
+        # Snapshot rebuild đã bỏ hẳn vector của ảnh bị xoá
+        self.assertEqual((self.engine.snapshot.size, self.engine.snapshot.tombstone_count), (98, 0))
+        self.assertEqual(self.search_ids(), self.live_ranking({5, 6}))
+        self.assertFalse(self.engine._reload_if_rebuilt())
+
+    def test_deletes_during_compaction_are_carried_over(self):
+        self.engine.remove_images_from_index([1, 2])
+        build_index = self.engine._build_index
+
+        def build_while_deleting(vectors):
+            # Request khác xoá ảnh trong lúc index mới đang được build (ngoài lock)
+            self.engine.remove_images_from_index([50, 51])
+            return build_index(vectors)
+
+        with mock.patch.object(self.engine, '_build_index', build_while_deleting):
+            self.assertTrue(self.engine.compact())
+
+        snapshot = self.engine.snapshot
+        self.assertEqual((snapshot.size, snapshot.tombstone_count), (98, 2))
+        self.assertEqual(self.search_ids(), self.live_ranking({1, 2, 50, 51}))
+
+        # Snapshot lưu sau compaction giữ tombstone của các lần xoá đó
+        self.engine.load_data()
+        self.assertEqual(self.engine.snapshot.tombstone_count, 2)
+        self.assertEqual(self.search_ids(), self.live_ranking({1, 2, 50, 51}))
+
+
+class MmapIndexLoadTests(CLIPEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = self.make_vectors(300)
+        self.image_ids = list(range(1, 301))
+        self.queries['lake'] = self.vectors[7]
+
+    def search_ids(self, engine, top_k=50):
+        return [result['id'] for result in engine.search('lake', top_k=top_k, use_cache=False)]
+
+    def test_mmap_index_and_embeddings_are_read_only_views_of_the_files(self):
+        engine = self.make_engine(self.vectors, self.make_metadata(self.image_ids), 'ivf_flat',
+                                  INDEX_MMAP=True, COMPACTION_THRESHOLD=1.0, IVF_NPROBE=64)
+        snapshot = engine.snapshot
+        self.assertTrue(snapshot.mmapped)
+        self.assertTrue(snapshot.embeddings.mmap)
+        self.assertIsInstance(snapshot.embeddings._base, np.memmap)
+        self.assertEqual(snapshot.size, 300)
+        self.assertEqual(self.search_ids(engine), self.exact_ranking(self.vectors, self.image_ids, self.vectors[7], 50))
+
+        # Compact đọc lại index vào bộ nhớ để sửa; sau khi save, worker đọc lại bản mmap mới
+        engine.remove_images_from_index([8, 9])
+        self.assertTrue(engine.compact())
+        live = [pos for pos, image_id in enumerate(self.image_ids) if image_id not in (8, 9)]
+        expected = self.exact_ranking(self.vectors[live], [self.image_ids[pos] for pos in live], self.vectors[7], 50)
+        self.assertEqual(self.search_ids(engine), expected)
+
+        engine.load_data()
+        self.assertTrue(engine.snapshot.mmapped)
+        self.assertIsInstance(engine.snapshot.embeddings._base, np.memmap)
+        self.assertEqual((engine.snapshot.size, self.search_ids(engine)), (298, expected))
+
+    def test_compressed_index_keeps_raw_embeddings_on_disk(self):
+        engine = self.make_engine(self.vectors, self.make_metadata(self.image_ids), storage='int8', INDEX_MMAP=False)
+        self.assertFalse(engine.snapshot.mmapped)
+        self.assertIsInstance(engine.snapshot.embeddings._base, np.memmap)
+        # Khoảng cách cuối cùng tính lại trên vector gốc đọc từ file
+        self.assertEqual(self.search_ids(engine, 10),
+                         self.exact_ranking(self.vectors, self.image_ids, self.vectors[7], 10))
+
+
+class IndexInfoTests(CLIPEngineTestCase):
+    def compacted_info(self, index_type, **constants):
+        from clip_retrieval import index_factory
+
+        vectors = self.make_vectors(400)
+        engine = self.make_engine(vectors, self.make_metadata(list(range(1, 401))), INDEX_TYPE=index_type,
+                                  COMPACTION_THRESHOLD=1.0, RECALL_SAMPLE_SIZE=50, **constants)
+        engine.remove_images_from_index([1, 2])
+        with mock.patch.object(index_factory, 'measure_recall', wraps=index_factory.measure_recall) as recall:
+            self.assertTrue(engine.compact())
+        self.assertEqual({call.kwargs['sample_size'] for call in recall.call_args_list}, {50})
+        return engine.snapshot.index_info
+
+    def test_ivf_index_info_after_compaction(self):
+        info = self.compacted_info('ivf_flat', IVF_NLIST=8, IVF_NPROBE=4)
+        self.assertEqual((info['index_type'], info['nlist'], info['nprobe'], info['ntotal']), ('ivf_flat', 8, 4, 398))
+        self.assertIsNone(info['ef_search'])
+        self.assertTrue(0.0 < info['recall_at_10_vs_flat'] <= 1.0)
+
+    def test_hnsw_index_info_after_compaction(self):
+        info = self.compacted_info('hnsw', HNSW_EF_SEARCH=32)
+        self.assertEqual((info['index_type'], info['ef_search'], info['ntotal']), ('hnsw', 32, 398))
+        self.assertIsNone(info['nprobe'])
+        self.assertTrue(0.0 < info['recall_at_10_vs_flat'] <= 1.0)
+
+
+class MetadataUpdateTests(CLIPEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = self.make_vectors(20)
+        self.engine = self.make_engine(self.vectors, self.make_metadata(list(range(1, 21))))
+
+    def edited_image(self, image_id, title):
+        return mock.Mock(id=image_id, title=title, description='', created_at='2026-01-01', is_public=True,
+                         **{'file.url': f'{image_id}.jpg', 'user.id': 1})
+
+    def test_title_edit_updates_the_index_without_encoding(self):
+        from clip_retrieval import clip_search
+
+        self.engine.image_encoder = mock.Mock()
+        rows = [self.edited_image(7, 'Hồ Gươm buổi sáng'), self.edited_image(99, 'not indexed')]
+        with mock.patch.object(self.engine, '_load_images', return_value=rows), \
+                mock.patch.object(self.engine, '_fetch_and_preprocess') as fetch:
+            self.assertEqual(self.engine.update_metadata_for_images([7, 99]), [7])
+        self.engine.image_encoder.assert_not_called()
+        fetch.assert_not_called()
+
+        # Vector và vị trí giữ nguyên, chỉ metadata + BM25 đổi
+        self.assertEqual((self.engine.snapshot.size, self.engine.snapshot.tombstone_count), (20, 0))
+        self.assertEqual(self.engine.snapshot.metadata(7)['title'], 'Hồ Gươm buổi sáng')
+        self.assertEqual(self.engine.lexical_index.search('ho guom')[0].tolist(), [7])
+        self.assertNotIn(7, self.engine.lexical_index.search('image', top_k=50)[0].tolist())
+
+        # Bản ghi metadata được replay khi load lại
+        self.engine.load_data()
+        self.assertEqual(self.engine.snapshot.metadata(7)['title'], 'Hồ Gươm buổi sáng')
+        self.assertEqual(self.engine.lexical_index.search('ho guom')[0].tolist(), [7])
+        self.assertEqual(self.engine.snapshot.size, 20)
+
+    def test_edits_after_an_add_in_the_same_batch_stay_an_add(self):
+        jobs = [{'op': index_queue.OP_ADD, 'image_id': 1}, {'op': index_queue.OP_METADATA, 'image_id': 1},
+                {'op': index_queue.OP_METADATA, 'image_id': 2}, {'op': index_queue.OP_METADATA, 'image_id': 3},
+                {'op': index_queue.OP_REMOVE, 'image_id': 3}]
+        self.assertEqual(index_queue.coalesce(jobs), ([1], [3], [2]))
+
+
+class VisibilityFilterTests(CLIPEngineTestCase):
+    def test_sparse_public_set_returns_exactly_top_k_visible_hits(self):
+        # 2% ảnh public: lọc sau khi search (như trước đây) gần như không còn kết quả nào
+        image_ids = list(range(1, 1001))
+        vectors = self.make_vectors(1000, seed=1)
+        metadata = self.make_metadata(image_ids, is_public=lambda image_id: image_id % 50 == 0,
+                                      owner=lambda image_id: 2 if image_id % 50 == 1 else 1)
+        public = {image_id for image_id in image_ids if image_id % 50 == 0}
+        visible_to_owner = public | {image_id for image_id in image_ids if image_id % 50 == 1}
+        queries = self.make_vectors(8, seed=2)
+        self.queries['lake'] = queries[0]
+
+        # flat / IVF / HNSW lọc bằng IDSelector; flat PQ không nhận selector nên đi qua over-fetch
+        for index_type, storage in (('flat', 'float32'), ('ivf_flat', 'float32'), ('hnsw', 'float32'), ('flat', 'pq')):
+            engine = self.make_engine(vectors, metadata, index_type, storage)
+            for viewer_id, visible in ((None, public), (2, visible_to_owner)):
+                for top_k in (12, 30, 100):
+                    with self.subTest(index_type=index_type, storage=storage, viewer_id=viewer_id, top_k=top_k):
+                        _, indices = engine._search_vectors(queries, top_k, viewer_id=viewer_id)
+                        for row in engine.snapshot.image_ids_at(indices).tolist():
+                            hits = [image_id for image_id in row if image_id >= 0]
+                            self.assertEqual(len(hits), min(top_k, len(visible)))
+                            self.assertEqual(len(set(hits)), len(hits))
+                            self.assertLessEqual(set(hits), visible)
+
+            results = engine.search('lake', top_k=12, use_cache=False)
+            self.assertEqual(len(results), 12)
+            if storage == 'float32' and index_type == 'flat':
+                positions = sorted(image_id - 1 for image_id in public)
+                self.assertEqual([result['id'] for result in results],
+                                 self.exact_ranking(vectors[positions], [pos + 1 for pos in positions], queries[0], 12))
+
+    def test_short_rows_are_filled_without_scanning_per_row(self):
+        from clip_retrieval import clip_search
+
+        image_ids = list(range(1, 1001))
+        vectors = self.make_vectors(1000, seed=1)
+        metadata = self.make_metadata(image_ids, is_public=lambda image_id: image_id % 50 == 0)
+        positions = [image_id - 1 for image_id in image_ids if image_id % 50 == 0]
+        queries = self.make_vectors(8, seed=2)
+        expected = [self.exact_ranking(vectors[positions], [pos + 1 for pos in positions], query, 12)
+                    for query in queries]
+
+        # Tập hợp lệ nhỏ: quét chính xác một lần; tập lớn: search IVF lại với mọi list
+        for limit in (10 ** 6, 0):
+            engine = self.make_engine(vectors, metadata, 'ivf_flat', IVF_NPROBE=1, SHORT_ROW_EXACT_LIMIT=limit)
+            with self.subTest(limit=limit), mock.patch.object(clip_search, 'rerank_exact') as rerank, \
+                    mock.patch.object(engine, '_fill_short_rows', wraps=engine._fill_short_rows) as fill:
+                _, indices = engine._search_vectors(queries, 12)
+                rerank.assert_not_called()
+                self.assertEqual(fill.call_count, 1)
+                self.assertEqual(engine.snapshot.image_ids_at(indices).tolist(), expected)
+
+
+class SearchPageTests(CLIPEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = self.make_vectors(150)
+        self.image_ids = list(range(1, 151))
+        metadata = self.make_metadata(self.image_ids, is_public=lambda image_id: image_id % 10 != 0,
+                                      owner=lambda image_id: 2 if image_id == 10 else 1)
+        self.engine = self.make_engine(self.vectors, metadata, PAGE_DEPTH=90, COMPACTION_THRESHOLD=1.0)
+        self.queries['lake'] = self.vectors[0]
+
+    def walk(self, cursor, viewer_id=None):
+        pages = []
+        while cursor:
+            page = self.engine.search_page(cursor=cursor, viewer_id=viewer_id)
+            self.assertFalse(page['expired'])
+            pages.append(page)
+            cursor = page['next_cursor']
+        return pages
+
+    def test_pages_follow_the_ranked_list_without_gaps(self):
+        first = self.engine.search_page('lake', page_size=20)
+        pages = [first] + self.walk(first['next_cursor'])
+
+        self.assertEqual([len(page['results']) for page in pages], [20, 20, 20, 20, 10])
+        public = [pos for pos, image_id in enumerate(self.image_ids) if image_id % 10 != 0]
+        expected = self.exact_ranking(self.vectors[public], [self.image_ids[pos] for pos in public],
+                                      self.vectors[0], 90)
+        self.assertEqual([result['id'] for page in pages for result in page['results']], expected)
+        self.assertEqual({page['index_version'] for page in pages}, {first['index_version']})
+        self.assertFalse(any(page['stale'] for page in pages))
+
+    def test_tampered_cursors_are_rejected(self):
+        from clip_retrieval.query_cache import decode_cursor, encode_cursor
+
+        first = self.engine.search_page('lake', page_size=20)
+        token, offset = decode_cursor(first['next_cursor'])
+        for cursor in ('not a cursor', encode_cursor('0' * 24, offset), encode_cursor(token, -20),
+                       first['next_cursor'][:-3], 'bGFrZTphYmM'):
+            with self.subTest(cursor=cursor):
+                page = self.engine.search_page(cursor=cursor)
+                self.assertEqual((page['results'], page['next_cursor'], page['expired']), ([], None, True))
+
+        # Danh sách có ảnh private của viewer 2: người khác không đọc được bằng cursor của họ
+        private = self.engine.search_page('lake', page_size=20, viewer_id=2)
+        self.assertIn(10, [result['id'] for page in [private] + self.walk(private['next_cursor'], 2)
+                           for result in page['results']])
+        self.assertTrue(self.engine.search_page(cursor=private['next_cursor'])['expired'])
+        self.assertTrue(self.engine.search_page(cursor=private['next_cursor'], viewer_id=3)['expired'])
+
+    def test_cursor_is_stale_after_index_change_then_expires(self):
+        first = self.engine.search_page('lake', page_size=20)
+        deleted = first['results'][0]['id']
+        self.engine.remove_images_from_index([deleted])
+
+        # Cursor cũ vẫn cắt danh sách đã xếp hạng, nhưng báo là index đã đổi
+        page = self.engine.search_page(cursor=first['next_cursor'])
+        self.assertEqual((page['index_version'], page['stale'], page['expired']),
+                         (first['index_version'], True, False))
+        self.assertEqual(len(page['results']), 20)
+
+        # Truy vấn mới xếp hạng lại trên phiên bản index mới
+        fresh = self.engine.search_page('lake', page_size=20)
+        self.assertGreater(fresh['index_version'], first['index_version'])
+        self.assertFalse(fresh['stale'])
+        self.assertNotIn(deleted, [result['id'] for result in fresh['results']])
+
+        # Hết PAGE_TTL: danh sách cũ không còn, cursor hết hạn
+        with mock.patch('django.core.cache.backends.locmem.time.time',
+                        return_value=time.time() + self.engine.page_store.ttl + 1):
+            page = self.engine.search_page(cursor=first['next_cursor'])
+        self.assertEqual((page['results'], page['next_cursor'], page['expired']), ([], None, True))
+
+class TwoStageRerankTests(CLIPEngineTestCase):
+    def test_pca_candidates_are_reranked_to_the_exact_order(self):
+        # Dữ liệu gần hạng thấp (như embedding CLIP): PCA giữ được hàng xóm gần nhưng sai thứ tự giữa chúng
+        rng = np.random.default_rng(3)
+        vectors = rng.standard_normal((600, 6)) @ rng.standard_normal((6, self.dimension))
+        vectors = vectors + 0.3 * rng.standard_normal(vectors.shape)
+        vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype('float32')
+        queries = vectors[:8] + 0.05 * rng.standard_normal((8, self.dimension))
+        queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype('float32')
+        metadata = self.make_metadata(range(1, 601))
+
+        flat = self.make_engine(vectors, metadata)
+        reduced = self.make_engine(vectors, metadata, pca_dim=6, RERANK_FACTOR=4, RERANK_MIN_CANDIDATES=40)
+        self.assertEqual(reduced.snapshot.index_info['pca_dim'], 6)
+
+        flat_distances, flat_indices = flat._search_vectors(queries, 10)
+        distances, indices = reduced._search_vectors(queries, 10)
+        # Tầng thô (PCA) xếp sai thứ tự, re-rank bằng vector gốc đưa về đúng kết quả của flat
+        _, coarse_indices = reduced.snapshot.index.search(queries, 10)
+        self.assertFalse((coarse_indices == flat_indices).all())
+        self.assertEqual(indices.tolist(), flat_indices.tolist())
+        np.testing.assert_allclose(distances, flat_distances, rtol=1e-5, atol=1e-6)
+        self.assertEqual(indices.tolist(), [self.exact_ranking(vectors, list(range(600)), query, 10)
+                                            for query in queries])
+
+class TextQueryCacheTests(CLIPEngineTestCase):
+    def test_repeated_query_reuses_embedding_and_ranking(self):
+        vectors = self.make_vectors(200)
+        engine = self.make_engine(vectors, self.make_metadata(range(1, 201)))
+        self.queries['hồ gươm'] = vectors[9]
+        expected = self.exact_ranking(vectors, list(range(1, 201)), vectors[9], 30)
+
+        with mock.patch.object(engine, 'encode_texts', wraps=engine.encode_texts) as encode, \
+                mock.patch.object(engine, '_search_vectors', wraps=engine._search_vectors) as search:
+            first = engine.search('hồ gươm', top_k=30)
+            # Truy vấn chuẩn hoá giống nhau, top_k nhỏ hơn: cắt từ danh sách đã cache
+            second = engine.search('  Hồ   Gươm ', top_k=5)
+        self.assertEqual([result['id'] for result in first], expected)
+        self.assertEqual([result['id'] for result in second], expected[:5])
+        self.assertEqual((encode.call_count, search.call_count), (1, 1))
+
+        # Ranking bị invalidate nhưng embedding vẫn dùng lại
+        engine._invalidate_search_cache()
+        with mock.patch.object(engine, 'encode_texts', wraps=engine.encode_texts) as encode:
+            self.assertEqual([result['id'] for result in engine.search('hồ gươm', top_k=5)], expected[:5])
+        encode.assert_not_called()
+
+
+    def test_warmed_popular_query_is_served_from_the_rank_cache(self):
+        vectors = self.make_vectors(200)
+        engine = self.make_engine(vectors, self.make_metadata(range(1, 201)))
+        self.queries['hồ gươm'] = vectors[9]
+        self.assertTrue(engine._warm_query('hồ gươm'))
+
+        with mock.patch.object(engine, 'encode_texts') as encode, \
+                mock.patch.object(engine, '_search_vectors') as search:
+            results = engine.search('Hồ Gươm', top_k=12)
+        encode.assert_not_called()
+        search.assert_not_called()
+        self.assertEqual([result['id'] for result in results],
+                         self.exact_ranking(vectors, list(range(1, 201)), vectors[9], 12))
+
+class SearchCacheInvalidationTests(CLIPEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = self.make_vectors(51)
+        self.ids = list(range(1, 51))
+        self.engine = self.make_engine(self.vectors[:50], self.make_metadata(self.ids))
+        # Ảnh 201 (chưa index) có vector trùng với truy vấn
+        self.queries['lake'] = self.vectors[50]
+
+    def cached_ids(self):
+        return ([result['id'] for result in self.engine.search('lake', top_k=5)],
+                [result['id'] for result in self.engine.search_by_image_id(3, top_k=5)])
+
+    def index_image(self, image_id, vector):
+        row = mock.Mock(id=image_id, title=f'image {image_id}', description='', is_public=True,
+                        created_at='2024-01-01', **{'file.url': f'{image_id}.jpg', 'user.id': 1})
+        with mock.patch.object(self.engine, '_load_images', return_value=[row]), \
+                mock.patch.object(self.engine, '_encode_images', return_value=([row], vector.reshape(1, -1))):
+            return self.engine.update_index_for_images([image_id])
+
+    def test_cached_results_follow_updates_and_removals(self):
+        before = (self.exact_ranking(self.vectors[:50], self.ids, self.vectors[50], 5),
+                  [image_id for image_id in self.exact_ranking(self.vectors[:50], self.ids, self.vectors[2], 6)
+                   if image_id != 3])
+        self.assertEqual(self.cached_ids(), before)
+        with mock.patch.object(self.engine, '_search_vectors') as search:
+            self.assertEqual(self.cached_ids(), before)
+        search.assert_not_called()
+
+        # Ảnh mới gần truy vấn nhất: cache cũ không được trả về nữa
+        self.assertEqual(self.index_image(201, self.vectors[50]), [201])
+        ids = self.ids + [201]
+        vectors = np.vstack([self.vectors[:50], self.vectors[50:51]])
+        after_add = self.cached_ids()
+        self.assertEqual(after_add, (self.exact_ranking(vectors, ids, self.vectors[50], 5),
+                                     [image_id for image_id in self.exact_ranking(vectors, ids, self.vectors[2], 6)
+                                      if image_id != 3]))
+        self.assertEqual(after_add[0][0], 201)
+
+        self.assertEqual(self.engine.remove_images_from_index([201]), [201])
+        self.assertEqual(self.cached_ids(), before)
+
+    def test_remove_invalidates_even_when_the_bump_fails(self):
+        removed = self.cached_ids()[0][0]
+        self.engine.search_generation.bump = mock.Mock(side_effect=ConnectionError)
+        self.engine.remove_images_from_index([removed])
+        # Version của index nằm trong key: không đọc lại kết quả tính trước khi xoá
+        self.assertNotIn(removed, self.cached_ids()[0])
+
+
+class SearchBatchTests(CLIPEngineTestCase):
+    def test_images_missing_from_the_index_are_encoded_together(self):
+        import torch
+
+        vectors = self.make_vectors(60)
+        engine = self.make_engine(vectors[:50], self.make_metadata(range(1, 51)))
+        # Ảnh 101, 102 chưa được index (vector = vectors[50], vectors[51]); ảnh 103 không tồn tại
+        rows = [mock.Mock(id=101), mock.Mock(id=102)]
+        engine.image_encoder = mock.Mock(return_value=vectors[50:52])
+        with mock.patch.object(engine, '_load_images', return_value=rows) as load, \
+                mock.patch.object(engine, '_fetch_and_preprocess', side_effect=lambda image: (image, torch.zeros(3))):
+            results = engine.search_batch([
+                {'image_id': 101, 'top_k': 5}, {'image_id': 7, 'top_k': 5}, {'image_id': 102, 'top_k': 3},
+                {'image_id': 103, 'top_k': 5}, {'image_id': 101, 'top_k': 2},
+            ])
+
+        load.assert_called_once_with([101, 102, 103])
+        engine.image_encoder.assert_called_once()
+        self.assertEqual(tuple(engine.image_encoder.call_args.args[0].shape), (2, 3))
+        ids = list(range(1, 51))
+        self.assertEqual([result['id'] for result in results[0]], self.exact_ranking(vectors[:50], ids, vectors[50], 5))
+        self.assertEqual([result['id'] for result in results[2]], self.exact_ranking(vectors[:50], ids, vectors[51], 3))
+        self.assertEqual([result['id'] for result in results[4]], self.exact_ranking(vectors[:50], ids, vectors[50], 2))
+        self.assertEqual([result['id'] for result in results[1]],
+                         [image_id for image_id in self.exact_ranking(vectors[:50], ids, vectors[6], 6) if image_id != 7])
+        self.assertEqual(results[3], [])
+
+
+class UploadQuerySearchTests(CLIPEngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.vectors = self.make_vectors(50)
+        self.engine = self.make_engine(self.vectors, self.make_metadata(range(1, 51)))
+        self.decoded, self.encoded = [], []
+        decode = self.engine._decode_query_image
+
+        def decode_query_image(source):
+            self.decoded.append(1)
+            return decode(source)
+
+        def encode_image(img):
+            # Ảnh đỏ khớp vector của ảnh 1, ảnh xanh khớp ảnh 2
+            red, _, blue = img.getpixel((0, 0))
+            self.encoded.append(1)
+            return self.vectors[[0 if red > blue else 1]]
+
+        for patch in (mock.patch.object(self.engine, '_decode_query_image', decode_query_image),
+                      mock.patch.object(self.engine, '_encode_image', encode_image)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    @staticmethod
+    def image_bytes(color, image_format='PNG'):
+        from io import BytesIO
+        from PIL import Image as PILImage
+
+        buffer = BytesIO()
+        PILImage.new('RGB', (320, 240), color).save(buffer, format=image_format)
+        return buffer.getvalue()
+
+    def test_same_bytes_reuse_the_cached_embedding(self):
+        red = self.image_bytes((255, 0, 0))
+        first = self.engine.search_by_image_bytes(red, top_k=5)
+        self.assertEqual(first[0]['id'], 1)
+        self.assertEqual((len(self.decoded), len(self.encoded)), (1, 1))
+
+        # Upload lại đúng ảnh đó: không decode, không encode lại
+        self.assertEqual(self.engine.search_by_image_bytes(red, top_k=5), first)
+        self.assertEqual((len(self.decoded), len(self.encoded)), (1, 1))
+
+    def test_different_bytes_do_not_collide(self):
+        self.assertEqual(self.engine.search_by_image_bytes(self.image_bytes((255, 0, 0)), top_k=5)[0]['id'], 1)
+        self.assertEqual(self.engine.search_by_image_bytes(self.image_bytes((0, 0, 255)), top_k=5)[0]['id'], 2)
+        # Cùng nội dung nhưng khác định dạng (JPEG): bytes khác nên là một entry riêng
+        self.assertEqual(
+            self.engine.search_by_image_bytes(self.image_bytes((255, 0, 0), 'JPEG'), top_k=5)[0]['id'], 1
+        )
+        self.assertEqual((len(self.decoded), len(self.encoded)), (3, 3))
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SingleFlightCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_misses_compute_once(self):
+        entries = SingleFlightCache(ttl=60)
+        started, release, calls = threading.Event(), threading.Event(), []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ['result']
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(entries.get_or_compute('q', compute)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['result']] * 4)
+
+    def test_stale_entry_is_served_while_refreshing(self):
+        refreshes = []
+        entries = SingleFlightCache(ttl=60, soft_ttl=1, background=lambda fn: refreshes.append(fn) or True)
+        entries.get_or_compute('q', lambda: 'old')
+
+        with mock.patch('clip_retrieval.query_cache.time.time', return_value=time.time() + 5):
+            self.assertEqual(entries.get_or_compute('q', lambda: 'new'), 'old')
+            # Lock làm mới đang giữ: request khác không xếp thêm lần làm mới
+            self.assertEqual(entries.get_or_compute('q', lambda: 'new'), 'old')
+        self.assertEqual(len(refreshes), 1)
+
+        refreshes[0]()
+        self.assertEqual(entries.get_or_compute('q', lambda: 'newer'), 'new')
+
+
+class SearchDaemonProtocolTests(SimpleTestCase):
+    """Request / response đi qua socket thật giữa CLIPSearchClient và SearchServer (engine giả)"""
+
+    def setUp(self):
+        socket_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(socket_dir.cleanup)
+        self.engine = mock.Mock()
+        self.server = SearchServer(self.engine, os.path.join(socket_dir.name, 'search.sock'))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = CLIPSearchClient(self.server.socket_path, timeout=5)
+
+    def test_request_frames_round_trip(self):
+        body = search_protocol.pack_search('hồ nước', 20, nprobe=8, use_cache=False, viewer_id=7)
+        self.assertEqual(search_protocol.unpack_search(body), ('hồ nước', 20, 8, None, False, 7))
+        data = bytes(range(256))
+        self.assertEqual(search_protocol.unpack_search(search_protocol.pack_search(data, 5), raw=True),
+                         (data, 5, None, None, True, None))
+
+        self.engine.search.return_value = []
+        self.client.search('hồ nước', top_k=20, use_cache=False, ef_search=32, viewer_id=7)
+        self.engine.search.assert_called_once_with('hồ nước', top_k=20, use_cache=False, nprobe=None, ef_search=32,
+                                                   viewer_id=7)
+        self.engine.search_by_image_bytes.return_value = []
+        self.client.search_by_image_bytes(data, top_k=5)
+        self.engine.search_by_image_bytes.assert_called_once_with(data, top_k=5, nprobe=None, ef_search=None,
+                                                                  viewer_id=None)
+        self.engine.remove_images_from_index.return_value = [3]
+        self.assertEqual(self.client.remove_images_from_index([3, 2 ** 40]), [3])
+        self.engine.remove_images_from_index.assert_called_once_with([3, 2 ** 40])
+
+    def test_response_frames_round_trip(self):
+        results = [{'id': 3, 'similarity_score': 0.75, 'title': 'Hồ Gươm', 'categories': [{'name': 'hồ'}]},
+                   {'id': 2 ** 40, 'similarity_score': 0.5, 'file': 'b.jpg'}]
+        self.engine.search_hybrid.return_value = results
+        self.assertEqual(self.client.search_hybrid('hồ'), results)
+
+        page = {'results': results, 'next_cursor': 'abc', 'index_version': 4, 'stale': False, 'expired': False}
+        self.engine.search_page.return_value = page
+        self.assertEqual(self.client.search_page(cursor='abc', viewer_id=7), page)
+        self.assertEqual(self.engine.search_page.call_args.kwargs['cursor'], 'abc')
+
+        vectors = np.arange(6, dtype='float32').reshape(2, 3) / 7
+        self.engine.encode_texts.return_value = vectors
+        np.testing.assert_array_equal(self.client.encode_texts(['a', 'b']), vectors)
+        self.engine.contains.return_value = True
+        self.assertTrue(self.client.contains(3))
+
+    def test_error_and_overload_frames(self):
+        self.engine.search.side_effect = ValueError('index chưa sẵn sàng')
+        with self.assertRaisesMessage(SearchDaemonError, 'index chưa sẵn sàng'):
+            self.client.search('hồ')
+
+        self.engine.search.side_effect = InferenceOverloaded('queue full', retry_after=3, reason='deadline')
+        with self.assertRaises(InferenceOverloaded) as raised:
+            self.client.search('hồ')
+        self.assertEqual((str(raised.exception), raised.exception.retry_after, raised.exception.reason),
+                         ('queue full', 3, 'deadline'))
+
+        with self.assertRaisesMessage(SearchDaemonError, 'Unknown operation 99'):
+            self.client._call(99, b'')
+
+        # Frame lỗi không làm hỏng kết nối: request tiếp theo trên cùng socket vẫn chạy
+        self.engine.search.side_effect = None
+        self.engine.search.return_value = [{'id': 1, 'similarity_score': 1.0}]
+        self.assertEqual(self.client.search('hồ'), [{'id': 1, 'similarity_score': 1.0}])
+
+    def test_oversized_frame_is_rejected(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        left.sendall(struct.pack('<IB', search_protocol.MAX_FRAME_SIZE + 1, search_protocol.OP_SEARCH_TEXT))
+        with self.assertRaises(search_protocol.ProtocolError):
+            search_protocol.recv_frame(right)
@@ -4,28 +4,28 @@ from django.contrib.auth.models import User
 from rest_framework import viewsets, status, permissions, mixins
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.generics import CreateAPIView
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 
-from clip_retrieval.clip_search import CLIPImageSearch
 import boto3
 from django.conf import settings
 import traceback
 
 import os
-import tempfile
-from .models import Category, Image, UserProfile, ImageCategory, Notification, Collection , Follow, LikedImage
+from .models import Category, Image, UserProfile, ImageCategory, Notification, Collection , Follow, LikedImage, get_clip_search
 from .serializers import (
     CategorySerializer, ImageSerializer, CollectionSerializer,
     UserSerializer, RegisterSerializer, UserProfileSerializer, 
     ImagesCategorySerializer, NotificationSerializer , FollowSerializer , LikedImageSerializer, DownloadedImage
     , ImageSearchSerializer, SimilarImageResultSerializer
 )
-from .image_search import ImageSearch
 
 # Import hàm tiện ích để tạo thông báo
 from .utils import create_notification
+from .search_hydration import attach_cards, hydrate_results, load_cards, visibility_filter
+from clip_retrieval.executor import InferenceOverloaded
+from clip_retrieval.popular_queries import PopularQueryTracker
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
@@ -141,6 +141,38 @@ class CollectionViewSet(viewsets.ModelViewSet):
         return super().destroy(request, *args, **kwargs)
 
 
+# Giới hạn cứng số kết quả mỗi lần tìm kiếm
+SEARCH_MAX_TOP_K = getattr(settings, 'CLIP_SEARCH_MAX_TOP_K', 100)
+
+
+def search_top_k(params, default):
+    """Đọc top_k từ request, giới hạn trong khoảng [1, SEARCH_MAX_TOP_K]"""
+    try:
+        top_k = int(params.get('top_k', default))
+    except (TypeError, ValueError):
+        top_k = default
+    return min(max(top_k, 1), SEARCH_MAX_TOP_K)
+
+
+def search_viewer_id(request):
+    """UserProfile id của người xem: ảnh private của chính họ cũng được tìm thấy"""
+    if not request.user.is_authenticated:
+        return None
+    profile = getattr(request.user, 'userprofile', None)
+    return profile.id if profile is not None else None
+
+
+def search_overloaded(error):
+    """503 + Retry-After khi hàng đợi inference đầy hoặc request quá deadline (client thử lại sau)"""
+    print(f"⚠️ Search rejected ({error.reason}): {error}")
+    response = Response({
+        'error': 'Hệ thống tìm kiếm đang quá tải, vui lòng thử lại sau',
+        'retry_after': error.retry_after,
+    }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
+
 class ImageViewSet(viewsets.ModelViewSet):
     serializer_class = ImageSerializer
     parser_classes = [MultiPartParser, FormParser, JSONParser]
@@ -200,6 +232,26 @@ class ImageViewSet(viewsets.ModelViewSet):
                     print(f"Lỗi khi thêm danh mục {category_id} cho ảnh {image.id}: {str(e)}")
         
         return image
+
+    def create(self, request, *args, **kwargs):
+        """Tạo ảnh; việc thêm vào CLIP index chạy nền nên response trả về ngay với trạng thái 'pending'"""
+        response = super().create(request, *args, **kwargs)
+        return self._with_indexing_status(response)
+
+    def update(self, request, *args, **kwargs):
+        response = super().update(request, *args, **kwargs)
+        return self._with_indexing_status(response)
+
+    def _with_indexing_status(self, response):
+        from clip_retrieval import index_queue
+        image_id = response.data.get('id') if isinstance(response.data, dict) else None
+        if image_id is not None:
+            try:
+                response.data['indexing_status'] = index_queue.get_status(image_id)
+            except Exception as e:
+                print(f"Error reading indexing status for image {image_id}: {e}")
+        return response
+
     def perform_destroy(self, instance):
         """
         Xoá ảnh trên AWS S3 trước khi xoá bản ghi trong database
@@ -393,6 +445,28 @@ class ImageViewSet(viewsets.ModelViewSet):
             return Response({
                 'error': f'Lỗi khi lấy ảnh theo danh mục: {str(e)}'
             }, status=status.HTTP_400_BAD_REQUEST)
+    @action(detail=True, methods=['get'], url_path='similar')
+    def search_similar(self, request, pk=None):
+        """
+        Ảnh tương tự cho trang chi tiết: dùng vector của ảnh đã có trong CLIP index
+        (không tải ảnh từ S3, không chạy model), chỉ encode lại khi ảnh chưa được index.
+        """
+        viewer_id = search_viewer_id(request)
+        image = get_object_or_404(Image.objects.filter(visibility_filter(viewer_id)), pk=pk)
+        top_k = search_top_k(request.query_params, 12)
+
+        try:
+            results = get_clip_search().search_by_image_id(image.id, top_k=top_k, viewer_id=viewer_id)
+        except InferenceOverloaded as e:
+            return search_overloaded(e)
+        except Exception as e:
+            print(f"❌ Lỗi khi tìm ảnh tương tự với ảnh #{image.id}: {e}")
+            return Response({'error': 'Không thể tìm ảnh tương tự lúc này'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        results = hydrate_results(results, viewer_id)
+        return Response({'count': len(results), 'results': results})
+
     @action(detail=True, methods=['post'], url_path='like')
     def like_image(self, request, pk=None):
         """API endpoint để like ảnh, tự động xác định loại ảnh"""
@@ -582,10 +656,36 @@ class ImageSearchViewSet(viewsets.ViewSet):
       - POST /api/image-search/        (create): Xử lý tìm kiếm ảnh dựa trên URL hoặc file upload.
       - POST /api/image-search/upload/ (search_by_upload): Tìm kiếm theo file ảnh upload.
       - POST /api/image-search/url/    (search_by_url): Tìm kiếm theo URL ảnh.
+      - POST /api/image-search/text/   (search_by_text): Tìm kiếm theo văn bản (phân trang bằng cursor).
+      - POST /api/image-search/batch/  (search_batch): Nhiều truy vấn văn bản / image id trong một request.
+      - GET /api/image-search/metrics/ (metrics): Thống kê runtime (chỉ admin).
+      - GET /api/image-search/popular-queries/ (popular_queries): Truy vấn văn bản phổ biến nhất (chỉ admin).
     """
     permission_classes = [AllowAny]
     parser_classes = [MultiPartParser, FormParser, JSONParser]
 
+    # Giới hạn tham số tinh chỉnh ANN index do client gửi lên
+    MAX_NPROBE = 1024
+    MAX_EF_SEARCH = 2048
+    # Tìm kiếm văn bản mặc định chỉ dùng CLIP (similarity_score = độ tương đồng CLIP); mode=hybrid kết hợp thêm
+    # BM25 (title / description), khi đó similarity_score là điểm đã trộn
+    HYBRID_SEARCH_ENABLED = getattr(settings, 'CLIP_HYBRID_SEARCH_ENABLED', True)
+    # Số truy vấn tối đa trong một request batch
+    MAX_BATCH_QUERIES = getattr(settings, 'CLIP_SEARCH_MAX_BATCH_QUERIES', 50)
+
+    def _search_tuning(self, request):
+        """Đọc nprobe (IVF) / ef_search (HNSW) tuỳ chọn từ request"""
+        tuning = {}
+        for name, upper in (('nprobe', self.MAX_NPROBE), ('ef_search', self.MAX_EF_SEARCH)):
+            value = request.data.get(name)
+            if value in (None, ''):
+                continue
+            try:
+                tuning[name] = min(max(int(value), 1), upper)
+            except (TypeError, ValueError):
+                continue
+        return tuning
+
     def list(self, request):
         """Hiển thị thông tin hướng dẫn tìm kiếm ảnh (GET request)"""
         return Response({
@@ -599,87 +699,43 @@ class ImageSearchViewSet(viewsets.ViewSet):
         image_file = request.FILES.get('image_file')
         image_url = request.data.get('image_url')
         query = request.data.get('query')
-        top_k = int(request.data.get('top_k', 12))
+        top_k = search_top_k(request.data, 12)
+        tuning = self._search_tuning(request)
+        # Lọc visibility ngay trong FAISS search: trả về đủ top_k ảnh người xem được phép thấy
+        tuning['viewer_id'] = search_viewer_id(request)
 
         try:
-            # Use singleton pattern to get CLIPImageSearch instance
-            search_engine = CLIPImageSearch.get_instance()
+            # In-process engine or the search daemon client
+            search_engine = get_clip_search()
 
             # Ưu tiên tìm kiếm theo ảnh dựa trên URL
             if image_url:
                 # Sử dụng search() của CLIPImageSearch – phiên bản dùng URL để tải ảnh và xử lý embedding
-                results = search_engine.search_by_image(image_url, top_k=top_k)
+                results = search_engine.search_by_image(image_url, top_k=top_k, **tuning)
             elif image_file:
-                # Lưu file ảnh tạm thời để xử lý
-                with tempfile.NamedTemporaryFile(delete=False) as tmp:
-                    for chunk in image_file.chunks():
-                        tmp.write(chunk)
-                    tmp_path = tmp.name
-                    
-                try:
-                    results = search_engine.search_by_image(tmp_path, top_k=top_k)
-                finally:
-                    # Xóa file tạm
-                    if os.path.exists(tmp_path):
-                        os.unlink(tmp_path)
+                # Decode thẳng từ buffer upload (bộ nhớ hoặc file spool của Django), không ghi file tạm
+                results = search_engine.search_by_image_bytes(image_file.read(), top_k=top_k, **tuning)
             else:
                 # Nếu không có ảnh nào được cung cấp, bạn có thể xử lý tìm kiếm theo query văn bản.
                 # (Chỉ áp dụng nếu bạn hỗ trợ tìm kiếm text; nếu không, trả về thông báo lỗi.)
-                results = search_engine.search(query, top_k=top_k)
-
-            # Lấy thêm thông tin từ database, nếu kết quả trả về có id liên kết với model Image
-            results_with_db_data = []
-            for result in results:
-                image_id = result.get('id')
-                if image_id:
-                    try:
-                        if request.user.is_authenticated:
-                            img = Image.objects.filter(
-                                Q(id=image_id, is_public=True) |
-                                Q(id=image_id, user=request.user.userprofile)
-                            ).first()
-                        else:
-                            img = Image.objects.filter(id=image_id, is_public=True).first()
-
-                        if img:
-                            result_item = {
-                                'id': img.id,
-                                'file': img.file.url if hasattr(img.file, 'url') else str(img.file),
-                                'title': getattr(img, 'title', ''),
-                                'description': getattr(img, 'description', ''),
-                                'created_at': getattr(img, 'created_at', None),
-                                'distance': result.get('distance', 0),
-                                'similarity': round(100 * (1 - min(result.get('distance', 0) / 2, 1)), 2)
-                            }
-                            # Thêm các trường thông tin khác nếu cần
-                            if hasattr(img, 'user'):
-                                result_item['user'] = str(img.user)
-                            if hasattr(img, 'likes'):
-                                result_item['likes'] = img.likes
-                            if hasattr(img, 'is_public'):
-                                result_item['is_public'] = img.is_public
-
-                            results_with_db_data.append(result_item)
-                            continue
-                    except Exception as e:
-                        print(f"Lỗi khi xử lý ảnh ID {image_id}: {str(e)}")
-                # Nếu không có thông tin id hay không liên kết với database, trả về thông tin tìm kiếm trực tiếp từ index
-                result_item = {
-                    'file': result.get('file', ''),
-                    'distance': result.get('distance', 0),
-                    'similarity': round(100 * (1 - min(result.get('distance', 0) / 2, 1)), 2),
-                    'from_index_only': True
-                }
-                for key in result:
-                    if key not in result_item and key != 'distance':
-                        result_item[key] = result[key]
-                results_with_db_data.append(result_item)
+                results = search_engine.search(query, top_k=top_k, **tuning)
+
+            # Lấy thêm thông tin từ database: một query (hoặc cache card) cho toàn bộ kết quả, giữ thứ tự xếp hạng
+            results_with_db_data = hydrate_results(results, tuning['viewer_id'])
+            for result_item in results_with_db_data:
+                # Khoảng cách L2 tương ứng với similarity_score = 1 / (1 + distance) của engine
+                score = result_item['similarity_score']
+                distance = 1.0 / score - 1.0 if score else 0
+                result_item['distance'] = distance
+                result_item['similarity'] = round(100 * (1 - min(distance / 2, 1)), 2)
 
             return Response({
                 'count': len(results_with_db_data),
                 'results': results_with_db_data
             })
 
+        except InferenceOverloaded as e:
+            return search_overloaded(e)
         except Exception as e:
             error_traceback = traceback.format_exc()
             print(f"ERROR: {str(e)}")
@@ -703,62 +759,52 @@ class ImageSearchViewSet(viewsets.ViewSet):
         return self.create(request)
     @action(detail=False, methods=['post'], url_path='text')
     def search_by_text(self, request):
+        """
+        Tìm kiếm theo văn bản, phân trang bằng cursor: trang đầu gửi query (top_k = số ảnh mỗi trang),
+        các trang sau chỉ gửi lại next_cursor của response trước. stale=true nghĩa là index đã thay đổi
+        kể từ khi danh sách được xếp hạng (client có thể tìm kiếm lại từ đầu).
+        """
         query = request.data.get('query', '')
-        top_k = int(request.data.get('top_k', 20))
+        cursor = request.data.get('cursor') or None
+        top_k = search_top_k(request.data, 20)
+        tuning = self._search_tuning(request)
+        tuning['viewer_id'] = search_viewer_id(request)
+        mode = 'hybrid' if request.data.get('mode') == 'hybrid' and self.HYBRID_SEARCH_ENABLED else 'vector'
 
-        if not query:
+        if not query and not cursor:
             return Response({"error": "Vui lòng cung cấp query"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            # Use singleton pattern to get CLIPImageSearch instance
-            search_engine = CLIPImageSearch.get_instance()
+            # In-process engine or the search daemon client
+            search_engine = get_clip_search()
             
             # Sử dụng try-except cụ thể cho tìm kiếm text để xử lý lỗi Redis
             try:
-                results = search_engine.search(query, top_k=top_k)
+                page = search_engine.search_page(query, page_size=top_k, cursor=cursor, mode=mode, **tuning)
+            except InferenceOverloaded:
+                raise
             except Exception as search_error:
                 print(f"Redis error during text search: {search_error}. Using search without cache.")
                 # Thử lại mà không dùng cache nếu có lỗi Redis
-                results = search_engine.search(query, top_k=top_k, use_cache=False)
+                page = search_engine.search_page(query, page_size=top_k, cursor=cursor, mode=mode, use_cache=False,
+                                                 **tuning)
             
-            # Chuẩn bị kết quả
-            results_with_db_data = []
-            for result in results:
-                image_id = result.get('id')
-                if image_id:
-                    try:
-                        if request.user.is_authenticated:
-                            img = Image.objects.filter(
-                                Q(id=image_id, is_public=True) |
-                                Q(id=image_id, user=request.user.userprofile)
-                            ).first()
-                        else:
-                            img = Image.objects.filter(id=image_id, is_public=True).first()
-
-                        if img:
-                            result_item = {
-                                'id': img.id,
-                                'file': img.file.url if hasattr(img.file, 'url') else str(img.file),
-                                'title': getattr(img, 'title', ''),
-                                'description': getattr(img, 'description', ''),
-                                'similarity_score': result.get('similarity_score', 0),
-                                'user': str(img.user) if hasattr(img, 'user') else None,
-                                'likes': getattr(img, 'likes', 0),
-                                'downloads': getattr(img, 'downloads', 0),
-                            }
-                            results_with_db_data.append(result_item)
-                    except Exception as e:
-                        print(f"Error retrieving image {image_id} data: {e}")
-                        # Vẫn giữ nguyên kết quả từ index để không làm mất kết quả tìm kiếm
-                        results_with_db_data.append(result)
-                else:
-                    # Nếu không có ID, thêm kết quả nguyên bản
-                    results_with_db_data.append(result)
+            if page['expired']:
+                return Response({"error": "Cursor không hợp lệ hoặc đã hết hạn, vui lòng tìm kiếm lại"},
+                                status=status.HTTP_410_GONE)
+            
+            # Chỉ hydrate trang hiện tại: một query (hoặc cache card), giữ thứ tự xếp hạng
+            results_with_db_data = hydrate_results(page['results'], tuning['viewer_id'])
             
             return Response({
                 'count': len(results_with_db_data),
-                'results': results_with_db_data
+                'results': results_with_db_data,
+                'next_cursor': page['next_cursor'],
+                'index_version': page['index_version'],
+                'stale': page['stale'],
             })
+        except InferenceOverloaded as e:
+            return search_overloaded(e)
         except Exception as e:
             error_trace = traceback.format_exc()
             print(f"Error in text search: {e}")
@@ -768,6 +814,71 @@ class ImageSearchViewSet(viewsets.ViewSet):
                 'message': 'Lỗi khi tìm kiếm văn bản. Vui lòng thử lại sau.'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @action(detail=False, methods=['post'], url_path='batch')
+    def search_batch(self, request):
+        """
+        Nhiều truy vấn trong một request (carousel của trang danh mục, đối tác):
+        {"queries": [{"key": "beach", "text": "sunset beach", "top_k": 10}, {"key": "more", "image_id": 42}]}
+        Encode một lần, một lần FAISS search nhiều dòng, một query database cho toàn bộ kết quả.
+        """
+        queries = request.data.get('queries')
+        if not isinstance(queries, list) or not queries:
+            return Response({"error": "Vui lòng cung cấp danh sách queries"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(queries) > self.MAX_BATCH_QUERIES:
+            return Response({"error": f"Tối đa {self.MAX_BATCH_QUERIES} truy vấn mỗi request"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        keys = []
+        parsed = []
+        for position, item in enumerate(queries):
+            if not isinstance(item, dict):
+                return Response({"error": f"Query #{position} không hợp lệ"}, status=status.HTTP_400_BAD_REQUEST)
+            text = item.get('text')
+            image_id = item.get('image_id')
+            if text:
+                parsed.append({'text': str(text), 'top_k': search_top_k(item, 12)})
+            elif image_id not in (None, ''):
+                try:
+                    image_id = int(image_id)
+                except (TypeError, ValueError):
+                    return Response({"error": f"Query #{position}: image_id không hợp lệ"},
+                                    status=status.HTTP_400_BAD_REQUEST)
+                parsed.append({'image_id': image_id, 'top_k': search_top_k(item, 12)})
+            else:
+                return Response({"error": f"Query #{position} cần 'text' hoặc 'image_id'"},
+                                status=status.HTTP_400_BAD_REQUEST)
+            key = str(item.get('key') or text or f'image:{image_id}')
+            if key in keys:
+                # Kết quả trả về theo key: hai query cùng key sẽ ghi đè nhau
+                return Response({"error": f"Query #{position}: key '{key}' bị trùng, hãy đặt 'key' riêng cho từng query"},
+                                status=status.HTTP_400_BAD_REQUEST)
+            keys.append(key)
+
+        viewer_id = search_viewer_id(request)
+        try:
+            results = get_clip_search().search_batch(parsed, viewer_id=viewer_id)
+        except InferenceOverloaded as e:
+            return search_overloaded(e)
+        except Exception as e:
+            error_trace = traceback.format_exc()
+            print(f"Error in batch search: {e}")
+            print(f"Traceback: {error_trace}")
+            return Response({
+                'error': str(e),
+                'message': 'Lỗi khi tìm kiếm. Vui lòng thử lại sau.'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # Card của mọi kết quả và của các ảnh nguồn (image_id) trong một lần: ảnh nguồn người xem
+        # không được thấy thì truy vấn đó trả về rỗng
+        source_ids = [query['image_id'] for query in parsed if 'image_id' in query]
+        cards = load_cards([result['id'] for rows in results for result in rows if result.get('id') is not None] +
+                           source_ids, viewer_id)
+        response = {}
+        for key, query, rows in zip(keys, parsed, results):
+            items = [] if 'image_id' in query and query['image_id'] not in cards else attach_cards(rows, cards)
+            response[key] = {'count': len(items), 'results': items}
+        return Response({'results': response})
+
     @action(detail=False, methods=['post'], url_path='url')
     def search_by_url(self, request):
         """Endpoint tìm kiếm bằng URL ảnh"""
@@ -780,6 +891,33 @@ class ImageSearchViewSet(viewsets.ViewSet):
 
         # Dùng create để xử lý tìm kiếm
         return self.create(request)
+
+    @action(detail=False, methods=['get'], url_path='metrics', permission_classes=[IsAdminUser])
+    def metrics(self, request):
+        """Thống kê runtime của search engine (batch size, thời gian chờ hàng đợi)"""
+        search_engine = get_clip_search()
+        return Response(search_engine.get_metrics())
+
+    @action(detail=False, methods=['get'], url_path='popular-queries', permission_classes=[IsAdminUser])
+    def popular_queries(self, request):
+        """Top truy vấn văn bản (?limit=, mặc định 50) với score ~ số lượt tìm gần đây, cho dashboard"""
+        try:
+            limit = min(max(int(request.query_params.get('limit', 50)), 1), 1000)
+        except (TypeError, ValueError):
+            limit = 50
+        half_life = getattr(settings, 'CLIP_POPULAR_QUERIES_HALF_LIFE', 6 * 60 * 60)
+        try:
+            top = PopularQueryTracker(half_life=half_life).top(limit)
+        except Exception as e:
+            print(f"❌ Không đọc được truy vấn phổ biến: {e}")
+            return Response({"error": "Popular query statistics are unavailable"},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({
+            'half_life_s': half_life,
+            'queries': [{'query': query, 'score': round(score, 3)} for query, score in top],
+        })
+
+
 class ImagesCategoryViewSet(viewsets.ModelViewSet):
     queryset = ImageCategory.objects.select_related('image', 'category', 'image__user').order_by('id')
     serializer_class = ImagesCategorySerializer
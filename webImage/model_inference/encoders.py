@@ -0,0 +1,298 @@
+import copy
+import inspect
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+# Backend chạy encoder trên CPU, dùng chung cho CLIP (clip_retrieval) và ResNet50 (imageretrieval)
+BACKENDS = ('eager', 'torchscript', 'onnx')
+QUANTIZATIONS = ('none', 'dynamic', 'static')
+
+# Backend tối ưu phải cho kết quả gần như trùng với model eager fp32
+PARITY_THRESHOLD = 0.99
+
+# Truy vấn mẫu để kiểm tra parity / calibrate encoder văn bản
+SAMPLE_QUERIES = [
+    'a photo of a dog', 'sunset over the ocean', 'city skyline at night', 'a bowl of fresh fruit',
+    'mountains covered in snow', 'people walking in the rain', 'a red sports car', 'portrait of a smiling woman',
+    'old wooden house in the forest', 'close-up of a flower', 'ảnh phố cổ hà nội', 'a cat sleeping on a sofa',
+    'abstract colorful painting', 'a plate of noodles', 'children playing football', 'aerial view of a beach',
+]
+
+
+class InferenceParityError(Exception):
+    pass
+
+
+def configure_threads(num_threads):
+    """
+    Số luồng intra-op của PyTorch (0 = mặc định của torch). Đây là thiết lập của cả process: chỉ chủ của
+    process (engine CLIP, lệnh benchmark) gọi, một lần, trước khi chạy inference.
+    """
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+
+
+def sample_images(preprocess, count=16, size=256, seed=0):
+    """
+    Ảnh tổng hợp (gradient + nhiễu) đã qua preprocess của model, dùng cho kiểm tra parity / calibrate
+    khi không có ảnh thật.
+    """
+    from PIL import Image as PILImage
+
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 255, size, dtype='float32')
+    tensors = []
+    for _ in range(count):
+        channels = [np.add.outer(ramp * rng.random(), ramp * rng.random()) / 2 for _ in range(3)]
+        pixels = np.stack(channels, axis=-1) + rng.normal(0, 24, (size, size, 3))
+        tensors.append(preprocess(PILImage.fromarray(np.clip(pixels, 0, 255).astype('uint8'))))
+    return torch.stack(tensors)
+
+
+def to_channels_last(module):
+    """
+    Chuyển trọng số conv của module sang bộ nhớ channels_last, tại chỗ. Chỉ gọi một lần lúc load model,
+    bởi nơi sở hữu model (module có thể dùng chung, ví dụ encode_text / encode_image của CLIP).
+    """
+    return module.to(memory_format=torch.channels_last)
+
+
+class EagerEncoder:
+    """
+    Model PyTorch gốc, chạy trong inference_mode. channels_last chỉ đổi layout của input ảnh: encoder
+    không sửa module (trọng số được chuyển một lần lúc load bằng to_channels_last).
+    """
+
+    backend = 'eager'
+    quantization = 'none'
+
+    def __init__(self, module, forward, device='cpu', channels_last=False):
+        self.module = module
+        self.forward = forward
+        self.device = device
+        self.channels_last = channels_last
+
+    def __call__(self, inputs):
+        inputs = inputs.to(self.device)
+        if self.channels_last and inputs.dim() == 4:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            features = self.forward(self.module, inputs)
+        return features.float().cpu().numpy().astype('float32').reshape(features.shape[0], -1)
+
+
+class TorchScriptEncoder:
+    """Module đã trace + freeze bằng TorchScript (có thể đã lượng tử hoá int8)"""
+
+    backend = 'torchscript'
+
+    def __init__(self, scripted, quantization='none', channels_last=False):
+        self.scripted = scripted
+        self.quantization = quantization
+        self.channels_last = channels_last
+
+    def __call__(self, inputs):
+        inputs = inputs.cpu()
+        if self.channels_last and inputs.dim() == 4:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        with torch.inference_mode():
+            features = self.scripted(inputs)
+        return features.float().numpy().astype('float32').reshape(len(inputs), -1)
+
+
+class OnnxEncoder:
+    """Model đã export sang ONNX, chạy bằng ONNX Runtime (CPUExecutionProvider)"""
+
+    backend = 'onnx'
+
+    def __init__(self, path, quantization='none', num_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = int(num_threads)
+        self.session = ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.quantization = quantization
+
+    def __call__(self, inputs):
+        inputs = inputs.cpu().numpy() if hasattr(inputs, 'numpy') else np.asarray(inputs)
+        features = self.session.run(None, {self.input_name: inputs})[0]
+        return np.asarray(features, dtype='float32').reshape(len(inputs), -1)
+
+
+def _wrap(module, forward):
+    """nn.Module gọi forward(module, inputs): export / lượng tử hoá được cả encode_text / encode_image của CLIP"""
+
+    class _Forward(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.module = module
+
+        def forward(self, inputs):
+            return forward(self.module, inputs)
+
+    return _Forward().eval()
+
+
+def _artifact_path(artifact_dir, name, backend, quantization):
+    extension = 'onnx' if backend == 'onnx' else 'pt'
+    version = torch.__version__.replace('+', '_')
+    return os.path.join(str(artifact_dir), f'{name}-{backend}-{quantization}-torch{version}.{extension}')
+
+
+def _calibrate(prepared, samples, batch_size=8):
+    with torch.inference_mode():
+        for start in range(0, len(samples), batch_size):
+            prepared(samples[start:start + batch_size])
+
+
+def _export_torchscript(module, forward, samples, quantization, path):
+    wrapped = _wrap(copy.deepcopy(module).cpu().eval(), forward)
+    if quantization == 'dynamic':
+        # Trọng số Linear (transformer của CLIP) lưu int8, activation lượng tử hoá lúc chạy
+        wrapped = torch.ao.quantization.quantize_dynamic(wrapped, {torch.nn.Linear}, dtype=torch.qint8)
+    elif quantization == 'static':
+        # Lượng tử hoá tĩnh bằng FX graph mode (conv / linear + activation), calibrate trên samples
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        prepared = prepare_fx(wrapped, get_default_qconfig_mapping(), example_inputs=(samples[:1],))
+        _calibrate(prepared, samples)
+        wrapped = convert_fx(prepared)
+
+    with torch.inference_mode():
+        scripted = torch.jit.trace(wrapped, samples[:2], check_trace=False)
+    # Lưu module đã freeze; optimize_for_inference (fusion, op MKLDNN) không serialize được, chạy lúc load
+    torch.jit.save(torch.jit.freeze(scripted.eval()), path)
+
+
+def _export_onnx(module, forward, samples, quantization, path):
+    fp32_path = path if quantization == 'none' else f'{path}.fp32.onnx'
+    wrapped = _wrap(copy.deepcopy(module).cpu().eval(), forward)
+    options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # Exporter dựa trên TorchScript: không cần thêm onnxscript
+        options['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapped, (samples[:2],), fp32_path, input_names=['input'], output_names=['output'],
+            dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}}, opset_version=17, **options
+        )
+
+    if quantization != 'none':
+        from onnxruntime.quantization import (
+            CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+        )
+
+        if quantization == 'dynamic':
+            quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+        else:
+            class _Reader(CalibrationDataReader):
+                def __init__(self):
+                    self._batches = iter([{'input': samples[i:i + 1].numpy()} for i in range(len(samples))])
+
+                def get_next(self):
+                    return next(self._batches, None)
+
+            quantize_static(fp32_path, path, _Reader(), quant_format=QuantFormat.QDQ,
+                            activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+
+
+def check_parity(reference, candidate, samples, threshold=PARITY_THRESHOLD):
+    """
+    Cosine similarity nhỏ nhất giữa output của backend và model eager trên cùng samples.
+
+    Raises:
+        InferenceParityError: nếu nhỏ hơn threshold.
+    """
+    expected = reference(samples)
+    actual = candidate(samples)
+    expected /= np.linalg.norm(expected, axis=1, keepdims=True)
+    actual /= np.linalg.norm(actual, axis=1, keepdims=True)
+    similarity = float((expected * actual).sum(axis=1).min())
+    if similarity < threshold:
+        raise InferenceParityError(
+            f"{candidate.backend}/{candidate.quantization}: cosine {similarity:.4f} < {threshold} so với eager"
+        )
+    return similarity
+
+
+def build_encoder(name, module, forward, samples, backend='eager', quantization='none', device='cpu',
+                  artifact_dir=None, num_threads=0, channels_last=False, strict=False):
+    """
+    Encoder theo backend đã cấu hình. Model export (TorchScript / ONNX) được lưu trong artifact_dir và
+    dùng lại ở lần khởi động sau; mọi backend khác eager đều phải qua kiểm tra parity trên samples.
+
+    Args:
+        forward (callable): forward(module, inputs) -> features (ví dụ encode_text của CLIP).
+        samples: Tensor input mẫu (token / ảnh đã preprocess) để trace, calibrate và kiểm tra parity.
+        artifact_dir (str): Thư mục lưu model đã export, None = export lại vào thư mục tạm mỗi lần.
+        strict (bool): Raise khi backend lỗi / không đạt parity thay vì quay về eager.
+
+    Returns:
+        Encoder: gọi encoder(inputs) -> np.ndarray float32 (n, dim), chưa chuẩn hoá.
+    """
+    eager = EagerEncoder(module, forward, device, channels_last)
+    if backend == 'eager':
+        return eager
+    if backend not in BACKENDS or quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown inference backend {backend}/{quantization}")
+    if str(device) != 'cpu':
+        print(f"⚠️ Backend {backend} chỉ dùng cho CPU, {name} chạy eager trên {device}")
+        return eager
+
+    path = None
+    try:
+        if artifact_dir is None:
+            artifact_dir = tempfile.mkdtemp(prefix='inference-')
+        os.makedirs(str(artifact_dir), exist_ok=True)
+        path = _artifact_path(artifact_dir, name, backend, quantization)
+        started = time.perf_counter()
+        if not os.path.exists(path):
+            # Export ra file tạm rồi rename: worker khác không bao giờ đọc phải file đang ghi dở
+            partial = f'{path}.{os.getpid()}.partial'
+            export = _export_torchscript if backend == 'torchscript' else _export_onnx
+            export(module, forward, samples, quantization, partial)
+            os.replace(partial, path)
+
+        if backend == 'torchscript':
+            encoder = TorchScriptEncoder(torch.jit.optimize_for_inference(torch.jit.load(path)), quantization, channels_last)
+        else:
+            encoder = OnnxEncoder(path, quantization, num_threads)
+
+        similarity = check_parity(eager, encoder, samples)
+        print(f"✅ {name}: {backend}/{quantization} sẵn sàng sau {time.perf_counter() - started:.1f}s, "
+              f"cosine với eager >= {similarity:.4f}")
+        return encoder
+    except Exception as e:
+        # Model export lỗi / không đạt parity không được dùng lại ở lần khởi động sau
+        if path and os.path.exists(path):
+            os.remove(path)
+        if strict:
+            raise
+        print(f"⚠️ Không dùng được backend {backend}/{quantization} cho {name}: {e}. Quay về eager")
+        return eager
+
+
+def measure_throughput(encoder, samples, batch_size=16, min_seconds=2.0):
+    """Số input xử lý mỗi giây (ảnh/s hoặc truy vấn/s) với batch_size cố định, sau một lần warm-up"""
+    batch = samples[:batch_size]
+    if len(batch) < batch_size:
+        batch = samples[np.arange(batch_size) % len(samples)]
+    encoder(batch)
+
+    processed = 0
+    started = time.perf_counter()
+    while True:
+        encoder(batch)
+        processed += len(batch)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return processed / elapsed
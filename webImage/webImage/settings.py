@@ -185,6 +185,100 @@ MEDIA_ROOT = BASE_DIR / 'mediafiles'
 MEDIA_URL = '/mediafiles/'
 INDEX_DIR = MEDIA_ROOT / "image_index"
 INDEX_CLIP_DIR = MEDIA_ROOT / "clip_index"
+INFERENCE_ARTIFACT_DIR = MEDIA_ROOT / "inference"
+
+# CLIP search tuning
+# Gom các truy vấn text đồng thời: chờ tối đa WINDOW_MS hoặc đến khi đủ MAX_SIZE truy vấn
+CLIP_TEXT_BATCH_ENABLED = os.getenv('CLIP_TEXT_BATCH_ENABLED', 'true').lower() == 'true'
+CLIP_TEXT_BATCH_WINDOW_MS = float(os.getenv('CLIP_TEXT_BATCH_WINDOW_MS', '5'))
+CLIP_TEXT_BATCH_MAX_SIZE = int(os.getenv('CLIP_TEXT_BATCH_MAX_SIZE', '32'))
+# Số truy vấn text tối đa chờ batcher (vượt quá -> 503 + Retry-After); caller không chiếm worker của executor
+CLIP_TEXT_BATCH_MAX_PENDING = int(os.getenv('CLIP_TEXT_BATCH_MAX_PENDING', '256'))
+# Số embedding truy vấn giữ trong LRU của mỗi process; độ sâu danh sách xếp hạng được cache
+CLIP_QUERY_EMBEDDING_LRU_SIZE = int(os.getenv('CLIP_QUERY_EMBEDDING_LRU_SIZE', '1024'))
+# Embedding của ảnh upload (theo hash nội dung) giữ trong LRU của mỗi process
+CLIP_UPLOAD_EMBEDDING_LRU_SIZE = int(os.getenv('CLIP_UPLOAD_EMBEDDING_LRU_SIZE', '256'))
+CLIP_RANK_CACHE_DEPTH = int(os.getenv('CLIP_RANK_CACHE_DEPTH', '100'))
+# Kết quả tìm kiếm đã cache quá SOFT_TTL giây vẫn được trả, đồng thời làm mới nền (stale-while-revalidate).
+# Khi chưa có kết quả chỉ một worker tính (lock LOCK_TTL giây), các request khác chờ tối đa LOCK_WAIT giây
+CLIP_SEARCH_CACHE_SOFT_TTL = int(os.getenv('CLIP_SEARCH_CACHE_SOFT_TTL', '3600'))
+CLIP_SEARCH_CACHE_LOCK_TTL = int(os.getenv('CLIP_SEARCH_CACHE_LOCK_TTL', '10'))
+CLIP_SEARCH_CACHE_LOCK_WAIT = float(os.getenv('CLIP_SEARCH_CACHE_LOCK_WAIT', '5'))
+# Theo dõi truy vấn phổ biến (suy giảm một nửa sau HALF_LIFE giây) và tính trước kết quả của TOP_N truy vấn
+# mỗi khi index thay đổi (kiểm tra mỗi REFRESH_INTERVAL giây)
+CLIP_POPULAR_QUERIES_ENABLED = os.getenv('CLIP_POPULAR_QUERIES_ENABLED', 'true').lower() == 'true'
+CLIP_POPULAR_QUERIES_TOP_N = int(os.getenv('CLIP_POPULAR_QUERIES_TOP_N', '100'))
+CLIP_POPULAR_QUERIES_HALF_LIFE = int(os.getenv('CLIP_POPULAR_QUERIES_HALF_LIFE', '21600'))
+CLIP_POPULAR_QUERIES_MAX_SIZE = int(os.getenv('CLIP_POPULAR_QUERIES_MAX_SIZE', '10000'))
+CLIP_POPULAR_QUERIES_REFRESH_INTERVAL = float(os.getenv('CLIP_POPULAR_QUERIES_REFRESH_INTERVAL', '5'))
+# Compact index (xoá hẳn vector đã tombstone) khi tỉ lệ tombstone vượt ngưỡng này
+CLIP_COMPACTION_THRESHOLD = float(os.getenv('CLIP_COMPACTION_THRESHOLD', '0.1'))
+# Vector mới được search chính xác (numpy) trong delta, gộp vào FAISS index khi delta đủ số vector này
+CLIP_INDEX_DELTA_MAX_VECTORS = int(os.getenv('CLIP_INDEX_DELTA_MAX_VECTORS', '2048'))
+# Loại FAISS index cho CLIP: flat (chính xác), ivf_flat, ivf_pq, hnsw (xấp xỉ, nhanh hơn)
+CLIP_INDEX_TYPE = os.getenv('CLIP_INDEX_TYPE', 'flat')
+# Số cluster IVF (để trống = tự tính theo số ảnh), nprobe / efSearch mặc định khi search
+CLIP_IVF_NLIST = int(os.getenv('CLIP_IVF_NLIST')) if os.getenv('CLIP_IVF_NLIST') else None
+CLIP_IVF_NPROBE = int(os.getenv('CLIP_IVF_NPROBE', '16'))
+CLIP_HNSW_EF_SEARCH = int(os.getenv('CLIP_HNSW_EF_SEARCH', '64'))
+# Kiểu lưu vector trong index: float32, float16, int8 (SQ8) hoặc pq; index nén được re-rank chính xác
+# từ vector gốc trên đĩa với RERANK_FACTOR x top_k ứng viên
+CLIP_INDEX_STORAGE = os.getenv('CLIP_INDEX_STORAGE', 'float32')
+CLIP_RERANK_FACTOR = int(os.getenv('CLIP_RERANK_FACTOR', '4'))
+RESNET_INDEX_STORAGE = os.getenv('RESNET_INDEX_STORAGE', 'float32')
+RESNET_RERANK_FACTOR = int(os.getenv('RESNET_RERANK_FACTOR', '4'))
+# Tìm kiếm hai tầng: số chiều sau PCA của index (0 = không giảm chiều) và số ứng viên tối thiểu được re-rank
+# bằng vector gốc (đo trade-off latency / recall: manage.py index_storage_report --pca 64 128)
+CLIP_INDEX_PCA_DIM = int(os.getenv('CLIP_INDEX_PCA_DIM', '0'))
+CLIP_RERANK_MIN_CANDIDATES = int(os.getenv('CLIP_RERANK_MIN_CANDIDATES', '200'))
+RESNET_INDEX_PCA_DIM = int(os.getenv('RESNET_INDEX_PCA_DIM', '0'))
+RESNET_RERANK_MIN_CANDIDATES = int(os.getenv('RESNET_RERANK_MIN_CANDIDATES', '200'))
+# Số truy vấn đo recall của index khi engine build lại index lúc compaction
+CLIP_INDEX_RECALL_SAMPLE = int(os.getenv('CLIP_INDEX_RECALL_SAMPLE', '100'))
+# Memory-map (read-only) file index và embeddings: các worker dùng chung page cache,
+# thời gian khởi động không còn tỉ lệ với kích thước index
+CLIP_INDEX_MMAP = os.getenv('CLIP_INDEX_MMAP', 'false').lower() == 'true'
+RESNET_INDEX_MMAP = os.getenv('RESNET_INDEX_MMAP', 'false').lower() == 'true'
+# Thêm / xoá ảnh khỏi CLIP index qua hàng đợi Redis (worker: manage.py process_index_queue)
+CLIP_INDEX_QUEUE_ENABLED = os.getenv('CLIP_INDEX_QUEUE_ENABLED', 'true').lower() == 'true'
+CLIP_INDEX_FETCH_WORKERS = int(os.getenv('CLIP_INDEX_FETCH_WORKERS', '8'))
+# Số lần một job index được thử lại (batch lỗi / worker chết) trước khi vào dead-letter list
+CLIP_INDEX_QUEUE_MAX_ATTEMPTS = int(os.getenv('CLIP_INDEX_QUEUE_MAX_ATTEMPTS', '5'))
+# Đồng bộ CLIP index giữa các worker qua log thay đổi có version trong Redis (giữ LOG_RETENTION entry gần nhất;
+# worker tụt lại xa hơn đọc lại snapshot trên đĩa), mỗi worker chờ thay đổi mới tối đa SYNC_POLL giây mỗi lần
+CLIP_INDEX_SYNC_ENABLED = os.getenv('CLIP_INDEX_SYNC_ENABLED', 'true').lower() == 'true'
+CLIP_INDEX_LOG_RETENTION = int(os.getenv('CLIP_INDEX_LOG_RETENTION', '10000'))
+CLIP_INDEX_SYNC_POLL = float(os.getenv('CLIP_INDEX_SYNC_POLL', '5'))
+# Unix socket của search daemon (manage.py run_search_daemon); để trống = load model trong từng worker
+CLIP_SEARCH_SOCKET = os.getenv('CLIP_SEARCH_SOCKET', '')
+CLIP_SEARCH_TIMEOUT = float(os.getenv('CLIP_SEARCH_TIMEOUT', '30'))
+# Executor search của mỗi process (hoặc của daemon): số request chạy đồng thời, số request được chờ
+# (vượt quá -> 503 + Retry-After) và deadline (giây) của mỗi request
+CLIP_SEARCH_WORKERS = int(os.getenv('CLIP_SEARCH_WORKERS', '2'))
+CLIP_SEARCH_QUEUE_SIZE = int(os.getenv('CLIP_SEARCH_QUEUE_SIZE', '16'))
+CLIP_SEARCH_DEADLINE = float(os.getenv('CLIP_SEARCH_DEADLINE', '10'))
+# Giới hạn cứng top_k của mỗi lần tìm kiếm (giá trị client gửi lớn hơn sẽ bị cắt)
+CLIP_SEARCH_MAX_TOP_K = int(os.getenv('CLIP_SEARCH_MAX_TOP_K', '100'))
+CLIP_SEARCH_MAX_BATCH_QUERIES = int(os.getenv('CLIP_SEARCH_MAX_BATCH_QUERIES', '50'))
+# Tìm kiếm văn bản kết hợp CLIP + BM25 (title / description) khi client gửi mode=hybrid (mặc định chỉ CLIP):
+# trọng số CLIP và số ứng viên mỗi nguồn
+CLIP_HYBRID_SEARCH_ENABLED = os.getenv('CLIP_HYBRID_SEARCH_ENABLED', 'true').lower() == 'true'
+CLIP_HYBRID_CLIP_WEIGHT = float(os.getenv('CLIP_HYBRID_CLIP_WEIGHT', '0.5'))
+CLIP_HYBRID_CANDIDATES = int(os.getenv('CLIP_HYBRID_CANDIDATES', '100'))
+# Phân trang bằng cursor: số kết quả xếp hạng một lần cho mỗi truy vấn và thời gian (giây) giữ danh sách
+CLIP_SEARCH_PAGE_DEPTH = int(os.getenv('CLIP_SEARCH_PAGE_DEPTH', '500'))
+CLIP_SEARCH_PAGE_TTL = int(os.getenv('CLIP_SEARCH_PAGE_TTL', '1800'))
+# Backend inference trên CPU cho encoder CLIP / ResNet50: eager | torchscript | onnx,
+# lượng tử hoá int8: none | dynamic | static (backend không đạt parity với eager sẽ quay về eager)
+CLIP_INFERENCE_BACKEND = os.getenv('CLIP_INFERENCE_BACKEND', 'eager')
+CLIP_INFERENCE_QUANTIZATION = os.getenv('CLIP_INFERENCE_QUANTIZATION', 'none')
+RESNET_INFERENCE_BACKEND = os.getenv('RESNET_INFERENCE_BACKEND', 'eager')
+RESNET_INFERENCE_QUANTIZATION = os.getenv('RESNET_INFERENCE_QUANTIZATION', 'none')
+# Tổng số luồng torch / FAISS của một process (0 = số CPU), chia đều cho các worker của executor search
+INFERENCE_NUM_THREADS = int(os.getenv('INFERENCE_NUM_THREADS', '0'))
+INFERENCE_CHANNELS_LAST = os.getenv('INFERENCE_CHANNELS_LAST', 'false').lower() == 'true'
+# TTL (giây) của "image card" đã render cho kết quả tìm kiếm
+SEARCH_CARD_CACHE_TTL = int(os.getenv('SEARCH_CARD_CACHE_TTL', '60'))
 # Simple JWT settings
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=1),